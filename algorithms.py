@@ -1,38 +1,44 @@
 # algorithms.py
 import numpy as np
-from shapely.geometry import MultiPoint
-from sklearn.cluster import AgglomerativeClustering
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra, minimum_spanning_tree
 
-def phar(densities, G, density_threshold=1.0, dist_threshold=300):
+import instrumentation
+from clustering import cluster_coords
+from compiled_graph import compile_graph
+from hotspot_polygons import cluster_polygons
+from network_utils import snapped_kde, MAX_DIJKSTRA_CELLS
+
+SHAR_CONNECTIONS = ('all_pairs', 'mst')
+# Limite inicial da busca do SHAR, em múltiplos da extensão (diagonal) do cluster
+SHAR_SEARCH_FACTOR = 3.0
+
+def phar(densities, G, density_threshold=1.0, dist_threshold=300, method='average', stats=None, trace_memory=False,
+         polygon='convex'):
     """
     PHAR: Seleciona nós com densidade acima do limiar, clusteriza-os e gera polígonos (convex hull).
+    G pode ser o grafo do OSMnx (projetado) ou um CompiledGraph.
+    `method`: backend de agrupamento (ver clustering.CLUSTERING_METHODS); `stats` (dict)
+    recebe o tempo (e, com `trace_memory`, o pico de memória) do agrupamento.
+    `polygon`: tipo de polígono (ver hotspot_polygons.POLYGON_TYPES), todos em uma chamada vetorizada.
     """
     selected_nodes = [n for n, d in densities.items() if d >= density_threshold]
     if not selected_nodes:
         return []
-    import osmnx as ox
-    nodes_gdf = ox.graph_to_gdfs(G, nodes=True, edges=False).to_crs(epsg=3857)
-    sub_nodes = nodes_gdf.loc[selected_nodes]
-    coords = np.vstack([sub_nodes.geometry.x, sub_nodes.geometry.y]).T
-    if len(coords) < 2:
+    graph = compile_graph(G)
+    nodes = graph.indices_of(selected_nodes)
+    if len(nodes) < 2:
         return []
-    cluster_model = AgglomerativeClustering(n_clusters=None, distance_threshold=dist_threshold, linkage='average')
-    labels = cluster_model.fit_predict(coords)
-    sub_nodes['cluster'] = labels
-    polygons = []
-    for c_id in np.unique(labels):
-        group = sub_nodes[sub_nodes['cluster'] == c_id]
-        if len(group) < 3:
-            continue
-        points = MultiPoint(list(group.geometry))
-        hull = points.convex_hull
-        polygons.append((c_id, hull))
+    coords = np.column_stack([graph.x[nodes], graph.y[nodes]])
+    labels = cluster_coords(coords, dist_threshold, method=method, stats=stats, trace_memory=trace_memory)
+    polygons = cluster_polygons(graph, nodes, labels, kind=polygon)
+    instrumentation.count('nós selecionados', len(selected_nodes))
+    instrumentation.count('polígonos', len(polygons))
     return polygons
 
-def i_phar(densities, G, old_polygons, new_crimes, bandwidth=200, density_threshold=1.0, dist_threshold=300):
+def _snap_new_crimes(graph, new_crimes, mode='node'):
     """
-    i-PHAR: Atualiza as densidades com novas ocorrências e reaplica a lógica do PHAR.
-    Trata corretamente o CRS dos novos crimes.
+    Associa à rede os novos crimes (GeoSeries/GeoDataFrame ou sequência de pontos em EPSG:3857).
     """
     import geopandas as gpd
     # Se new_crimes já tem CRS, converta para EPSG:3857; caso contrário, defina-o.
@@ -41,87 +47,329 @@ def i_phar(densities, G, old_polygons, new_crimes, bandwidth=200, density_thresh
     else:
         new_crimes = gpd.GeoSeries(new_crimes).set_crs("EPSG:3857", allow_override=True)
     gdf_new = gpd.GeoDataFrame(geometry=new_crimes)
-    crime_coords = [(geom.x, geom.y) for geom in gdf_new.geometry]
-    import osmnx as ox
-    for (cx, cy) in crime_coords:
-        nearest_node = ox.distance.nearest_nodes(G, X=[cx], Y=[cy])[0]
+    return graph.snap_index.snap_gdf(gdf_new, mode=mode)
+
+def i_phar(densities, G, old_polygons, new_crimes, bandwidth=200, density_threshold=1.0, dist_threshold=300,
+           snapped=None, polygon='convex'):
+    """
+    i-PHAR: Atualiza as densidades com novas ocorrências e reaplica a lógica do PHAR.
+    Trata corretamente o CRS dos novos crimes.
+    `snapped` (SnappedPoints) permite informar as posições já associadas à rede,
+    dispensando a consulta ao grafo para cada novo crime.
+    Para atualizações sucessivas sobre o mesmo estado, use IncrementalPHAR.
+    """
+    graph = compile_graph(G)
+    if snapped is None:
+        snapped = _snap_new_crimes(graph, new_crimes)
+    delta = snapped_kde(graph, snapped, bandwidth)
+    for i in np.flatnonzero(delta):
+        node = graph.node_ids[i].item()
+        densities[node] = densities.get(node, 0.0) + float(delta[i])
+    return phar(densities, graph, density_threshold, dist_threshold, polygon=polygon)
+
+class IncrementalPHAR:
+    """
+    Estado persistente do i-PHAR: densidades por nó, rótulo de cluster de cada nó
+    selecionado e o polígono de cada cluster.
+    A cada atualização, só a contribuição dos novos crimes é calculada (KDE limitado
+    às vizinhanças deles). Como o agrupamento depende apenas do conjunto de nós acima
+    do limiar, só os nós que cruzaram o limiar disparam reagrupamento, e apenas dos
+    clusters alcançáveis a partir deles por saltos de até `dist_threshold`; os demais
+    polígonos são devolvidos sem alteração. Os ids de clusters não afetados são preservados.
+    """
+
+    def __init__(self, G, densities, bandwidth=200, density_threshold=1.0, dist_threshold=300, method='average',
+                 polygon='convex'):
+        self.graph = compile_graph(G)
+        self.method = method
+        self.polygon = polygon
+        self.bandwidth = bandwidth
+        self.density_threshold = density_threshold
+        self.dist_threshold = dist_threshold
+        graph = self.graph
+        if isinstance(densities, dict):
+            values = np.zeros(graph.n_nodes)
+            nodes = list(densities)
+            idx = graph.indices_of(nodes)
+            values[idx] = np.fromiter((densities[n] for n in nodes), dtype=float, count=len(nodes))
+            densities = values
+        self.density = np.asarray(densities, dtype=float).copy()
+        self.labels = np.full(graph.n_nodes, -1, dtype=np.int64)
+        self.members = {}
+        self.hulls = {}
+        self._next_id = 0
+        self.last_update = {}
+        selected = np.flatnonzero(self.density >= density_threshold)
+        # Mesmo comportamento do PHAR: com menos de 2 nós selecionados não há clusters
+        if len(selected) >= 2:
+            self._recluster(selected)
+
+    def _recluster(self, nodes):
+        """
+        Agrupa os nós informados e cria clusters novos para eles.
+        """
+        graph = self.graph
+        coords = np.column_stack([graph.x[nodes], graph.y[nodes]])
+        labels = cluster_coords(coords, self.dist_threshold, method=self.method)
+        # Ruído do DBSCAN: cada nó vira um grupo próprio, sem polígono, para continuar
+        # alcançável na expansão das próximas atualizações
+        noise = labels < 0
+        hulls = dict(cluster_polygons(graph, nodes, labels, kind=self.polygon))
+        labels[noise] = labels.max() + 1 + np.arange(noise.sum())
+        order = np.argsort(labels, kind='stable')
+        keys, starts = np.unique(labels[order], return_index=True)
+        for label, members in zip(keys.tolist(), np.split(nodes[order], starts[1:])):
+            c_id = self._next_id
+            self._next_id += 1
+            self.members[c_id] = members
+            self.labels[members] = c_id
+            self.hulls[c_id] = hulls.get(label)
+
+    def polygons(self):
+        """
+        Lista [(c_id, polígono)] dos clusters com pelo menos 3 nós, no formato do PHAR.
+        """
+        return [(c_id, hull) for c_id, hull in sorted(self.hulls.items()) if hull is not None]
+
+    def densities(self):
+        """
+        Densidades atuais como dicionário {node_id: densidade} (apenas nós com densidade > 0).
+        """
+        idx = np.flatnonzero(self.density)
+        return dict(zip(self.graph.node_ids[idx].tolist(), self.density[idx].tolist()))
+
+    def update(self, new_crimes=None, snapped=None):
+        """
+        Soma a densidade dos novos crimes (ou das posições já associadas `snapped`) e
+        reagrupa só a vizinhança dos nós que passaram a ficar acima do limiar.
+        Retorna os polígonos atualizados.
+        """
+        with instrumentation.stage('atualização i-PHAR'):
+            return self._update(new_crimes, snapped)
+
+    def _update(self, new_crimes, snapped):
+        graph = self.graph
+        if snapped is None:
+            snapped = _snap_new_crimes(graph, new_crimes)
+        delta = snapped_kde(graph, snapped, self.bandwidth)
+        changed = np.flatnonzero(delta)
+        self.density[changed] += delta[changed]
+        crossed = changed[(self.density[changed] >= self.density_threshold) & (self.labels[changed] < 0)]
+        affected = np.empty(0, dtype=np.int64)
+        region = crossed
+        if len(crossed):
+            # Com average linkage, grupos cujos nós distam todos >= dist_threshold nunca se
+            # fundem: basta reagrupar a componente (ligações < dist_threshold entre nós
+            # selecionados) que contém os nós novos. Ela é expandida cluster a cluster.
+            affected = []
+            frontier = crossed
+            parts = [crossed]
+            while len(frontier):
+                near = graph.snap_index.nodes_within(graph.x[frontier], graph.y[frontier], self.dist_threshold)
+                found = np.unique(self.labels[near])
+                found = [c_id for c_id in found[found >= 0] if c_id in self.members]
+                found_members = [self.members.pop(c_id) for c_id in found]
+                affected.extend(found)
+                parts.extend(found_members)
+                frontier = np.concatenate(found_members) if found_members else np.empty(0, dtype=np.int64)
+            region = np.concatenate(parts)
+            for c_id in affected:
+                del self.hulls[c_id]
+            self.labels[region] = -1
+            selected_total = len(region) + sum(len(m) for m in self.members.values())
+            if selected_total >= 2:
+                self._recluster(np.sort(region))
+        self.last_update = {
+            'Crimes novos': len(snapped),
+            'Nós com densidade alterada': len(changed),
+            'Nós que cruzaram o limiar': len(crossed),
+            'Clusters reagrupados': len(affected),
+            'Nós reagrupados': len(region),
+        }
+        for name, value in self.last_update.items():
+            instrumentation.count(name.lower(), value)
+        return self.polygons()
+
+def _shortest_path_trees(graph, sources, limit=np.inf):
+    """
+    Árvores de caminhos mínimos (dijkstra limitado a `limit` metros) a partir de cada
+    índice de `sources`, em blocos que respeitam MAX_DIJKSTRA_CELLS.
+    Gera (posições em sources, distâncias, predecessores).
+    """
+    block = max(1, MAX_DIJKSTRA_CELLS // max(graph.n_nodes, 1))
+    for start in range(0, len(sources), block):
+        rows = np.arange(start, min(start + block, len(sources)))
+        dist, pred = dijkstra(graph.matrix, directed=True, indices=sources[rows], limit=limit,
+                              return_predecessors=True)
+        yield rows, dist, pred
+
+def _connect_cluster(graph, members, connection='all_pairs'):
+    """
+    Liga os nós do cluster (índices) por caminhos mínimos, com uma única busca por membro
+    reaproveitada para todos os seus destinos.
+    connection 'all_pairs': união dos caminhos de cada membro para os seguintes (como no
+    SHAR original); 'mst': só os caminhos das arestas da árvore geradora mínima do fecho
+    métrico dos membros (aproximação de árvore de Steiner).
+    Retorna (conjunto de arestas (u, v) em ids, número de pares sem caminho).
+    """
+    k = len(members)
+    xy = np.column_stack([graph.x[members], graph.y[members]])
+    # Busca limitada a algumas vezes a extensão do cluster; linhas com destinos não
+    # alcançados são refeitas sem limite, então o resultado é exato
+    extent = float(np.hypot(*(xy.max(axis=0) - xy.min(axis=0))))
+    row_limit = np.full(k, SHAR_SEARCH_FACTOR * max(extent, 1.0))
+    closure = np.full((k, k), np.inf)
+    keep = k * graph.n_nodes <= MAX_DIJKSTRA_CELLS
+    preds = {}
+
+    def search(rows):
+        for block, dist, pred in _shortest_path_trees(graph, members[rows], row_limit[rows[0]]):
+            closure[rows[block]] = dist[:, members]
+            if keep:
+                preds.update(zip(rows[block].tolist(), pred))
+
+    search(np.arange(k))
+    if connection == 'all_pairs':
+        needed = np.triu(np.ones((k, k), dtype=bool), 1)
+    else:
+        needed = ~np.eye(k, dtype=bool)
+    retry = np.flatnonzero((np.isinf(closure) & needed).any(axis=1))
+    if len(retry):
+        row_limit[retry] = np.inf
+        search(retry)
+
+    if connection == 'all_pairs':
+        reachable = needed & np.isfinite(closure)
+        unreachable = int((needed & ~reachable).sum())
+        targets = {i: np.flatnonzero(reachable[i]) for i in range(k) if reachable[i].any()}
+    else:
+        sym = np.minimum(closure, closure.T)
+        upper = np.triu(np.isfinite(sym), 1)
+        unreachable = int(np.triu(~np.isfinite(sym), 1).sum())
+        i, j = np.nonzero(upper)
+        # Deslocamento mínimo: arestas de comprimento zero não somem da matriz esparsa
+        weights = coo_matrix((sym[i, j] + 1e-9, (i, j)), shape=(k, k))
+        tree = minimum_spanning_tree(weights).tocoo()
+        targets = {}
+        for a, b in zip(tree.row.tolist(), tree.col.tolist()):
+            src, dst = (a, b) if closure[a, b] <= closure[b, a] else (b, a)
+            targets.setdefault(src, []).append(dst)
+
+    edges = set()
+    sources = np.array(sorted(targets), dtype=np.int64)
+    missing = [r for r in sources.tolist() if r not in preds]
+    for limit in np.unique(row_limit[missing]) if missing else []:
+        rows = np.array([r for r in missing if row_limit[r] == limit], dtype=np.int64)
+        for block, _, pred in _shortest_path_trees(graph, members[rows], limit):
+            preds.update(zip(rows[block].tolist(), pred))
+    for r in sources.tolist():
+        pred = preds[r]
+        source = members[r]
         visited = set()
-        queue = [(nearest_node, 0)]
-        while queue:
-            current, dist = queue.pop()
-            if current in visited:
-                continue
-            visited.add(current)
-            decay = np.exp(-dist / bandwidth)
-            densities[current] += decay
-            for neighbor in G[current]:
-                edge_length = G[current][neighbor][0].get('length', 1)
-                ndist = dist + edge_length
-                if ndist <= bandwidth:
-                    queue.append((neighbor, ndist))
-    return phar(densities, G, density_threshold, dist_threshold)
-
-def shar(densities, G, density_threshold=1.0, dist_threshold=300):
+        for t in targets[r]:
+            x = members[t]
+            while x != source and x not in visited:
+                visited.add(x)
+                edges.add((pred[x], x))
+                x = pred[x]
+    ids = graph.node_ids
+    return {(ids[u].item(), ids[v].item()) for u, v in edges}, unreachable
+
+def shar(densities, G, density_threshold=1.0, dist_threshold=300, method='average', stats=None, trace_memory=False,
+         connection='all_pairs', workers=1):
     """
     SHAR: Seleciona nós com densidade >= threshold, clusteriza-os e constrói subgrafos
     conectando os nós do cluster via caminhos mínimos.
+    G pode ser o grafo do OSMnx (projetado) ou um CompiledGraph.
+    `method`, `stats` e `trace_memory`: como no PHAR.
+    `connection`: 'all_pairs' (caminhos entre todos os pares) ou 'mst' (árvore geradora
+    mínima do fecho métrico, com menos arestas). `workers` > 1 processa os clusters em
+    paralelo (threads). Pares sem caminho são contados em stats['Pares sem caminho'].
     """
+    if connection not in SHAR_CONNECTIONS:
+        raise ValueError(f"Conexão desconhecida para o SHAR: {connection}")
     selected_nodes = [n for n, d in densities.items() if d >= density_threshold]
     if not selected_nodes:
         return []
-    import osmnx as ox
-    nodes_gdf = ox.graph_to_gdfs(G, nodes=True, edges=False).to_crs(epsg=3857)
-    sub_nodes = nodes_gdf.loc[selected_nodes]
-    coords = np.vstack([sub_nodes.geometry.x, sub_nodes.geometry.y]).T
+    graph = compile_graph(G)
+    coords = graph.coords(selected_nodes)
     if len(coords) < 2:
         return []
-    cluster_model = AgglomerativeClustering(n_clusters=None, distance_threshold=dist_threshold, linkage='average')
-    labels = cluster_model.fit_predict(coords)
-    sub_nodes['cluster'] = labels
-    subgraphs = []
-    for c_id in np.unique(labels):
-        group = sub_nodes[sub_nodes['cluster'] == c_id]
-        if len(group) < 2:
-            continue
-        c_nodes = list(group.index)
-        edges_in_subgraph = []
-        for i in range(len(c_nodes)):
-            for j in range(i+1, len(c_nodes)):
-                try:
-                    path = ox.shortest_path(G, c_nodes[i], c_nodes[j])
-                    path_pairs = list(zip(path[:-1], path[1:]))
-                    edges_in_subgraph.extend(path_pairs)
-                except Exception:
-                    pass
-        subgraphs.append((c_id, set(edges_in_subgraph)))
-    return subgraphs
-
-def expansive_network(densities, G, density_threshold=1.0):
+    labels = cluster_coords(coords, dist_threshold, method=method, stats=stats, trace_memory=trace_memory)
+    selected_idx = graph.indices_of(selected_nodes)
+    clusters = []
+    for c_id in np.unique(labels[labels >= 0]):
+        members = selected_idx[labels == c_id]
+        if len(members) >= 2:
+            clusters.append((c_id, members))
+
+    def connect(cluster):
+        return _connect_cluster(graph, cluster[1], connection)
+
+    with instrumentation.stage('caminhos'):
+        if workers > 1 and len(clusters) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(connect, clusters))
+        else:
+            results = [connect(cluster) for cluster in clusters]
+        if instrumentation.enabled():
+            sizes = np.array([len(members) for _, members in clusters], dtype=np.int64)
+            pairs = sizes * (sizes - 1) // 2 if connection == 'all_pairs' else sizes - 1
+            instrumentation.count('nós selecionados', len(selected_nodes))
+            instrumentation.count('clusters conectados', len(clusters))
+            instrumentation.count('caminhos entre pares', int(pairs.sum()))
+            instrumentation.count('pares sem caminho', sum(unreachable for _, unreachable in results))
+    if stats is not None:
+        stats['Pares sem caminho'] = sum(unreachable for _, unreachable in results)
+    return [(c_id, edges) for (c_id, _), (edges, _) in zip(clusters, results)]
+
+def expansion_tree(densities, G, lixels=None):
+    """
+    Árvore de junção (MergeTree) do campo de densidades usado pelo Expansive Network:
+    por nó (dict) na vizinhança não direcionada do grafo ou, com `lixels`, por lixel.
+    Construída uma vez por campo; cada limiar é só uma consulta.
+    """
+    from merge_tree import MergeTree
+    if lixels is not None:
+        return MergeTree(lixels.adjacency(), densities)
+    return MergeTree.from_graph(G, densities)
+
+def _cluster_edges(graph, members):
+    """
+    Arestas que saem dos nós do cluster (índices), cada via uma única vez, como pares de ids.
+    """
+    sizes = graph.indptr[members + 1] - graph.indptr[members]
+    owner = np.repeat(members, sizes)
+    targets = graph.indices[np.repeat(graph.indptr[members], sizes) + np.arange(sizes.sum())
+                            - np.repeat(np.cumsum(sizes) - sizes, sizes)].astype(np.int64)
+    keys = np.unique(np.minimum(owner, targets) * graph.n_nodes + np.maximum(owner, targets))
+    ids = graph.node_ids
+    return list(zip(ids[keys // graph.n_nodes].tolist(), ids[keys % graph.n_nodes].tolist()))
+
+def expansive_network(densities, G, density_threshold=1.0, lixels=None, tree=None):
     """
     Expansive Network: Expande a partir dos nós com maior densidade para formar clusters.
+    G pode ser o grafo do OSMnx ou um CompiledGraph.
+    Os clusters são os componentes conexos dos nós com densidade >= limiar, do maior para
+    o menor pico, lidos da árvore de junção (`tree`, de expansion_tree; construída aqui
+    se não for informada). Cada cluster traz as arestas que saem dos seus nós, sem repetir
+    os dois sentidos de uma via.
+    Com `lixels` (LixelNetwork), `densities` é o array de densidade por lixel e cada
+    cluster vem como (id, nós, arestas, lixels).
     """
-    sorted_nodes = sorted(densities.items(), key=lambda x: x[1], reverse=True)
-    visited = set()
+    graph = compile_graph(G)
+    if tree is None:
+        tree = expansion_tree(densities, graph, lixels)
+    components = tree.components(density_threshold)
     expansions = []
-    c_id = 0
-    for n, dval in sorted_nodes:
-        if n in visited:
-            continue
-        if dval < density_threshold:
-            break
-        frontier = [n]
-        cluster_edges = []
-        cluster_nodes = set()
-        while frontier:
-            current = frontier.pop()
-            if current in visited:
-                continue
-            visited.add(current)
-            cluster_nodes.add(current)
-            for neighbor in G[current]:
-                if densities.get(neighbor, 0) >= density_threshold and neighbor not in visited:
-                    frontier.append(neighbor)
-                cluster_edges.append((current, neighbor))
-        expansions.append((c_id, cluster_nodes, cluster_edges))
-        c_id += 1
+    for c_id, members in enumerate(components):
+        if lixels is not None:
+            edge_pairs = lixels.edge_pairs(members)
+            expansions.append((c_id, {n for pair in edge_pairs for n in pair}, edge_pairs, members))
+        else:
+            expansions.append((c_id, set(graph.node_ids[members].tolist()), _cluster_edges(graph, members)))
+    instrumentation.count('lixels visitados' if lixels is not None else 'nós visitados',
+                          sum(len(m) for m in components))
+    instrumentation.count('clusters', len(expansions))
     return expansions
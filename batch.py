@@ -0,0 +1,210 @@
+# batch.py
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from pipeline import DEFAULT_CONFIG, PIPELINE_ALGORITHMS, run_municipio, write_hotspots
+
+# Cada processo é substituído após este número de municípios, devolvendo a memória ao sistema
+DEFAULT_MAX_TASKS_PER_CHILD = 4
+# Bibliotecas numéricas usam uma thread por processo: o paralelismo vem do pool
+_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+def list_municipios(df):
+    """
+    Municípios (UF, MUNICIPIO) presentes nos dados e o número de crimes de cada um,
+    do maior para o menor.
+    """
+    counts = df.groupby(['UF', 'MUNICIPIO'], observed=True).size().rename('CRIMES').reset_index()
+    counts = counts[counts['CRIMES'] > 0]
+    return counts.sort_values('CRIMES', ascending=False, kind='stable').reset_index(drop=True)
+
+def _init_worker(memory_limit_mb):
+    """
+    Limita o espaço de endereçamento do processo: um município grande demais falha com
+    MemoryError em vez de derrubar a máquina.
+    """
+    if memory_limit_mb:
+        import resource
+        limit = int(memory_limit_mb) * 1024 ** 2
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def process_municipio(task):
+    """
+    Gera os hotspots de um município com o pipeline (pipeline.run_municipio): lê os
+    crimes (da tarefa ou da base particionada), obtém a rede, calcula as densidades e
+    roda o algoritmo. Nunca propaga exceções: o erro fica registrado no resultado,
+    isolado dos demais. Retorna um dict com o resumo e os hotspots (GeoDataFrame EPSG:4326).
+    """
+    start = time.perf_counter()
+    uf, municipio, config = task['uf'], task['municipio'], task['config']
+    result = {'UF': uf, 'MUNICIPIO': municipio, 'Status': 'ok', 'Crimes': 0, 'Nós': None,
+              'Hotspots': 0, 'Tempo (s)': None, 'Erro': None, 'hotspots': None}
+    try:
+        df = task.get('data')
+        if df is None:
+            from crime_store import read_crime_dataset
+            df = read_crime_dataset(task['dataset_dir'], uf=uf, municipio=municipio, start=config['start'],
+                                    end=config['end'], naturezas=config['naturezas'] or None,
+                                    faixa_hora_1=config['faixa_hora_1'] or None,
+                                    faixa_hora_6=config['faixa_hora_6'] or None)
+        result['Crimes'] = len(df)
+        if df.empty:
+            result['Status'] = 'sem dados'
+            return result
+        output = run_municipio(df, uf, municipio, {**config, 'municipio': municipio}, with_table=False)
+        result['Nós'] = output['resumo']['Nós']
+        result['Hotspots'] = output['resumo']['Hotspots']
+        result['hotspots'] = output['hotspots']
+    except Exception as e:
+        result['Status'] = 'erro'
+        result['Erro'] = f"{type(e).__name__}: {e}"
+    finally:
+        result['Tempo (s)'] = round(time.perf_counter() - start, 3)
+    return result
+
+def _crash_result(task, error):
+    return {'UF': task['uf'], 'MUNICIPIO': task['municipio'], 'Status': 'erro', 'Crimes': None, 'Nós': None,
+            'Hotspots': 0, 'Tempo (s)': None, 'Erro': error, 'hotspots': None}
+
+def _run_pool(tasks, workers, max_tasks_per_child, memory_limit_mb, on_result):
+    """
+    Executa as tarefas no pool; retorna as que não terminaram porque um processo morreu
+    (ex.: morto pelo sistema por falta de memória), o que invalida o pool inteiro.
+    """
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=max_tasks_per_child,
+                             initializer=_init_worker, initargs=(memory_limit_mb,)) as executor:
+        futures = {executor.submit(process_municipio, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                on_result(future.result())
+            except BrokenProcessPool:
+                broken.append(futures[future])
+    return broken
+
+def run_batch(source, output=None, config=None, municipios=None, workers=None,
+              max_tasks_per_child=DEFAULT_MAX_TASKS_PER_CHILD, memory_limit_mb=None, progress=None):
+    """
+    Gera hotspots para vários municípios em paralelo (um processo por município).
+    source: caminho de um CSV (limpo e dividido por UF/MUNICIPIO aqui) ou diretório da
+    base particionada (cada processo lê só a sua partição).
+    config: parâmetros do pipeline (ver pipeline.DEFAULT_CONFIG; 'source' e 'municipio'
+    são ignorados, os filtros de natureza, faixas e datas valem para todos os municípios).
+    municipios: lista opcional de
+    nomes para restringir o lote. Os municípios maiores são enviados primeiro, para
+    equilibrar a carga entre os processos.
+    Falhas ficam isoladas: exceções viram linhas com Status 'erro' no relatório; se um
+    processo morrer, as tarefas afetadas são repetidas, uma por vez, em processos novos.
+    progress(concluídos, total, resultado) é chamado a cada município.
+    Retorna (GeoDataFrame com os hotspots em EPSG:4326, DataFrame com o relatório) e, se
+    `output` for informado, grava os hotspots (.parquet, .gpkg ou .geojson) e o relatório
+    (<output>_relatorio.csv).
+    """
+    import geopandas as gpd
+
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    if config['algorithm'] not in PIPELINE_ALGORITHMS:
+        raise ValueError(f"Algoritmo desconhecido: {config['algorithm']}")
+    base = {'config': config}
+    if os.path.isdir(source):
+        from crime_store import list_partitions
+        partitions = list_partitions(source)
+        if partitions is None or partitions.empty:
+            raise ValueError(f"A base em '{source}' está vazia.")
+        # Sem ler os dados, o número de partições (meses) estima o tamanho de cada município
+        sizes = partitions.groupby(['UF', 'MUNICIPIO']).size().rename('PARTICOES').reset_index()
+        sizes = sizes.sort_values('PARTICOES', ascending=False, kind='stable')
+        tasks = [{**base, 'uf': r.UF, 'municipio': r.MUNICIPIO, 'dataset_dir': source}
+                 for r in sizes.itertuples()]
+    else:
+        from pipeline import load_crimes
+        df = load_crimes({**config, 'source': source, 'municipio': None, 'uf': None})
+        sizes = list_municipios(df)
+        groups = df.groupby(['UF', 'MUNICIPIO'], observed=True)
+        tasks = [{**base, 'uf': r.UF, 'municipio': r.MUNICIPIO, 'data': groups.get_group((r.UF, r.MUNICIPIO))}
+                 for r in sizes.itertuples()]
+    if municipios:
+        wanted = {m.strip().upper() for m in municipios}
+        tasks = [t for t in tasks if str(t['municipio']).upper() in wanted]
+
+    results = []
+
+    def on_result(result):
+        results.append(result)
+        if progress:
+            progress(len(results), len(tasks), result)
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    previous = {var: os.environ.get(var) for var in _THREAD_VARIABLES}
+    os.environ.update({var: '1' for var, value in previous.items() if value is None})
+    try:
+        broken = _run_pool(tasks, workers, max_tasks_per_child, memory_limit_mb, on_result) if tasks else []
+        for task in broken:
+            # Isolado em um processo próprio: se morrer de novo, só este município falha
+            if _run_pool([task], 1, 1, memory_limit_mb, on_result):
+                on_result(_crash_result(task, "Processo encerrado inesperadamente (memória insuficiente?)"))
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+
+    parts = [r['hotspots'] for r in results if r['hotspots'] is not None and len(r['hotspots'])]
+    if parts:
+        hotspots = gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), crs="EPSG:4326")
+    else:
+        hotspots = gpd.GeoDataFrame(columns=['UF', 'MUNICIPIO', 'ALGORITMO', 'CLUSTER', 'geometry'],
+                                    geometry='geometry', crs="EPSG:4326")
+    report = pd.DataFrame([{k: v for k, v in r.items() if k != 'hotspots'} for r in results])
+    if not report.empty:
+        report = report.sort_values(['UF', 'MUNICIPIO'], kind='stable').reset_index(drop=True)
+    if output:
+        write_hotspots(hotspots, output)
+        report.to_csv(f"{os.path.splitext(output)[0]}_relatorio.csv", index=False)
+    return hotspots, report
+
+def _print_progress(done, total, result):
+    detalhe = result['Erro'] if result['Status'] == 'erro' else f"{result['Hotspots']} hotspots"
+    print(f"[{done}/{total}] {result['MUNICIPIO']}/{result['UF']}: {result['Status']} "
+          f"({result['Tempo (s)']} s, {detalhe})", flush=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Geração de hotspots em lote para vários municípios.")
+    parser.add_argument('source', help="CSV de crimes ou diretório da base particionada")
+    parser.add_argument('output', help="Arquivo de saída (.parquet, .gpkg ou .geojson)")
+    parser.add_argument('--config', help="Configuração do pipeline em JSON ou TOML")
+    parser.add_argument('--algoritmo', choices=PIPELINE_ALGORITHMS)
+    parser.add_argument('--bandwidth', type=float)
+    parser.add_argument('--limiar-densidade', type=float)
+    parser.add_argument('--distancia-cluster', type=float)
+    parser.add_argument('--metodo')
+    parser.add_argument('--snap', choices=('node', 'edge'))
+    parser.add_argument('--redes', help="Diretório do GraphStore")
+    parser.add_argument('--municipios', nargs='*', help="Restringe o lote a estes municípios")
+    parser.add_argument('--processos', type=int, default=None)
+    parser.add_argument('--memoria-mb', type=int, default=None, help="Limite de memória por processo")
+    parser.add_argument('--tarefas-por-processo', type=int, default=DEFAULT_MAX_TASKS_PER_CHILD)
+    args = parser.parse_args()
+    if args.config:
+        from pipeline import load_config
+        config = load_config(args.config)
+    else:
+        config = dict(DEFAULT_CONFIG)
+    # Opções da linha de comando têm prioridade sobre o arquivo
+    overrides = {'algorithm': args.algoritmo, 'bandwidth': args.bandwidth,
+                 'density_threshold': args.limiar_densidade, 'dist_threshold': args.distancia_cluster,
+                 'method': args.metodo, 'snap_mode': args.snap, 'store_dir': args.redes}
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    inicio = time.perf_counter()
+    hotspots, relatorio = run_batch(args.source, args.output, config, municipios=args.municipios,
+                                    workers=args.processos, max_tasks_per_child=args.tarefas_por_processo,
+                                    memory_limit_mb=args.memoria_mb, progress=_print_progress)
+    falhas = int((relatorio['Status'] == 'erro').sum()) if not relatorio.empty else 0
+    print(f"{len(relatorio)} municípios, {len(hotspots)} hotspots, {falhas} falhas "
+          f"em {time.perf_counter() - inicio:.1f} s. Saída: {args.output}")
+    sys.exit(1 if falhas and falhas == len(relatorio) else 0)
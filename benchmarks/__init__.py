@@ -0,0 +1,3 @@
+# benchmarks/__init__.py
+# Suíte de benchmarks offline dos caminhos críticos (densidade, agrupamento e mapas).
+# Uso: python -m benchmarks --help
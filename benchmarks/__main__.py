@@ -0,0 +1,42 @@
+# benchmarks/__main__.py
+import argparse
+import datetime
+import os
+import sys
+
+from benchmarks.suite import PROFILES, STEPS, compare_results, run_suite, write_results
+
+def _print_case(label, n, rows):
+    etapas = ", ".join(f"{r['etapa']} {r['tempo_s']:.3f} s" for r in rows)
+    print(f"{label} ({rows[0]['nos'] if rows else '?'} nós), {n} crimes: {etapas}", flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description="Benchmarks offline de densidade, agrupamento e mapas.")
+    parser.add_argument('--perfil', default='rapido', choices=list(PROFILES))
+    parser.add_argument('--crimes', type=int, nargs='*', help="Quantidades de crimes (substitui as do perfil)")
+    parser.add_argument('--etapas', nargs='*', choices=STEPS, default=list(STEPS))
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--memoria', action='store_true', help="Mede o pico de memória (tracemalloc)")
+    parser.add_argument('--cache', default='cache', help="Diretório com as respostas do Overpass")
+    parser.add_argument('--saida', help="Arquivo JSON de resultados")
+    parser.add_argument('--comparar', metavar='BASE.json',
+                        help="Compara a saída (ou --saida já existente com --sem-executar) com esta base")
+    parser.add_argument('--sem-executar', action='store_true', help="Só compara arquivos existentes")
+    args = parser.parse_args(argv)
+
+    output = args.saida or os.path.join(
+        'benchmarks', 'resultados', f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{args.perfil}.json")
+    if not args.sem_executar:
+        results = run_suite(args.perfil, cache_dir=args.cache, steps=args.etapas, crimes=args.crimes,
+                            repeat=args.repeticoes, memory=args.memoria, progress=_print_case)
+        write_results(results, output)
+        print(f"Resultados gravados em '{output}'.")
+    if args.comparar:
+        table = compare_results(args.comparar, output)
+        print(table.to_string(index=False))
+        return 1 if (table['razao_tempo'] > 1.2).any() else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
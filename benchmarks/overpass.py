@@ -0,0 +1,25 @@
+# benchmarks/overpass.py
+import glob
+import os
+
+from offline_network import _is_overpass, build_drive_graph
+
+def overpass_files(cache_dir='cache'):
+    """
+    Respostas do Overpass no cache do OSMnx (ignora as respostas do Nominatim), da
+    maior para a menor.
+    """
+    files = [path for path in glob.glob(os.path.join(cache_dir, '*.json')) if _is_overpass(path)]
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+def graph_from_overpass(path):
+    """
+    Rede viária (MultiDiGraph em EPSG:3857) de uma única resposta do Overpass, lida com o
+    leitor em streaming do offline_network: vias de carro, sentido único pelo tag oneway
+    e comprimento geodésico de cada trecho. Sem recorte nem simplificação da topologia.
+    """
+    import osmnx as ox
+    G = build_drive_graph([path])
+    if G.number_of_nodes() == 0:
+        return G
+    return ox.project_graph(G, to_crs='epsg:3857')
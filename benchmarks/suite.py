@@ -0,0 +1,204 @@
+# benchmarks/suite.py
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.overpass import graph_from_overpass, overpass_files
+from benchmarks.synthetic import grid_graph, radial_graph, synthetic_crimes, write_crime_csv
+
+# Redes sintéticas (grades n x n e radiais anéis x raios), quantidades de crimes e
+# número de redes reais (respostas do Overpass em cache/, das maiores para as menores)
+PROFILES = {
+    'rapido': {'grids': [30, 60], 'radials': [(20, 40)], 'crimes': [1_000, 10_000], 'real': 1},
+    'padrao': {'grids': [50, 100, 200], 'radials': [(30, 60), (60, 120)],
+               'crimes': [1_000, 10_000, 100_000], 'real': 3},
+    'completo': {'grids': [50, 100, 200, 300], 'radials': [(30, 60), (60, 120), (120, 240)],
+                 'crimes': [1_000, 10_000, 100_000, 1_000_000], 'real': None},
+}
+STEPS = ('load_crime_data', 'create_geodataframe', 'compute_node_densities', 'phar', 'i_phar', 'shar',
+         'expansive_network', 'build_cluster_table_subgraphs', 'edge_geometry_index', 'mapa')
+BANDWIDTH = 200
+DIST_THRESHOLD = 300
+# Nós selecionados: os 5% mais densos, para que a carga dos algoritmos cresça com a rede
+DENSITY_QUANTILE = 0.95
+# Parcela de novos crimes usada na atualização do i-PHAR
+I_PHAR_SHARE = 0.1
+# Etapas mais lentas que isto (s) não são repetidas
+SLOW_STEP = 5.0
+
+def measure(fn, repeat=3, memory=False):
+    """
+    Executa `fn` até `repeat` vezes e retorna (resultado, medidas): menor tempo, mediana,
+    número de execuções e, com `memory`, o pico de memória alocada em uma execução
+    extra com tracemalloc (que deixa o código mais lento, por isso fica fora dos tempos).
+    """
+    times = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+        if times[-1] > SLOW_STEP:
+            break
+    stats = {'tempo_s': round(min(times), 6), 'tempo_mediana_s': round(statistics.median(times), 6),
+             'repeticoes': len(times), 'pico_memoria_mb': None}
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            stats['pico_memoria_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 2)
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+def _build_map(graph, edge_index, polygons, subgraphs, lon, lat):
+    """
+    Monta o mapa como o app (polígonos, arestas dos clusters e pontos agregados) e
+    gera o HTML. Retorna o tamanho do HTML em bytes.
+    """
+    import folium
+    import geopandas as gpd
+    from map_utils import add_aggregated_points, add_cluster_edges
+    m = folium.Map(location=[float(np.mean(lat)), float(np.mean(lon))], zoom_start=12)
+    if polygons:
+        hulls = gpd.GeoSeries([h for _, h in polygons], crs=graph.crs or "EPSG:3857").to_crs(epsg=4326)
+        folium.GeoJson(hulls.__geo_interface__, name="PHAR").add_to(m)
+    for c_id, edges in subgraphs:
+        add_cluster_edges(m, edge_index, int(c_id), edges)
+    add_aggregated_points(m, lon, lat)
+    return len(m.get_root().render())
+
+def run_case(label, kind, G, n_crimes, workdir, steps=STEPS, repeat=3, memory=False, seed=0):
+    """
+    Executa as etapas do pipeline para uma rede e uma quantidade de crimes sintéticos.
+    Retorna uma linha de resultado por etapa.
+    """
+    from algorithms import phar, i_phar, shar, expansive_network
+    from cluster_table import build_cluster_table_subgraphs
+    from compiled_graph import compile_graph
+    from data_utils import create_geodataframe, load_crime_data
+    from map_utils import EdgeGeometryIndex
+    from network_utils import compute_node_densities
+
+    graph = compile_graph(G)
+    base = {'rede': label, 'tipo': kind, 'nos': int(graph.n_nodes), 'arestas': int(graph.n_edges),
+            'crimes': int(n_crimes)}
+    rows = []
+
+    def step(name, fn, output=None, needed=False):
+        # Etapas fora de `steps` só rodam (sem medição) quando as seguintes dependem delas
+        if name not in steps:
+            return fn() if needed else None
+        result, stats = measure(fn, repeat, memory)
+        rows.append({**base, 'etapa': name, **stats, 'saida': output(result) if output else None})
+        return result
+
+    csv_path = write_crime_csv(synthetic_crimes(graph, n_crimes, seed=seed), os.path.join(workdir, 'crimes.csv'))
+    df = step('load_crime_data', lambda: load_crime_data(csv_path), len, needed=True)
+    gdf = step('create_geodataframe', lambda: create_geodataframe(df), needed=True)
+    densities = step('compute_node_densities', lambda: compute_node_densities(gdf, graph, bandwidth=BANDWIDTH),
+                     needed=True)
+    values = np.fromiter(densities.values(), dtype=float)
+    positive = values[values > 0]
+    threshold = float(np.quantile(positive, DENSITY_QUANTILE)) if len(positive) else 1.0
+    base['limiar_densidade'] = round(threshold, 6)
+
+    polygons = step('phar', lambda: phar(densities, graph, threshold, DIST_THRESHOLD), len,
+                    needed='mapa' in steps)
+    if 'i_phar' in steps:
+        new_crimes = create_geodataframe(load_crime_data(write_crime_csv(
+            synthetic_crimes(graph, max(1, int(n_crimes * I_PHAR_SHARE)), seed=seed + 1),
+            os.path.join(workdir, 'novos.csv')))).geometry
+        step('i_phar', lambda: i_phar(dict(densities), graph, [], new_crimes, bandwidth=BANDWIDTH,
+                                      density_threshold=threshold, dist_threshold=DIST_THRESHOLD), len)
+    subgraphs = step('shar', lambda: shar(densities, graph, threshold, DIST_THRESHOLD), len,
+                     needed='mapa' in steps or 'build_cluster_table_subgraphs' in steps)
+    step('expansive_network', lambda: expansive_network(densities, graph, threshold), len)
+    step('build_cluster_table_subgraphs', lambda: build_cluster_table_subgraphs(subgraphs, graph), len)
+    edge_index = step('edge_geometry_index', lambda: EdgeGeometryIndex(graph), needed='mapa' in steps)
+    lon = df['LONGITUDE'].to_numpy(dtype=float)
+    lat = df['LATITUDE'].to_numpy(dtype=float)
+    step('mapa', lambda: _build_map(graph, edge_index, polygons, subgraphs, lon, lat), lambda size: size)
+    return rows
+
+def networks(profile, cache_dir='cache'):
+    """
+    Gera (rótulo, tipo, grafo) para as redes do perfil, das menores para as maiores.
+    """
+    config = PROFILES[profile]
+    for n in config['grids']:
+        yield f"grade_{n}x{n}", 'grade', grid_graph(n)
+    for rings, spokes in config['radials']:
+        yield f"radial_{rings}x{spokes}", 'radial', radial_graph(rings, spokes)
+    files = overpass_files(cache_dir) if os.path.isdir(cache_dir) else []
+    if config['real'] is not None:
+        files = files[:config['real']]
+    for path in files:
+        G = graph_from_overpass(path)
+        if G.number_of_nodes() >= 100:
+            yield f"osm_{os.path.splitext(os.path.basename(path))[0][:10]}", 'osm', G
+
+def environment():
+    """
+    Versões e máquina, gravadas junto dos resultados para comparações entre versões.
+    """
+    import networkx, scipy, shapely, sklearn
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'data': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit or None,
+            'python': platform.python_version(), 'plataforma': platform.platform(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'scipy': scipy.__version__,
+            'networkx': networkx.__version__, 'shapely': shapely.__version__, 'sklearn': sklearn.__version__}
+
+def run_suite(profile='rapido', cache_dir='cache', steps=STEPS, crimes=None, repeat=3, memory=False,
+              progress=None):
+    """
+    Roda todas as combinações de rede e quantidade de crimes do perfil.
+    Retorna {'ambiente': ..., 'perfil': ..., 'resultados': [linhas]}.
+    """
+    sizes = crimes or PROFILES[profile]['crimes']
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='poh-bench-') as workdir:
+        for label, kind, G in networks(profile, cache_dir):
+            for n in sizes:
+                case_rows = run_case(label, kind, G, n, workdir, steps=steps, repeat=repeat, memory=memory)
+                rows.extend(case_rows)
+                if progress:
+                    progress(label, n, case_rows)
+    return {'ambiente': environment(), 'perfil': profile, 'parametros': {
+                'bandwidth': BANDWIDTH, 'dist_threshold': DIST_THRESHOLD, 'quantil_densidade': DENSITY_QUANTILE,
+                'repeticoes': repeat, 'memoria': memory},
+            'resultados': rows}
+
+def write_results(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+    return path
+
+def compare_results(base_path, new_path):
+    """
+    Compara dois arquivos de resultados por (rede, crimes, etapa): razão entre os menores
+    tempos (novo / base; > 1 indica regressão) e entre os picos de memória.
+    """
+    def load(path):
+        with open(path, encoding='utf-8') as f:
+            return pd.DataFrame(json.load(f)['resultados'])
+    keys = ['rede', 'crimes', 'etapa']
+    merged = load(base_path).merge(load(new_path), on=keys, suffixes=('_base', '_novo'))
+    merged['razao_tempo'] = (merged['tempo_s_novo'] / merged['tempo_s_base']).round(3)
+    merged['razao_memoria'] = (merged['pico_memoria_mb_novo'] / merged['pico_memoria_mb_base']).round(3)
+    columns = keys + ['tempo_s_base', 'tempo_s_novo', 'razao_tempo', 'pico_memoria_mb_base',
+                      'pico_memoria_mb_novo', 'razao_memoria']
+    return merged[columns].sort_values('razao_tempo', ascending=False).reset_index(drop=True)
@@ -0,0 +1,94 @@
+# benchmarks/synthetic.py
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+# Origem das redes sintéticas em EPSG:3857 (região de Belo Horizonte)
+ORIGIN_X, ORIGIN_Y = -4_887_000.0, -2_265_000.0
+NATUREZAS = ['ROUBO', 'FURTO', 'LESAO CORPORAL', 'HOMICIDIO', 'DANO', 'AMEACA']
+
+def _add_street(G, rng, a, b, one_way_share):
+    d = np.hypot(G.nodes[a]['x'] - G.nodes[b]['x'], G.nodes[a]['y'] - G.nodes[b]['y']) * rng.uniform(1.0, 1.2)
+    G.add_edge(a, b, length=d)
+    if rng.random() >= one_way_share:
+        G.add_edge(b, a, length=d)
+
+def grid_graph(n, spacing=80.0, jitter=5.0, one_way_share=0.1, seed=0):
+    """
+    Malha n x n de quarteirões (MultiDiGraph em EPSG:3857), com pequenas perturbações
+    nas posições dos nós e uma parcela de vias de mão única.
+    """
+    rng = np.random.default_rng(seed)
+    G = nx.MultiDiGraph(crs='epsg:3857')
+    xy = rng.normal(0, jitter, (n * n, 2))
+    for i in range(n):
+        for j in range(n):
+            k = i * n + j
+            G.add_node(k, x=ORIGIN_X + i * spacing + xy[k, 0], y=ORIGIN_Y + j * spacing + xy[k, 1])
+    for i in range(n):
+        for j in range(n):
+            if i + 1 < n:
+                _add_street(G, rng, i * n + j, (i + 1) * n + j, one_way_share)
+            if j + 1 < n:
+                _add_street(G, rng, i * n + j, i * n + j + 1, one_way_share)
+    return G
+
+def radial_graph(rings, spokes, ring_spacing=120.0, one_way_share=0.1, seed=0):
+    """
+    Rede radial: um centro, `rings` anéis concêntricos e `spokes` avenidas radiais
+    (MultiDiGraph em EPSG:3857).
+    """
+    rng = np.random.default_rng(seed)
+    G = nx.MultiDiGraph(crs='epsg:3857')
+    G.add_node(0, x=ORIGIN_X, y=ORIGIN_Y)
+    angles = np.linspace(0, 2 * np.pi, spokes, endpoint=False)
+    for r in range(1, rings + 1):
+        for s, angle in enumerate(angles):
+            G.add_node(r * spokes + s, x=ORIGIN_X + r * ring_spacing * np.cos(angle),
+                       y=ORIGIN_Y + r * ring_spacing * np.sin(angle))
+    for s in range(spokes):
+        _add_street(G, rng, 0, spokes + s, one_way_share)
+        for r in range(1, rings + 1):
+            node = r * spokes + s
+            _add_street(G, rng, node, r * spokes + (s + 1) % spokes, one_way_share)
+            if r < rings:
+                _add_street(G, rng, node, node + spokes, one_way_share)
+    return G
+
+def synthetic_crimes(graph, n, n_hotspots=40, spread=150.0, noise_share=0.2, seed=0):
+    """
+    DataFrame de `n` crimes no formato do CSV de entrada (texto, separador decimal ',').
+    A maior parte se concentra em torno de `n_hotspots` nós sorteados (dispersão normal
+    de `spread` metros); `noise_share` é espalhada uniformemente na extensão da rede.
+    graph: CompiledGraph em EPSG:3857.
+    """
+    from pyproj import Transformer
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(0, graph.n_nodes, n_hotspots)
+    clustered = rng.random(n) >= noise_share
+    idx = rng.choice(centers, n)
+    x = np.where(clustered, graph.x[idx] + rng.normal(0, spread, n), rng.uniform(graph.x.min(), graph.x.max(), n))
+    y = np.where(clustered, graph.y[idx] + rng.normal(0, spread, n), rng.uniform(graph.y.min(), graph.y.max(), n))
+    lon, lat = Transformer.from_crs(3857, 4326, always_xy=True).transform(x, y)
+    dates = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 730, n), unit='D')
+    hours = rng.integers(0, 24, n)
+    minutes = rng.integers(0, 60, n)
+
+    def decimal(values):
+        return pd.Series(np.round(values, 7)).astype(str).str.replace('.', ',', regex=False)
+
+    return pd.DataFrame({
+        'DATA_FATO': dates.strftime('%Y-%m-%d'),
+        'HORARIO_FATO': pd.Series(hours).astype(str).str.zfill(2) + ':' + pd.Series(minutes).astype(str).str.zfill(2) + ':00',
+        'LATITUDE': decimal(lat),
+        'LONGITUDE': decimal(lon),
+        'DESCR_NATUREZA_PRINCIPAL': rng.choice(NATUREZAS, n),
+        'MUNICIPIO': 'SINTETICO',
+        'UF': 'MG',
+        'FAIXA_HORA_1': hours,
+        'FAIXA_HORA_6': hours // 6,
+    })
+
+def write_crime_csv(df, path):
+    df.to_csv(path, sep=';', index=False)
+    return path
@@ -1,8 +1,12 @@
 # cluster_table.py
+import numpy as np
 import pandas as pd
-import streamlit as st
 from pyproj import Transformer
 
+import instrumentation
+from compiled_graph import compile_graph
+from route_planning import RoutePlanner
+
 def generate_google_maps_link(cluster_points):
     """
     Gera um link do Google Maps para a rota passando pelos pontos do cluster.
@@ -25,35 +29,65 @@ def generate_google_maps_link(cluster_points):
         link += f"&waypoints={waypoints_str}"
     return link
 
-def build_cluster_table_polygons(poly_list):
+def _density_array(graph, densities):
+    """
+    Densidades por nó (dict id -> densidade) como array alinhado aos nós do grafo.
+    """
+    if densities is None:
+        return None
+    return np.fromiter((densities.get(n, 0.0) for n in graph.nodes()), dtype=float, count=graph.n_nodes)
+
+def build_cluster_table_polygons(poly_list, G=None, densities=None, planner=None):
     """
     poly_list: lista de tuplas (cluster_id, polygon) onde o polígono está em EPSG:4326.
     Gera uma tabela com o número do cluster, quantidade de vértices e link para o Google Maps.
+    Com o grafo G (ou um RoutePlanner), os vértices são levados aos nós mais próximos da
+    rede e a rota segue a ordem de route_planning; sem ele, a ordem dos vértices.
     """
-    rows = []
+    if planner is None and G is not None:
+        planner = RoutePlanner(G)
+    coords_list = []
     for cid, poly in poly_list:
         if poly.geom_type == 'Polygon':
-            coords = list(poly.exterior.coords)
+            coords_list.append(list(poly.exterior.coords))
         else:
-            coords = list(poly.convex_hull.exterior.coords)
+            coords_list.append(list(poly.convex_hull.exterior.coords))
+    if planner is not None and coords_list:
+        # Todos os vértices reprojetados e associados à rede de uma vez
+        graph = planner.graph
+        lonlat = np.array([c for coords in coords_list for c in coords], dtype=float)
+        transformer = Transformer.from_crs("EPSG:4326", graph.crs or "EPSG:3857", always_xy=True)
+        x, y = transformer.transform(lonlat[:, 0], lonlat[:, 1])
+        nearest = graph.snap_index.nearest_nodes(x, y)
+        bounds = np.cumsum([0] + [len(coords) for coords in coords_list])
+        clusters = [np.unique(nearest[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        routes = planner.routes_latlon(clusters, _density_array(graph, densities))
+    else:
         # Converter de (lon, lat) para (lat, lon)
-        cluster_points = [(lat, lon) for lon, lat in coords]
-        link = generate_google_maps_link(cluster_points[:25])
+        routes = [[(lat, lon) for lon, lat in coords][:25] for coords in coords_list]
+    rows = []
+    for (cid, _), coords, route in zip(poly_list, coords_list, routes):
         rows.append({
             "Cluster": cid,
             "Qtd. Pontos": len(coords),
-            "Rota Google Maps": link
+            "Rota Google Maps": generate_google_maps_link(route)
         })
+    instrumentation.count('linhas da tabela', len(rows))
     return pd.DataFrame(rows)
 
-def build_cluster_table_subgraphs(subgraphs, G):
+def build_cluster_table_subgraphs(subgraphs, G, densities=None, planner=None):
     """
-    subgraphs: lista de tuplas (cluster_id, nodes, edges) ou (cluster_id, edges)
-    G: grafo original, cujas coordenadas estão em EPSG:3857.
-    Converte os nós para EPSG:4326 para gerar o link.
+    subgraphs: lista de tuplas (cluster_id, nodes, edges[, lixels]) ou (cluster_id, edges)
+    G: grafo original (ou CompiledGraph), cujas coordenadas estão em EPSG:3857.
+    A rota de cada cluster passa por até 25 nós representativos, na ordem de visita
+    calculada sobre as distâncias de rede (route_planning.RoutePlanner, reaproveitável
+    entre chamadas por `planner`); `densities` prioriza os nós mais densos. Todos os
+    pontos são convertidos para 4326 em uma única transformação.
     """
-    rows = []
-    transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    graph = compile_graph(G)
+    planner = planner or RoutePlanner(graph)
+    index = graph.index
+    ids, clusters, sizes = [], [], []
     for item in subgraphs:
         if len(item) == 2:
             cid, edge_pairs = item
@@ -62,26 +96,24 @@ def build_cluster_table_subgraphs(subgraphs, G):
                 node_set.add(u)
                 node_set.add(v)
         else:
-            cid, node_set, edge_pairs = item
-        cluster_points = []
-        for n in node_set:
-            # G.nodes[n]['x'] e G.nodes[n]['y'] estão em EPSG:3857; converter para 4326:
-            x, y = G.nodes[n].get('x', None), G.nodes[n].get('y', None)
-            if x is None or y is None:
-                continue
-            lon, lat = transformer.transform(x, y)
-            cluster_points.append((lat, lon))
-        # Ordena os pontos para consistência
-        cluster_points = sorted(cluster_points, key=lambda pt: (pt[0], pt[1]))
-        link = generate_google_maps_link(cluster_points)
+            cid, node_set, edge_pairs = item[:3]
+        ids.append(cid)
+        sizes.append(len(node_set))
+        clusters.append(np.array(sorted(i for i in (index.get(n) for n in node_set) if i is not None), dtype=np.int64))
+    routes = planner.routes_latlon(clusters, _density_array(graph, densities))
+    rows = []
+    for cid, size, route in zip(ids, sizes, routes):
         rows.append({
             "Cluster": cid,
-            "Qtd. Pontos": len(node_set),
-            "Rota Google Maps": link
+            "Qtd. Pontos": size,
+            "Rota Google Maps": generate_google_maps_link(route)
         })
+    instrumentation.count('linhas da tabela', len(rows))
     return pd.DataFrame(rows)
 
 def show_cluster_table_as_links(df_cluster_table):
+    # Importado aqui: o restante do módulo é usado pelo pipeline sem interface
+    import streamlit as st
     table_html = "<table style='width:100%; border-collapse: collapse;'><thead><tr style='background-color: #f2f2f2;'><th style='border: 1px solid #ddd; padding: 8px;'>Cluster</th><th style='border: 1px solid #ddd; padding: 8px;'>Qtd. Pontos</th><th style='border: 1px solid #ddd; padding: 8px;'>Rota Google Maps</th></tr></thead><tbody>"
     for _, row in df_cluster_table.iterrows():
         link_html = f'<a href="{row["Rota Google Maps"]}" target="_blank">Abrir Rota</a>' if row["Rota Google Maps"] else "-"
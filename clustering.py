@@ -0,0 +1,144 @@
+# clustering.py
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import instrumentation
+
+# Métodos de agrupamento por limiar de distância usados pelo PHAR e pelo SHAR
+CLUSTERING_METHODS = {
+    'average': "Average linkage (exato)",
+    'average_sparse': "Average linkage em vizinhança esparsa",
+    'single': "Single linkage (KD-tree)",
+    'dbscan': "DBSCAN",
+}
+DBSCAN_MIN_SAMPLES = 3
+# average_sparse: componentes até este tamanho usam o average linkage exato
+SPARSE_EXACT_MAX_POINTS = 2000
+SPARSE_RADIUS_FACTOR = 2
+
+def _neighbor_components(coords, dist_threshold):
+    """
+    Componentes conexas do grafo que liga pontos a menos de `dist_threshold`
+    (pares obtidos de uma KD-tree, sem matriz de distâncias completa).
+    """
+    n = len(coords)
+    pairs = cKDTree(coords).query_pairs(dist_threshold, output_type='ndarray')
+    if len(pairs):
+        d = np.hypot(*(coords[pairs[:, 0]] - coords[pairs[:, 1]]).T)
+        pairs = pairs[d < dist_threshold]
+    adjacency = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(adjacency, directed=False)
+    return labels
+
+def _relabel(labels):
+    """
+    Renumera os clusters pela ordem do primeiro ponto de cada um (ruído, -1, é mantido).
+    """
+    valid = labels >= 0
+    _, first, inverse = np.unique(labels[valid], return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    out = np.full(len(labels), -1, dtype=np.int64)
+    out[valid] = rank[inverse]
+    return out
+
+def _average_components(coords, dist_threshold, fit_component):
+    """
+    Aplica `fit_component` (average linkage) em cada componente de vizinhança com 3 ou
+    mais pontos. Grupos cujos pontos distam todos >= dist_threshold nunca se fundem,
+    então o resultado é o mesmo de agrupar todos os pontos de uma vez.
+    """
+    components = _neighbor_components(coords, dist_threshold)
+    labels = components.copy()
+    next_label = components.max() + 1 if len(components) else 0
+    sizes = np.bincount(components)
+    for comp in np.flatnonzero(sizes >= 3):
+        members = np.flatnonzero(components == comp)
+        sub = fit_component(coords[members])
+        labels[members] = np.where(sub == 0, comp, next_label + sub - 1)
+        next_label += sub.max()
+    return labels
+
+def _average(coords, dist_threshold):
+    """
+    Average linkage exato, por componente: o custo quadrático fica restrito ao tamanho
+    da maior componente.
+    """
+    from sklearn.cluster import AgglomerativeClustering
+    model = AgglomerativeClustering(n_clusters=None, distance_threshold=dist_threshold, linkage='average')
+    return _average_components(coords, dist_threshold, model.fit_predict)
+
+def _average_sparse(coords, dist_threshold):
+    """
+    Average linkage aproximado, por componente. Componentes pequenas usam o método
+    exato; nas grandes, só pares a até SPARSE_RADIUS_FACTOR * dist_threshold entram no
+    cálculo das médias (grafo de vizinhança esparso), com memória proporcional ao
+    número de vizinhos em vez de n².
+    """
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.neighbors import radius_neighbors_graph
+
+    def fit_component(points):
+        if len(points) <= SPARSE_EXACT_MAX_POINTS:
+            model = AgglomerativeClustering(n_clusters=None, distance_threshold=dist_threshold, linkage='average')
+        else:
+            # A componente já é conexa no raio dist_threshold: o grafo mais largo também é
+            connectivity = radius_neighbors_graph(points, SPARSE_RADIUS_FACTOR * dist_threshold,
+                                                  mode='connectivity', include_self=False)
+            model = AgglomerativeClustering(n_clusters=None, distance_threshold=dist_threshold,
+                                            linkage='average', connectivity=connectivity)
+        return model.fit_predict(points)
+
+    return _average_components(coords, dist_threshold, fit_component)
+
+def _dbscan(coords, dist_threshold):
+    """
+    DBSCAN com raio `dist_threshold`; pontos isolados (ruído) recebem o rótulo -1.
+    """
+    from sklearn.cluster import DBSCAN
+    return DBSCAN(eps=dist_threshold, min_samples=DBSCAN_MIN_SAMPLES).fit_predict(coords)
+
+_BACKENDS = {
+    'average': _average,
+    'average_sparse': _average_sparse,
+    'single': _neighbor_components,
+    'dbscan': _dbscan,
+}
+
+def cluster_coords(coords, dist_threshold, method='average', stats=None, trace_memory=False):
+    """
+    Agrupa as coordenadas (n x 2, metros) pelo limiar de distância com o método escolhido.
+    Retorna um rótulo por ponto (-1 para ruído no DBSCAN).
+    Se `stats` (dict) for informado, recebe o tempo da execução e, com `trace_memory`,
+    o pico de memória alocada (tracemalloc, que deixa o agrupamento mais lento).
+    """
+    if method not in _BACKENDS:
+        raise ValueError(f"Método de agrupamento desconhecido: {method}")
+    coords = np.asarray(coords, dtype=float)
+    if len(coords) < 2:
+        return np.zeros(len(coords), dtype=np.int64)
+    tracing = stats is not None and trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with instrumentation.stage('agrupamento'):
+            labels = _relabel(np.asarray(_BACKENDS[method](coords, dist_threshold)))
+            instrumentation.count('pontos', len(coords))
+            instrumentation.count('clusters', int(labels.max()) + 1 if len(labels) else 0)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracing else None
+        if tracing:
+            tracemalloc.stop()
+    if stats is not None:
+        stats.update({'Método': CLUSTERING_METHODS[method], 'Pontos': len(coords),
+                      'Clusters': int(labels.max()) + 1 if len(labels) else 0,
+                      'Tempo (s)': round(elapsed, 3),
+                      'Pico de memória (MB)': round(peak / 1024 ** 2, 1) if peak is not None else None})
+    return labels
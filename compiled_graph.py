@@ -0,0 +1,215 @@
+# compiled_graph.py
+import hashlib
+
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+class CompiledGraph:
+    """
+    Representação compacta (CSR) da rede viária, construída uma única vez a partir do
+    MultiDiGraph do OSMnx. Guarda os ids dos nós, as coordenadas x/y (no CRS do grafo,
+    normalmente EPSG:3857), os arrays indptr/indices/lengths das arestas de saída e o
+    mapeamento id <-> índice. Entre arestas paralelas mantém a de menor comprimento.
+    edge_geometry (opcional) guarda a geometria de cada aresta, alinhada a `indices`;
+    pode ser uma função sem argumentos, avaliada apenas no primeiro acesso.
+    Os arrays podem ser memory-maps (ver graph_store.GraphStore).
+    """
+
+    def __init__(self, node_ids, x, y, indptr, indices, lengths, crs=None, edge_geometry=None, fingerprint=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.crs = crs
+        self._edge_geometry = edge_geometry
+        self._fingerprint = fingerprint
+        self._index = None
+        self._edge_sources = None
+        self._matrix = None
+        self._snap_index = None
+
+    @classmethod
+    def from_graph(cls, G):
+        """
+        Compila um MultiDiGraph (nós com atributos 'x'/'y', arestas com 'length').
+        """
+        node_ids = np.array(list(G.nodes()), dtype=np.int64)
+        index = {n: i for i, n in enumerate(node_ids.tolist())}
+        x = np.array([G.nodes[n]['x'] for n in node_ids.tolist()], dtype=float)
+        y = np.array([G.nodes[n]['y'] for n in node_ids.tolist()], dtype=float)
+        n_edges = G.number_of_edges()
+        u = np.empty(n_edges, dtype=np.int64)
+        v = np.empty(n_edges, dtype=np.int64)
+        lengths = np.empty(n_edges, dtype=float)
+        geometry = np.empty(n_edges, dtype=object)
+        for k, (a, b, data) in enumerate(G.edges(data=True)):
+            u[k], v[k] = index[a], index[b]
+            lengths[k] = data.get('length', 1)
+            geometry[k] = data.get('geometry')
+        order = np.lexsort((lengths, v, u))
+        u, v, lengths, geometry = u[order], v[order], lengths[order], geometry[order]
+        first = np.ones(n_edges, dtype=bool)
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, lengths, geometry = u[first], v[first], lengths[first], geometry[first]
+        # Arestas sem geometria (retas) viram um segmento entre os dois nós
+        missing = np.flatnonzero(shapely.is_missing(geometry))
+        if len(missing):
+            segments = np.stack([np.column_stack([x[u[missing]], y[u[missing]]]),
+                                 np.column_stack([x[v[missing]], y[v[missing]]])], axis=1)
+            geometry[missing] = shapely.linestrings(segments)
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(u, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids, x, y, indptr, v, lengths, crs=G.graph.get('crs'), edge_geometry=geometry)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def index(self):
+        """
+        Mapeamento id do nó -> índice, construído no primeiro acesso.
+        """
+        if self._index is None:
+            self._index = {n: i for i, n in enumerate(self.node_ids.tolist())}
+        return self._index
+
+    @property
+    def edge_sources(self):
+        """
+        Índice do nó de origem de cada aresta (alinhado a `indices`).
+        """
+        if self._edge_sources is None:
+            self._edge_sources = np.repeat(np.arange(self.n_nodes), np.diff(self.indptr))
+        return self._edge_sources
+
+    @property
+    def edge_geometry(self):
+        if callable(self._edge_geometry):
+            self._edge_geometry = self._edge_geometry()
+        return self._edge_geometry
+
+    def fingerprint(self):
+        """
+        Hash (sha1) do conteúdo da rede: identifica o grafo em caches e no armazenamento em disco.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for array in (self.node_ids, self.x, self.y, self.indptr, self.indices, self.lengths):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def edges_gdf(self):
+        """
+        GeoDataFrame das arestas (colunas u, v, length e geometry) no CRS do grafo.
+        """
+        import geopandas as gpd
+        return gpd.GeoDataFrame({
+            'u': self.node_ids[self.edge_sources],
+            'v': self.node_ids[self.indices],
+            'length': self.lengths,
+        }, geometry=self.snap_index.edge_geometry, crs=self.crs)
+
+    @property
+    def snap_index(self):
+        """
+        Índice espacial de snapping (nós e arestas), construído uma única vez por grafo.
+        """
+        if self._snap_index is None:
+            from snapping import SnapIndex
+            self._snap_index = SnapIndex(self)
+        return self._snap_index
+
+    @property
+    def matrix(self):
+        """
+        Matriz esparsa (CSR) de comprimentos, no formato do scipy.sparse.csgraph.
+        """
+        if self._matrix is None:
+            self._matrix = csr_matrix((self.lengths, self.indices, self.indptr),
+                                      shape=(self.n_nodes, self.n_nodes))
+        return self._matrix
+
+    def nodes(self):
+        return self.node_ids.tolist()
+
+    def indices_of(self, nodes):
+        """
+        Converte ids de nós em índices (posições nos arrays).
+        """
+        index = self.index
+        return np.fromiter((index[n] for n in nodes), dtype=np.int64)
+
+    def neighbors(self, node):
+        """
+        Ids dos vizinhos de saída do nó.
+        """
+        i = self.index[node]
+        return self.node_ids[self.indices[self.indptr[i]:self.indptr[i + 1]]].tolist()
+
+    def edge_length(self, u, v):
+        """
+        Comprimento da aresta u -> v (a menor entre as paralelas), ou None se não existir.
+        """
+        k = self.find_edges([self.index[u]], [self.index[v]])[0]
+        return float(self.lengths[k]) if k >= 0 else None
+
+    def coords(self, nodes):
+        """
+        Array (n, 2) com as coordenadas x/y dos nós informados.
+        """
+        idx = self.indices_of(nodes)
+        return np.column_stack([self.x[idx], self.y[idx]])
+
+    def find_edges(self, u, v):
+        """
+        Posições das arestas u -> v (índices de nós) nos arrays de arestas; -1 quando
+        a aresta não existe. Vetorizado: as arestas estão ordenadas por (origem, destino).
+        """
+        u = np.asarray(u, dtype=np.int64)
+        v = np.asarray(v, dtype=np.int64)
+        keys = self.edge_sources * self.n_nodes + self.indices
+        wanted = u * self.n_nodes + v
+        if len(keys) == 0:
+            return np.full(len(wanted), -1)
+        pos = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        return np.where(keys[pos] == wanted, pos, -1)
+
+    def nearest_nodes(self, X, Y):
+        """
+        Ids dos nós mais próximos (distância euclidiana) de cada ponto (X, Y).
+        """
+        return self.node_ids[self.snap_index.nearest_nodes(X, Y)]
+
+    def shortest_path(self, source, target):
+        """
+        Caminho mínimo (lista de ids) de source até target, ou None se não houver.
+        """
+        s, t = self.index[source], self.index[target]
+        dist, pred = dijkstra(self.matrix, directed=True, indices=s, return_predecessors=True)
+        if not np.isfinite(dist[t]):
+            return None
+        path = [t]
+        while path[-1] != s:
+            path.append(pred[path[-1]])
+        return self.node_ids[path[::-1]].tolist()
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.node_ids, self.x, self.y, self.indptr, self.indices, self.lengths))
+
+def compile_graph(G):
+    """
+    Retorna o CompiledGraph correspondente a G (ou o próprio G, se já compilado).
+    """
+    if isinstance(G, CompiledGraph):
+        return G
+    return CompiledGraph.from_graph(G)
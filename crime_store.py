@@ -0,0 +1,155 @@
+# crime_store.py
+"""
+Base colunar (Parquet) de ocorrências, particionada por UF/MUNICIPIO/ANO_MES.
+
+Importação (uma única vez por arquivo):
+    python crime_store.py ocorrencias.csv base_crimes/
+"""
+import hashlib
+import os
+import shutil
+import sys
+import uuid
+from urllib.parse import quote
+
+import pandas as pd
+
+from data_utils import read_crime_csv, clean_crime_data, categorize_columns
+
+DEFAULT_DATASET_DIR = os.environ.get("POH_CRIME_DATASET", "base_crimes")
+PARTITION_COLUMNS = ['UF', 'MUNICIPIO', 'ANO_MES']
+IMPORT_CHUNKSIZE = 500_000
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        raise ImportError("A base particionada requer o pacote 'pyarrow' (pip install pyarrow).") from e
+    return pa, ds
+
+def _schema(pa):
+    return pa.schema([
+        ('DATA_FATO', pa.timestamp('us')),
+        ('HORARIO_FATO', pa.string()),
+        ('LATITUDE', pa.float32()),
+        ('LONGITUDE', pa.float32()),
+        ('DESCR_NATUREZA_PRINCIPAL', pa.string()),
+        ('FAIXA_HORA_1', pa.string()),
+        ('FAIXA_HORA_6', pa.string()),
+        ('DATETIME_FATO', pa.timestamp('us')),
+        ('UF', pa.string()),
+        ('MUNICIPIO', pa.string()),
+        ('ANO_MES', pa.int32()),
+    ])
+
+def import_crime_csv(csv_path, dataset_dir=DEFAULT_DATASET_DIR, chunksize=IMPORT_CHUNKSIZE, progress=None):
+    """
+    Converte o CSV bruto em uma base Parquet particionada por UF, MUNICIPIO e ANO_MES
+    (AAAAMM de DATETIME_FATO). O CSV é lido e limpo em blocos, sem carregá-lo inteiro na
+    memória; duplicatas são removidas dentro de cada bloco. Partições já existentes para
+    as mesmas chaves são substituídas. Retorna o relatório de limpeza acumulado.
+    """
+    pa, ds = _arrow()
+    schema = _schema(pa)
+    relatorio_total = {}
+    written = set()
+    for i, chunk in enumerate(read_crime_csv(csv_path, chunksize=chunksize)):
+        df, relatorio = clean_crime_data(chunk, categorize=False)
+        for linha in relatorio:
+            total = relatorio_total.setdefault(linha['Etapa'], {'Etapa': linha['Etapa'], 'Removidas': 0, 'Restantes': 0})
+            total['Removidas'] += linha['Removidas']
+            total['Restantes'] += linha['Restantes']
+        datas = df['DATETIME_FATO'] if 'DATETIME_FATO' in df.columns else pd.Series(pd.NaT, index=df.index)
+        df['ANO_MES'] = (datas.dt.year * 100 + datas.dt.month).fillna(0).astype('int32')
+        for col in schema.names:
+            if col not in df.columns:
+                df[col] = None
+        table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+        # Partições gravadas por importações anteriores são substituídas
+        for key in set(zip(df['UF'], df['MUNICIPIO'], df['ANO_MES'])) - written:
+            _remove_partition(dataset_dir, *key)
+            written.add(key)
+        ds.write_dataset(table, dataset_dir, format='parquet', partitioning=PARTITION_COLUMNS,
+                         partitioning_flavor='hive', existing_data_behavior='overwrite_or_ignore',
+                         basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet")
+        if progress:
+            progress(i, len(df))
+    return list(relatorio_total.values())
+
+def _remove_partition(dataset_dir, uf, municipio, ano_mes):
+    # Mesma codificação (URI) que o pyarrow usa nos nomes dos diretórios hive
+    path = os.path.join(dataset_dir, f"UF={quote(str(uf), safe='')}",
+                        f"MUNICIPIO={quote(str(municipio), safe='')}", f"ANO_MES={ano_mes}")
+    shutil.rmtree(path, ignore_errors=True)
+
+def _open(dataset_dir):
+    pa, ds = _arrow()
+    return ds.dataset(dataset_dir, format='parquet', partitioning='hive', schema=_schema(pa))
+
+def dataset_version(dataset_dir):
+    """
+    Assinatura (caminho, tamanho, data de modificação) dos arquivos da base, usada como
+    chave de cache: muda sempre que uma importação altera a base.
+    """
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(dataset_dir)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()
+
+def list_partitions(dataset_dir=DEFAULT_DATASET_DIR):
+    """
+    Partições disponíveis (UF, MUNICIPIO, ANO_MES), lidas só dos caminhos dos arquivos.
+    """
+    _, ds = _arrow()
+    rows = [ds.get_partition_keys(fragment.partition_expression)
+            for fragment in _open(dataset_dir).get_fragments()]
+    return pd.DataFrame(rows, columns=PARTITION_COLUMNS).drop_duplicates().sort_values(PARTITION_COLUMNS)
+
+def read_crime_dataset(dataset_dir=DEFAULT_DATASET_DIR, uf=None, municipio=None, start=None, end=None,
+                       naturezas=None, faixa_hora_1=None, faixa_hora_6=None):
+    """
+    Lê a base particionada aplicando os filtros na leitura: UF, MUNICIPIO e o intervalo
+    de datas eliminam partições inteiras (só os arquivos selecionados são abertos);
+    natureza e faixas horárias são filtradas pelo leitor Parquet.
+    start/end: datas (inclusivas). Retorna o DataFrame no mesmo formato de load_crime_data.
+    """
+    _, ds = _arrow()
+    filtro = None
+
+    def juntar(expr):
+        return expr if filtro is None else filtro & expr
+
+    if uf:
+        filtro = juntar(ds.field('UF') == uf)
+    if municipio:
+        filtro = juntar(ds.field('MUNICIPIO') == municipio)
+    if start is not None:
+        start = pd.Timestamp(start)
+        filtro = juntar(ds.field('ANO_MES') >= start.year * 100 + start.month)
+        filtro = juntar(ds.field('DATETIME_FATO') >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        filtro = juntar(ds.field('ANO_MES') <= end.year * 100 + end.month)
+        filtro = juntar(ds.field('DATETIME_FATO') < end + pd.Timedelta(days=1))
+    if naturezas:
+        filtro = juntar(ds.field('DESCR_NATUREZA_PRINCIPAL').isin(list(naturezas)))
+    if faixa_hora_1:
+        filtro = juntar(ds.field('FAIXA_HORA_1').isin([str(v) for v in faixa_hora_1]))
+    if faixa_hora_6:
+        filtro = juntar(ds.field('FAIXA_HORA_6').isin([str(v) for v in faixa_hora_6]))
+    table = _open(dataset_dir).to_table(filter=filtro)
+    df = table.to_pandas().drop(columns=['ANO_MES'])
+    return categorize_columns(df)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Uso: python crime_store.py <arquivo.csv> [diretório da base]")
+        sys.exit(1)
+    destino = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DATASET_DIR
+    relatorio = import_crime_csv(sys.argv[1], destino, progress=lambda i, n: print(f"Bloco {i + 1}: {n} linhas"))
+    print(pd.DataFrame(relatorio).to_string(index=False))
+    print(f"Base gravada em '{destino}'.")
@@ -2,44 +2,134 @@
 import pandas as pd
 import geopandas as gpd
 
-def load_crime_data(uploaded_file):
+COLUNAS_INTERESSE = [
+    'DATA_FATO', 'HORARIO_FATO', 'LATITUDE', 'LONGITUDE',
+    'DESCR_NATUREZA_PRINCIPAL', 'MUNICIPIO', 'UF',
+    'FAIXA_HORA_1', 'FAIXA_HORA_6'
+]
+# Colunas de baixa cardinalidade, armazenadas como categorias
+COLUNAS_CATEGORICAS = ['DESCR_NATUREZA_PRINCIPAL', 'MUNICIPIO', 'UF', 'FAIXA_HORA_1', 'FAIXA_HORA_6']
+
+def _csv_engine():
     """
-    Lê o CSV com separador ';' e realiza a limpeza dos dados,
-    selecionando as colunas relevantes e convertendo as coordenadas.
+    Usa o parser multithread do pyarrow quando disponível; senão, o parser C do pandas.
+    """
+    try:
+        import pyarrow  # noqa: F401
+        return 'pyarrow'
+    except ImportError:
+        return 'c'
+
+def _read_columns(uploaded_file, sep):
+    """
+    Lê apenas o cabeçalho do CSV e retorna os nomes originais das colunas de interesse
+    (os nomes no arquivo podem ter espaços extras).
+    """
+    header = pd.read_csv(uploaded_file, sep=sep, nrows=0).columns
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+    return [c for c in header if c.strip() in COLUNAS_INTERESSE]
+
+def _combine_date_time(data, horario):
+    """
+    Combina DATA_FATO (datetime) e HORARIO_FATO (texto) em um único datetime, de forma
+    vetorizada. Horários fora do formato HH:MM[:SS] caem na conversão linha a linha.
+    """
+    horario = horario.astype(str).str.strip()
+    horario = horario.where(horario.str.count(':') != 1, horario + ':00')
+    # to_timedelta aceita '25:99:00' (avança para o dia seguinte): relógio fora da faixa
+    # vai para a conversão linha a linha, que o rejeita como NaT
+    partes = horario.str.extract(r'^(\d+):(\d+):(\d+(?:\.\d*)?)$').astype(float)
+    valido = (partes[0] < 24) & (partes[1] < 60) & (partes[2] < 60)
+    combinado = data.dt.normalize() + pd.to_timedelta(horario.where(valido), errors='coerce')
+    falhas = combinado.isna() & data.notna()
+    if falhas.any():
+        combinado[falhas] = pd.to_datetime(
+            data[falhas].dt.strftime('%Y-%m-%d') + ' ' + horario[falhas],
+            errors='coerce', format='mixed'
+        )
+    return combinado
+
+def read_crime_csv(uploaded_file, chunksize=None):
+    """
+    Lê do CSV (separador ';') apenas as colunas de interesse, como texto.
+    Com `chunksize`, retorna um iterador de blocos (parser C do pandas).
+    """
+    colunas = _read_columns(uploaded_file, sep=";")
+    engine = 'c' if chunksize else _csv_engine()
+    return pd.read_csv(uploaded_file, sep=";", on_bad_lines='skip', engine=engine,
+                       usecols=colunas, dtype={c: 'string' for c in colunas}, chunksize=chunksize)
+
+def categorize_columns(df):
+    """
+    Converte (in place) as colunas de baixa cardinalidade em categorias; faixas horárias
+    numéricas mantêm a ordenação numérica.
+    """
+    for col in COLUNAS_CATEGORICAS:
+        if col in df.columns:
+            valores = df[col]
+            numericos = pd.to_numeric(valores, errors='coerce')
+            if col.startswith('FAIXA_HORA') and numericos.notna().sum() == valores.notna().sum():
+                valores = numericos.astype('Int64')
+            df[col] = valores.astype('category')
+    return df
+
+def clean_crime_data(df, coord_dtype='float32', categorize=True):
+    """
+    Limpeza dos dados lidos por read_crime_csv: converte as coordenadas, descarta
+    coordenadas inválidas e duplicatas e cria DATETIME_FATO. Colunas de baixa
+    cardinalidade viram categorias (faixas horárias numéricas mantêm a ordenação numérica).
+    Retorna o DataFrame e o relatório de linhas removidas por etapa.
     """
-    df = pd.read_csv(uploaded_file, sep=";", on_bad_lines='skip')
     df.columns = df.columns.str.strip()
-    colunas_interesse = [
-        'DATA_FATO', 'HORARIO_FATO', 'LATITUDE', 'LONGITUDE',
-        'DESCR_NATUREZA_PRINCIPAL', 'MUNICIPIO', 'UF',
-        'FAIXA_HORA_1', 'FAIXA_HORA_6'
-    ]
-    colunas_existentes = [c for c in colunas_interesse if c in df.columns]
-    df = df[colunas_existentes].copy()
-    
+    relatorio = [{'Etapa': 'Linhas lidas', 'Removidas': 0, 'Restantes': len(df)}]
+
+    def registrar(etapa, antes):
+        relatorio.append({'Etapa': etapa, 'Removidas': antes - len(df), 'Restantes': len(df)})
+
     # Converter LATITUDE e LONGITUDE (substituindo vírgula por ponto)
-    df['LATITUDE'] = df['LATITUDE'].astype(str).str.replace(",", ".").astype(float)
-    df['LONGITUDE'] = df['LONGITUDE'].astype(str).str.replace(",", ".").astype(float)
-    
+    for col in ['LATITUDE', 'LONGITUDE']:
+        df[col] = pd.to_numeric(df[col].str.replace(",", ".", regex=False), errors='coerce')
+
     # Filtrar coordenadas válidas
-    valid_coords = (df['LATITUDE'].between(-90, 90)) & (df['LONGITUDE'].between(-180, 180))
-    df = df[valid_coords]
-    df.dropna(subset=['LATITUDE', 'LONGITUDE'], inplace=True)
+    antes = len(df)
+    df = df.dropna(subset=['LATITUDE', 'LONGITUDE'])
+    registrar('Coordenadas ausentes ou inválidas', antes)
+    antes = len(df)
+    df = df[(df['LATITUDE'].between(-90, 90)) & (df['LONGITUDE'].between(-180, 180))]
+    registrar('Coordenadas fora dos limites', antes)
+    antes = len(df)
     df = df[(df['LATITUDE'] != 0) & (df['LONGITUDE'] != 0)]
-    
+    registrar('Coordenadas zeradas', antes)
+    df = df.astype({'LATITUDE': coord_dtype, 'LONGITUDE': coord_dtype})
+
     # Criar coluna DATETIME_FATO a partir de DATA_FATO e HORARIO_FATO
     if 'DATA_FATO' in df.columns and 'HORARIO_FATO' in df.columns:
         df['DATA_FATO'] = pd.to_datetime(df['DATA_FATO'], errors='coerce')
         df['HORARIO_FATO'] = df['HORARIO_FATO'].fillna('00:00:00')
-        df['DATETIME_FATO'] = df.apply(
-            lambda row: pd.to_datetime(
-                f"{row['DATA_FATO'].strftime('%Y-%m-%d')} {row['HORARIO_FATO']}",
-                errors='coerce'
-            ) if pd.notnull(row['DATA_FATO']) else pd.NaT,
-            axis=1
-        )
-    
-    df.drop_duplicates(inplace=True)
+        df['DATETIME_FATO'] = _combine_date_time(df['DATA_FATO'], df['HORARIO_FATO'])
+
+    for col in COLUNAS_CATEGORICAS:
+        if col in df.columns:
+            df[col] = df[col].str.strip()
+    if categorize:
+        categorize_columns(df)
+
+    antes = len(df)
+    df = df.drop_duplicates()
+    registrar('Linhas duplicadas', antes)
+    return df.reset_index(drop=True), relatorio
+
+def load_crime_data(uploaded_file, coord_dtype='float32'):
+    """
+    Lê o CSV com separador ';' e realiza a limpeza dos dados,
+    selecionando as colunas relevantes e convertendo as coordenadas.
+    Apenas as colunas de interesse são lidas do disco; colunas de baixa cardinalidade
+    viram categorias e as coordenadas usam float32 (resolução < 1 m em graus).
+    As linhas removidas em cada etapa ficam em df.attrs['relatorio_limpeza'].
+    """
+    df, relatorio = clean_crime_data(read_crime_csv(uploaded_file), coord_dtype=coord_dtype)
+    df.attrs['relatorio_limpeza'] = relatorio
     return df
 
 def create_geodataframe(df):
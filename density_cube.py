@@ -0,0 +1,104 @@
+# density_cube.py
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from compiled_graph import compile_graph
+from filter_index import MISSING_DAY
+from network_utils import _distance_triplets
+
+class DensityCube:
+    """
+    Densidades do KDE restrito à rede (modo 'node') separadas por célula: cada combinação
+    observada das colunas de filtro (natureza, FAIXA_HORA_1, FAIXA_HORA_6, ...) e do dia
+    do fato. Uma única busca limitada à bandwidth, a partir de todos os nós com crimes,
+    dá a matriz esparsa K (nós x fontes, com exp(-d / bandwidth)); W (fontes x células)
+    conta os crimes de cada nó de origem em cada célula. O cubo nós x células é K @ W,
+    mantido fatorado (W tem no máximo uma entrada por crime): uma combinação de filtros
+    vira uma máscara de células e a densidade sai de K @ (W @ máscara), sem nova busca
+    no grafo. O resultado é o mesmo do KDE sobre as linhas filtradas pelo FilterIndex.
+    """
+
+    def __init__(self, G, snapped, index, rows=None, bandwidth=200):
+        if snapped.mode != 'node':
+            raise ValueError("O cubo de densidades só é calculado no modo de snapping 'node'.")
+        self.graph = compile_graph(G)
+        self.bandwidth = bandwidth
+        self.columns = index.columns
+        rows = np.arange(index.n_rows) if rows is None else np.asarray(rows)
+        if len(rows) != len(snapped):
+            raise ValueError("`rows` e `snapped` devem ter o mesmo número de crimes.")
+
+        # Célula de cada crime: chave combinada dos códigos de todas as dimensões
+        key = np.zeros(len(rows), dtype=np.int64)
+        dims = []
+        for col in self.columns:
+            size = index.n_codes(col)
+            key = key * size + index.row_codes(col, rows)
+            dims.append(size)
+        days = index.row_days(rows) if index.time_column else np.full(len(rows), MISSING_DAY)
+        valid = days != MISSING_DAY
+        self.first_day = int(days[valid].min()) if valid.any() else 0
+        n_days = int(days[valid].max()) - self.first_day + 2 if valid.any() else 1
+        # Dias ausentes ficam no último código do tempo
+        key = key * n_days + np.where(valid, days - self.first_day, n_days - 1)
+        dims.append(n_days)
+        cells, cell_of_crime = np.unique(key, return_inverse=True)
+        codes = np.unravel_index(cells, dims)
+        self.cell_codes = dict(zip(self.columns, codes[:-1]))
+        self.cell_days = np.where(codes[-1] == n_days - 1, MISSING_DAY, codes[-1] + self.first_day)
+        self.n_cells = len(cells)
+        self._index = index
+
+        sources, source_of_crime = np.unique(snapped.node, return_inverse=True)
+        self.W = csr_matrix((np.ones(len(rows)), (source_of_crime.ravel(), cell_of_crime.ravel())),
+                            shape=(len(sources), self.n_cells))
+        src, node, dist = _distance_triplets(self.graph, sources, bandwidth)
+        self.K = csr_matrix((np.exp(-dist / bandwidth), (node, src)), shape=(self.graph.n_nodes, len(sources)))
+
+    def nbytes(self):
+        arrays = [self.K.data, self.K.indices, self.K.indptr, self.W.data, self.W.indices, self.W.indptr,
+                  self.cell_days, *self.cell_codes.values()]
+        return sum(a.nbytes for a in arrays)
+
+    def cell_mask(self, filters=None, start=None, end=None):
+        """
+        Células que atendem aos filtros, com a mesma semântica de FilterIndex.select:
+        colunas sem valores são ignoradas e `start`/`end` são datas inclusivas.
+        """
+        mask = np.ones(self.n_cells, dtype=bool)
+        for col, values in (filters or {}).items():
+            if len(values) and col in self.cell_codes:
+                mask &= np.isin(self.cell_codes[col], self._index.value_codes(col, values))
+        if start is not None and end is not None and self._index.time_column:
+            lo = pd.Timestamp(start).to_datetime64().astype('datetime64[D]').astype(np.int64)
+            hi = pd.Timestamp(end).to_datetime64().astype('datetime64[D]').astype(np.int64)
+            mask &= (self.cell_days != MISSING_DAY) & (self.cell_days >= lo) & (self.cell_days <= hi)
+        return mask
+
+    def counts(self, filters=None, start=None, end=None):
+        """
+        Número de crimes de cada nó de origem que atendem aos filtros.
+        """
+        return self.W @ self.cell_mask(filters, start, end).astype(float)
+
+    def densities(self, filters=None, start=None, end=None):
+        """
+        Array com a densidade de cada nó considerando apenas os crimes filtrados.
+        """
+        return self.K @ self.counts(filters, start, end)
+
+    def densities_dict(self, filters=None, start=None, end=None):
+        return dict(zip(self.graph.nodes(), self.densities(filters, start, end).tolist()))
+
+    def cells(self):
+        """
+        DataFrame com as dimensões (valores) e o total de crimes de cada célula.
+        """
+        table = pd.DataFrame({col: self._index.labels(col, codes) for col, codes in self.cell_codes.items()})
+        valid = self.cell_days != MISSING_DAY
+        days = np.full(self.n_cells, np.datetime64('NaT'), dtype='datetime64[D]')
+        days[valid] = self.cell_days[valid].astype('datetime64[D]')
+        table['DIA'] = pd.to_datetime(days)
+        table['CRIMES'] = np.asarray(self.W.sum(axis=0)).ravel().astype(np.int64)
+        return table
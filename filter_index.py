@@ -0,0 +1,170 @@
+# filter_index.py
+import numpy as np
+import pandas as pd
+
+FILTER_COLUMNS = ['MUNICIPIO', 'DESCR_NATUREZA_PRINCIPAL', 'FAIXA_HORA_1', 'FAIXA_HORA_6']
+MISSING_DAY = np.iinfo(np.int64).min
+
+class FilterIndex:
+    """
+    Índice dos filtros da barra lateral, construído uma única vez por conjunto de dados.
+    Para cada coluna categórica guarda, por valor, o array ordenado das linhas que o
+    contêm (posições de um argsort estável dos códigos) e as contagens totais; para
+    DATETIME_FATO, a coluna ordenada com a permutação correspondente.
+    Combinações de filtros são resolvidas por interseção dos arrays de linhas, com
+    custo proporcional ao tamanho do resultado e não ao da tabela.
+    """
+
+    def __init__(self, df, columns=FILTER_COLUMNS, time_column='DATETIME_FATO'):
+        self.n_rows = len(df)
+        self._values = {}
+        self._codes = {}
+        self._order = {}
+        self._bounds = {}
+        self._counts = {}
+        for col in columns:
+            if col not in df.columns:
+                continue
+            serie = df[col]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                codes = serie.cat.codes.to_numpy()
+                values = serie.cat.categories
+            else:
+                codes, values = pd.factorize(serie, sort=True)
+            n_values = len(values)
+            # Nulos (código -1) ficam no fim, fora de qualquer valor
+            codes = np.where(codes < 0, n_values, codes).astype(np.int32)
+            self._values[col] = values
+            self._codes[col] = codes
+            self._order[col] = np.argsort(codes, kind='stable')
+            counts = np.bincount(codes, minlength=n_values + 1)
+            self._bounds[col] = np.concatenate([[0], np.cumsum(counts)])
+            self._counts[col] = counts[:n_values]
+        self.time_column = time_column if time_column in df.columns else None
+        if self.time_column:
+            times = df[time_column].to_numpy(dtype='datetime64[ns]')
+            valid = np.flatnonzero(~np.isnat(times))
+            order = valid[np.argsort(times[valid], kind='stable')]
+            self._row_times = times
+            self._time_order = order
+            self._times = times[order]
+
+    @property
+    def columns(self):
+        return list(self._values)
+
+    def __contains__(self, col):
+        return col in self._values
+
+    def nbytes(self):
+        total = sum(a.nbytes for d in (self._codes, self._order, self._bounds, self._counts) for a in d.values())
+        if self.time_column:
+            total += self._row_times.nbytes + self._time_order.nbytes + self._times.nbytes
+        return total
+
+    def row_codes(self, col, rows=None):
+        """
+        Código de `col` em cada linha (todas, se rows for None); nulos recebem o último código.
+        """
+        codes = self._codes[col]
+        return codes if rows is None else codes[rows]
+
+    def value_codes(self, col, values):
+        """
+        Códigos dos `values` de `col` (valores inexistentes são descartados).
+        """
+        codes = self._values[col].get_indexer(list(values))
+        return codes[codes >= 0]
+
+    def labels(self, col, codes):
+        """
+        Valores de `col` correspondentes aos `codes` (None para o código dos nulos).
+        """
+        values = np.asarray(self._values[col], dtype=object)
+        codes = np.asarray(codes)
+        out = np.full(len(codes), None, dtype=object)
+        known = codes < len(values)
+        out[known] = values[codes[known]]
+        return out
+
+    def n_codes(self, col):
+        """
+        Número de códigos de `col`, contando o dos nulos.
+        """
+        return len(self._values[col]) + 1
+
+    def row_days(self, rows=None):
+        """
+        Dia (dias desde 1970-01-01) de DATETIME_FATO em cada linha; MISSING_DAY para datas ausentes.
+        """
+        times = self._row_times if rows is None else self._row_times[rows]
+        days = times.astype('datetime64[D]').astype(np.int64)
+        return np.where(np.isnat(times), MISSING_DAY, days)
+
+    def rows_for(self, col, values):
+        """
+        Linhas (ordenadas) em que `col` assume algum dos `values`.
+        """
+        codes = self._values[col].get_indexer(list(values))
+        order, bounds = self._order[col], self._bounds[col]
+        parts = [order[bounds[c]:bounds[c + 1]] for c in np.unique(codes[codes >= 0])]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        # Cada fatia já está ordenada; só a união de vários valores precisa ser reordenada
+        return parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+    def rows_between(self, start, end):
+        """
+        Linhas com data (DATETIME_FATO) entre `start` e `end`, inclusive (datas).
+        """
+        lo = np.searchsorted(self._times, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        hi = np.searchsorted(self._times, np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1), 'ns'), side='left')
+        return np.sort(self._time_order[lo:hi])
+
+    def select(self, filters=None, start=None, end=None):
+        """
+        Linhas que atendem a todos os filtros. `filters`: {coluna: valores selecionados};
+        colunas sem valores são ignoradas. `start`/`end`: intervalo de datas opcional.
+        Retorna None quando nenhum filtro está ativo (todas as linhas).
+        """
+        sets = [self.rows_for(col, values) for col, values in (filters or {}).items()
+                if len(values) and col in self._values]
+        if start is not None and end is not None and self.time_column:
+            sets.append(self.rows_between(start, end))
+        if not sets:
+            return None
+        sets.sort(key=len)
+        rows = sets[0]
+        for other in sets[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    def options(self, col, rows=None):
+        """
+        Valores de `col` presentes nas linhas selecionadas (todas, se rows for None),
+        na ordem das categorias.
+        """
+        if rows is None:
+            counts = self._counts[col]
+        else:
+            counts = np.bincount(self._codes[col][rows], minlength=len(self._values[col]) + 1)[:-1]
+        return list(self._values[col][counts > 0])
+
+    def time_bounds(self, rows=None):
+        """
+        Menor e maior DATETIME_FATO das linhas selecionadas, ou None se não houver datas.
+        """
+        if not self.time_column:
+            return None
+        if rows is None:
+            times = self._times
+            if not len(times):
+                return None
+            return pd.Timestamp(times[0]), pd.Timestamp(times[-1])
+        times = self._row_times[rows]
+        times = times[~np.isnat(times)]
+        if not len(times):
+            return None
+        return pd.Timestamp(times.min()), pd.Timestamp(times.max())
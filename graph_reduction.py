@@ -0,0 +1,251 @@
+# graph_reduction.py
+import numpy as np
+import shapely
+from scipy.sparse.csgraph import dijkstra
+
+from compiled_graph import CompiledGraph, compile_graph
+from snapping import SnappedPoints
+
+# Redes de trabalho: completa, recortada à extensão dos crimes ou recortada e contraída
+REDUCTION_MODES = {
+    'none': "Completa",
+    'prune': "Recortada à área dos crimes",
+    'contract': "Recortada, com cadeias de grau 2 contraídas",
+}
+
+def extent_nodes(graph, seeds, buffer):
+    """
+    Máscara dos nós a uma distância de rede <= buffer (no sentido de circulação) de algum
+    dos nós `seeds`, em uma única busca com múltiplas origens, mais os destinos das
+    arestas que saem deles (para que as ruas que partem da área não sejam cortadas).
+    Todo caminho de até `buffer` metros a partir das origens fica dentro da máscara.
+    """
+    seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+    keep = np.zeros(graph.n_nodes, dtype=bool)
+    if not len(seeds):
+        return keep
+    dist = dijkstra(graph.matrix, directed=True, indices=seeds, limit=buffer, min_only=True)
+    reached = np.isfinite(dist)
+    keep[reached] = True
+    keep[graph.indices[reached[graph.edge_sources]]] = True
+    return keep
+
+def subgraph(graph, keep):
+    """
+    Subgrafo induzido pelos nós da máscara `keep`. Retorna (CompiledGraph, índices
+    originais dos nós, posições originais das arestas). A ordem das arestas é preservada.
+    """
+    keep = np.asarray(keep, dtype=bool)
+    nodes = np.flatnonzero(keep)
+    new_index = np.cumsum(keep) - 1
+    u = graph.edge_sources
+    v = graph.indices
+    edges = np.flatnonzero(keep[u] & keep[v])
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_index[u[edges]], minlength=len(nodes)), out=indptr[1:])
+    sub = CompiledGraph(graph.node_ids[nodes], graph.x[nodes], graph.y[nodes], indptr, new_index[v[edges]],
+                        graph.lengths[edges], crs=graph.crs, edge_geometry=graph.snap_index.edge_geometry[edges])
+    return sub, nodes, edges
+
+def _removable(graph, protected):
+    """
+    Nós de passagem que podem ser contraídos: exatamente dois vizinhos, sem laço, e ou
+    mão dupla com os dois (2 arestas de entrada e 2 de saída) ou entrada por um e saída
+    pelo outro (mão única).
+    """
+    n = graph.n_nodes
+    u = graph.edge_sources
+    v = graph.indices.astype(np.int64)
+    loops = np.zeros(n, dtype=bool)
+    loops[u[u == v]] = True
+    keys = np.unique(np.concatenate([u * n + v, v * n + u]))
+    neighbours = np.bincount(keys // n, minlength=n)
+    out_degree = np.bincount(u, minlength=n)
+    in_degree = np.bincount(v, minlength=n)
+    passing = ((out_degree == 2) & (in_degree == 2)) | ((out_degree == 1) & (in_degree == 1))
+    return (neighbours == 2) & passing & ~loops & ~protected
+
+def _walk_chains(graph, removable):
+    """
+    Cadeias de arestas que começam em um nó mantido e atravessam nós removíveis até o
+    próximo nó mantido. Retorna (início de cada cadeia no array de arestas, arestas em
+    ordem, nós removíveis atravessados).
+    """
+    u = graph.edge_sources
+    v = graph.indices.astype(np.int64)
+    current = np.flatnonzero(~removable[u] & removable[v])
+    chain = np.arange(len(current))
+    steps_chain, steps_edge = [chain], [current]
+    visited = np.zeros(graph.n_nodes, dtype=bool)
+    while len(current):
+        node = v[current]
+        active = removable[node]
+        current, chain, node, previous = current[active], chain[active], node[active], u[current[active]]
+        visited[node] = True
+        # Sai pela aresta que não volta ao nó anterior
+        first = graph.indptr[node]
+        has_two = graph.indptr[node + 1] - first == 2
+        current = np.where(has_two & (graph.indices[first] == previous), first + 1, first)
+        steps_chain.append(chain)
+        steps_edge.append(current)
+    chain = np.concatenate(steps_chain)
+    order = np.argsort(chain, kind='stable')
+    edges = np.concatenate(steps_edge)[order]
+    chain_ptr = np.searchsorted(chain[order], np.arange(len(steps_chain[0]) + 1))
+    return chain_ptr, edges, visited
+
+def contract_chains(graph, protected=None):
+    """
+    Contrai as cadeias de nós de grau 2 (fora de `protected`) em arestas únicas, com o
+    comprimento somado e a geometria das arestas originais emendada. Cadeias que
+    formariam laços ou arestas paralelas mantêm o primeiro nó intermediário.
+    Retorna (CompiledGraph, índices originais dos nós, edge_ptr, arestas originais):
+    a aresta k do grafo contraído percorre, em ordem, original_edges[edge_ptr[k]:edge_ptr[k + 1]].
+    """
+    n = graph.n_nodes
+    protected = np.zeros(n, dtype=bool) if protected is None else np.asarray(protected, dtype=bool).copy()
+    u = graph.edge_sources
+    v = graph.indices.astype(np.int64)
+    while True:
+        removable = _removable(graph, protected)
+        chain_ptr, chain_edges, visited = _walk_chains(graph, removable)
+        # Ciclos formados só por nós removíveis não têm onde começar: ficam como estão
+        isolated = removable & ~visited
+        if isolated.any():
+            protected |= isolated
+            continue
+        simple = np.flatnonzero(~removable[u] & ~removable[v])
+        chain_u = u[chain_edges[chain_ptr[:-1]]]
+        chain_v = v[chain_edges[chain_ptr[1:] - 1]]
+        new_u = np.concatenate([u[simple], chain_u])
+        new_v = np.concatenate([v[simple], chain_v])
+        keys = new_u * n + new_v
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        chain_bad = ((counts[inverse] > 1) | (new_u == new_v))[len(simple):]
+        if not chain_bad.any():
+            break
+        protected[v[chain_edges[chain_ptr[:-1][chain_bad]]]] = True
+
+    # Mapeamento de cada nova aresta para as arestas originais
+    sizes = np.concatenate([np.ones(len(simple), dtype=np.int64), np.diff(chain_ptr)])
+    originals = np.concatenate([simple, chain_edges])
+    order = np.lexsort((new_v, new_u))
+    sizes = sizes[order]
+    starts = np.concatenate([np.arange(len(simple)), len(simple) + chain_ptr[:-1]])[order]
+    edge_ptr = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=edge_ptr[1:])
+    owner = np.repeat(np.arange(len(order)), sizes)
+    original_edges = originals[starts[owner] + np.arange(edge_ptr[-1]) - edge_ptr[owner]]
+
+    lengths = np.bincount(owner, weights=graph.lengths[original_edges], minlength=len(order))
+    # Geometria emendada: cada parte, exceto a primeira, perde o ponto repetido da junção
+    parts = graph.snap_index.edge_geometry[original_edges]
+    coords, part = shapely.get_coordinates(parts, return_index=True)
+    first_coord = np.r_[True, part[1:] != part[:-1]]
+    first_part = np.zeros(len(parts), dtype=bool)
+    first_part[edge_ptr[:-1]] = True
+    keep_coord = ~first_coord | first_part[part]
+    geometry = shapely.linestrings(coords[keep_coord], indices=owner[part[keep_coord]])
+
+    nodes = np.flatnonzero(~removable)
+    new_index = np.cumsum(~removable) - 1
+    new_u, new_v = new_index[new_u[order]], new_index[new_v[order]]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_u, minlength=len(nodes)), out=indptr[1:])
+    contracted = CompiledGraph(graph.node_ids[nodes], graph.x[nodes], graph.y[nodes], indptr, new_v, lengths,
+                               crs=graph.crs, edge_geometry=geometry)
+    return contracted, nodes, edge_ptr, original_edges
+
+class ReducedGraph:
+    """
+    Rede de trabalho derivada da rede completa (`source`): `graph` é o CompiledGraph
+    reduzido, `nodes` o índice original de cada nó e a aresta k de `graph` percorre as
+    arestas originais original_edges[edge_ptr[k]:edge_ptr[k + 1]], em ordem.
+    `snapped` são os crimes já associados à rede reduzida.
+    """
+
+    def __init__(self, source, graph, nodes, edge_ptr, original_edges, snapped=None):
+        self.source = source
+        self.graph = graph
+        self.nodes = nodes
+        self.edge_ptr = edge_ptr
+        self.original_edges = original_edges
+        self.snapped = snapped
+        # Aresta reduzida de cada aresta original e metros percorridos antes dela
+        owner = np.repeat(np.arange(graph.n_edges), np.diff(edge_ptr))
+        lengths = source.lengths[original_edges]
+        before = np.cumsum(lengths) - lengths
+        self._reduced_edge = np.full(source.n_edges, -1, dtype=np.int64)
+        self._reduced_edge[original_edges] = owner
+        self._offset = np.zeros(source.n_edges)
+        self._offset[original_edges] = before - before[edge_ptr[:-1]][owner]
+        self._reduced_node = np.full(source.n_nodes, -1, dtype=np.int64)
+        self._reduced_node[nodes] = np.arange(len(nodes))
+
+    def nbytes(self):
+        arrays = (self.nodes, self.edge_ptr, self.original_edges, self._reduced_edge, self._offset, self._reduced_node)
+        return self.graph.nbytes() + sum(a.nbytes for a in arrays)
+
+    def translate(self, snapped):
+        """
+        Converte pontos associados à rede completa para a rede reduzida. No modo 'edge',
+        o offset passa a contar a partir do início da cadeia contraída. Pontos fora da
+        rede reduzida ficam com -1.
+        """
+        if snapped.mode == 'node':
+            return SnappedPoints('node', node=self._reduced_node[snapped.node], distance=snapped.distance)
+        return SnappedPoints('edge', edge=self._reduced_edge[snapped.edge],
+                             offset=self._offset[snapped.edge] + snapped.offset, distance=snapped.distance)
+
+    def original_pairs(self, edge_pairs):
+        """
+        Pares (u, v) de ids das arestas originais percorridas pelas arestas reduzidas
+        informadas (em qualquer sentido), para desenhar ou exportar na rede completa.
+        """
+        graph, source = self.graph, self.source
+        pairs = list(edge_pairs)
+        if not pairs:
+            return []
+        index = graph.index
+        u = np.fromiter((index.get(a, -1) for a, _ in pairs), dtype=np.int64, count=len(pairs))
+        v = np.fromiter((index.get(b, -1) for _, b in pairs), dtype=np.int64, count=len(pairs))
+        known = (u >= 0) & (v >= 0)
+        pos = graph.find_edges(u[known], v[known])
+        pos = np.where(pos >= 0, pos, graph.find_edges(v[known], u[known]))
+        pos = pos[pos >= 0]
+        sizes = self.edge_ptr[pos + 1] - self.edge_ptr[pos]
+        owner = np.repeat(np.arange(len(pos)), sizes)
+        original = self.original_edges[self.edge_ptr[pos][owner] + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)]
+        ids = source.node_ids
+        return list(zip(ids[source.edge_sources[original]].tolist(), ids[source.indices[original]].tolist()))
+
+    def summary(self):
+        return {'Nós': int(self.graph.n_nodes), 'Arestas': int(self.graph.n_edges),
+                'Nós (rede completa)': int(self.source.n_nodes), 'Arestas (rede completa)': int(self.source.n_edges)}
+
+def _seed_nodes(graph, snapped):
+    if snapped.mode == 'node':
+        return snapped.node
+    return np.concatenate([graph.edge_sources[snapped.edge], graph.indices[snapped.edge]])
+
+def reduce_graph(G, snapped, buffer, contract=False):
+    """
+    Rede de trabalho para os crimes `snapped` (associados à rede completa G): só os nós
+    a até `buffer` metros de rede dos crimes, e, com `contract`, as cadeias de nós de
+    grau 2 viram arestas únicas (os nós com crimes, no modo 'node', são mantidos).
+    Com buffer >= bandwidth, as densidades por nó na rede recortada são as mesmas da
+    rede completa. Retorna ReducedGraph, com os crimes já convertidos.
+    """
+    source = compile_graph(G)
+    seeds = _seed_nodes(source, snapped)
+    graph, nodes, edges = subgraph(source, extent_nodes(source, seeds, buffer))
+    edge_ptr = np.arange(len(edges) + 1)
+    if contract:
+        protected = np.zeros(graph.n_nodes, dtype=bool)
+        if snapped.mode == 'node':
+            protected[np.searchsorted(nodes, np.unique(seeds))] = True
+        graph, kept, edge_ptr, chain_edges = contract_chains(graph, protected)
+        nodes, edges = nodes[kept], edges[chain_edges]
+    reduced = ReducedGraph(source, graph, nodes, edge_ptr, edges)
+    reduced.snapped = reduced.translate(snapped)
+    return reduced
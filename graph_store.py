@@ -0,0 +1,221 @@
+# graph_store.py
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import shapely
+
+from compiled_graph import CompiledGraph
+
+# Incrementar sempre que o layout dos arquivos mudar: versões diferentes são descartadas
+FORMAT_VERSION = 1
+DEFAULT_STORE_DIR = os.environ.get("POH_GRAPH_STORE", ".graph_store")
+DEFAULT_MAX_BYTES = int(os.environ.get("POH_GRAPH_STORE_MAX_BYTES", 2 * 1024 ** 3))
+
+_ARRAYS = ('node_ids', 'x', 'y', 'indptr', 'indices', 'lengths')
+# Diretórios temporários de gravação/troca (`<rede>.tmp-<pid>`, `<rede>.old-<pid>`)
+_TRANSIENT = re.compile(r'\.(tmp|old)-\d+$')
+# Trava da remoção entre processos (lotes em paralelo); travas mais antigas que isto
+# são de processos que morreram e podem ser retomadas
+EVICT_LOCK = '.evict.lock'
+STALE_LOCK_SECONDS = 600
+
+class GraphStore:
+    """
+    Armazenamento em disco das redes viárias já projetadas e compiladas, uma por
+    `region_query`. Cada rede é um diretório com arrays .npy (carregados via memory-map)
+    e as geometrias das arestas (coordenadas + offsets), além de um meta.json com a
+    versão do formato e o hash do conteúdo.
+    O tamanho total é limitado a `max_bytes`: as redes usadas há mais tempo são removidas.
+    Vários processos podem usar o mesmo diretório: a gravação troca o diretório da rede
+    por renomeação e a remoção roda sob uma trava em arquivo.
+    """
+
+    def __init__(self, root=DEFAULT_STORE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, region_query):
+        key = region_query.strip().lower()
+        slug = re.sub(r'[^a-z0-9]+', '_', key).strip('_')[:60]
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.root, f"{slug}-{digest}")
+
+    def _read_meta(self, path):
+        try:
+            with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __contains__(self, region_query):
+        meta = self._read_meta(self._path(region_query))
+        return meta is not None and meta.get('format_version') == FORMAT_VERSION
+
+    def load(self, region_query):
+        """
+        Carrega a rede salva (memory-map dos arrays), ou None se não houver versão válida.
+        As geometrias das arestas só são reconstruídas no primeiro acesso.
+        """
+        path = self._path(region_query)
+        meta = self._read_meta(path)
+        if meta is None or meta.get('format_version') != FORMAT_VERSION:
+            return None
+        try:
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in _ARRAYS}
+        except (OSError, ValueError):
+            return None
+
+        def load_geometry():
+            coords = np.load(os.path.join(path, 'geom_coords.npy'))
+            offsets = np.load(os.path.join(path, 'geom_offsets.npy'))
+            return shapely.linestrings(coords, indices=np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)))
+
+        # Marca o acesso para a política de remoção (menos usada recentemente)
+        try:
+            os.utime(os.path.join(path, 'meta.json'))
+        except OSError:
+            pass
+        return CompiledGraph(crs=meta.get('crs'), edge_geometry=load_geometry,
+                             fingerprint=meta.get('hash'), **arrays)
+
+    def save(self, region_query, graph):
+        """
+        Salva a rede compilada (gravação atômica) e aplica o limite de tamanho.
+        """
+        path = self._path(region_query)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(getattr(graph, name)))
+        geometry = graph.snap_index.edge_geometry
+        coords, part = shapely.get_coordinates(geometry, return_index=True)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(part, minlength=len(geometry)))])
+        np.save(os.path.join(tmp_path, 'geom_coords.npy'), coords)
+        np.save(os.path.join(tmp_path, 'geom_offsets.npy'), offsets)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'region_query': region_query,
+            'hash': graph.fingerprint(),
+            'crs': str(graph.crs) if graph.crs is not None else None,
+            'n_nodes': int(graph.n_nodes),
+            'n_edges': int(graph.n_edges),
+            'created': time.time(),
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        # Troca por renomeação: a versão antiga sai de cena e a nova entra logo em seguida,
+        # sem a janela de um rmtree recursivo; leitores já abertos mantêm seus memory-maps
+        old_path = f"{path}.old-{os.getpid()}"
+        try:
+            os.replace(path, old_path)
+        except OSError:
+            old_path = None
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Outro processo gravou a mesma rede nesse intervalo: a dele é mantida
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+        self.evict()
+        return path
+
+    def invalidate(self, region_query):
+        """
+        Remove a rede salva da região (força novo download na próxima consulta).
+        """
+        path = self._path(region_query)
+        existed = os.path.isdir(path)
+        shutil.rmtree(path, ignore_errors=True)
+        return existed
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry['path'], ignore_errors=True)
+
+    def entries(self):
+        """
+        Lista as redes salvas: caminho, região, tamanho em bytes e último acesso.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            if _TRANSIENT.search(name):
+                continue
+            path = os.path.join(self.root, name)
+            meta = self._read_meta(path)
+            if meta is None:
+                continue
+            # A rede pode ser removida por outro processo durante a listagem
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                last_access = os.path.getmtime(os.path.join(path, 'meta.json'))
+            except OSError:
+                continue
+            entries.append({'path': path, 'region_query': meta.get('region_query'),
+                            'bytes': size, 'last_access': last_access,
+                            'valid': meta.get('format_version') == FORMAT_VERSION})
+        return entries
+
+    @contextmanager
+    def _evict_lock(self):
+        """
+        Trava exclusiva (arquivo criado com O_EXCL) para a remoção; produz False se outro
+        processo já estiver removendo.
+        """
+        lock = os.path.join(self.root, EVICT_LOCK)
+        try:
+            if time.time() - os.path.getmtime(lock) > STALE_LOCK_SECONDS:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            yield False
+            return
+        try:
+            os.close(fd)
+            yield True
+        finally:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove versões antigas do formato e, em seguida, as redes menos usadas
+        recentemente até o total caber em `max_bytes`. Retorna as regiões removidas.
+        Se outro processo já estiver removendo, não faz nada (o limite é aplicado por ele).
+        """
+        with self._evict_lock() as acquired:
+            if not acquired:
+                return []
+            return self._evict()
+
+    def _evict(self):
+        removed = []
+        entries = []
+        for entry in self.entries():
+            if entry['valid']:
+                entries.append(entry)
+            else:
+                shutil.rmtree(entry['path'], ignore_errors=True)
+                removed.append(entry['region_query'])
+        entries.sort(key=lambda e: e['last_access'])
+        total = sum(e['bytes'] for e in entries)
+        # A rede mais recente é sempre mantida, mesmo que sozinha ultrapasse o limite
+        while len(entries) > 1 and total > self.max_bytes:
+            entry = entries.pop(0)
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['bytes']
+            removed.append(entry['region_query'])
+        return removed
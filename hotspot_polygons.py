@@ -0,0 +1,102 @@
+# hotspot_polygons.py
+import numpy as np
+import shapely
+
+# Polígono de cada hotspot do PHAR/i-PHAR
+POLYGON_TYPES = {
+    'convex': "Envoltória convexa",
+    'concave': "Envoltória côncava",
+    'streets': "Ruas do cluster (buffer)",
+}
+# Envoltória côncava: fração (0 a 1) do comprimento máximo de aresta mantido; menor = mais justa
+CONCAVE_RATIO = 0.3
+# Buffer (m) em torno das ruas e nós do cluster
+STREET_BUFFER = 40
+# Segmentos por quarto de círculo nos buffers: menos vértices, custo limitado por cluster
+BUFFER_QUAD_SEGS = 2
+
+def _groups(labels, min_size=3):
+    """
+    Ordenação única dos rótulos: (rótulos com pelo menos `min_size` elementos, posições
+    dos elementos agrupadas por rótulo, índice do grupo de cada posição).
+    """
+    labels = np.asarray(labels)
+    valid = np.flatnonzero(labels >= 0)
+    order = valid[np.argsort(labels[valid], kind='stable')]
+    keys, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+    big = counts >= min_size
+    group = np.repeat(np.arange(len(keys)), counts)
+    keep = big[group]
+    remap = np.cumsum(big) - 1
+    return keys[big], order[keep], remap[group[keep]]
+
+def _street_polygons(graph, nodes, labels, keys, buffer):
+    """
+    Buffer das arestas com as duas pontas no mesmo cluster (cada via uma vez) e dos nós
+    do cluster, em uma única chamada vetorizada por tipo de geometria.
+    """
+    node_label = np.full(graph.n_nodes, -1, dtype=np.int64)
+    node_label[nodes] = labels
+    u = graph.edge_sources
+    v = graph.indices
+    lu, lv = node_label[u], node_label[v]
+    inside = (lu >= 0) & (lu == lv) & np.isin(lu, keys)
+    # Vias de mão dupla aparecem nos dois sentidos: fica só u < v
+    reverse = graph.find_edges(v, u)
+    inside &= (reverse < 0) | (u < v)
+    edges = np.flatnonzero(inside)
+    group_of_key = {k: i for i, k in enumerate(keys.tolist())}
+    edge_group = np.fromiter((group_of_key[k] for k in lu[edges].tolist()), dtype=np.int64, count=len(edges))
+    lines = np.full(len(keys), None, dtype=object)
+    if len(edges):
+        present = np.unique(edge_group)
+        order = np.argsort(edge_group, kind='stable')
+        merged = shapely.multilinestrings(graph.snap_index.edge_geometry[edges[order]],
+                                          indices=np.searchsorted(present, edge_group[order]))
+        lines[present] = shapely.buffer(merged, buffer, quad_segs=BUFFER_QUAD_SEGS)
+    node_group = np.fromiter((group_of_key.get(k, -1) for k in labels.tolist()), dtype=np.int64, count=len(labels))
+    chosen = np.flatnonzero(node_group >= 0)
+    order = chosen[np.argsort(node_group[chosen], kind='stable')]
+    points = shapely.multipoints(np.column_stack([graph.x[nodes[order]], graph.y[nodes[order]]]),
+                                 indices=node_group[order])
+    points = shapely.buffer(points, buffer, quad_segs=BUFFER_QUAD_SEGS)
+    missing = shapely.is_missing(lines)
+    lines[missing] = points[missing]
+    return shapely.union(lines, points)
+
+def cluster_polygons(graph, nodes, labels, kind='convex', min_size=3, ratio=CONCAVE_RATIO, buffer=STREET_BUFFER):
+    """
+    Polígono de cada cluster com pelo menos `min_size` nós. `nodes` são índices de nós do
+    CompiledGraph e `labels` o rótulo de cada um (< 0 = sem cluster). Os nós são agrupados
+    uma única vez e todos os polígonos saem de uma chamada vetorizada do shapely:
+    'convex' (envoltória convexa), 'concave' (envoltória côncava, `ratio`) ou 'streets'
+    (buffer de `buffer` metros nas ruas e nós do cluster).
+    Retorna [(rótulo, polígono)] em ordem de rótulo.
+    """
+    if kind not in POLYGON_TYPES:
+        raise ValueError(f"Tipo de polígono desconhecido: {kind}")
+    nodes = np.asarray(nodes, dtype=np.int64)
+    labels = np.asarray(labels)
+    keys, positions, group = _groups(labels, min_size)
+    if not len(keys):
+        return []
+    if kind == 'streets':
+        polygons = _street_polygons(graph, nodes, labels, keys, buffer)
+    else:
+        selected = nodes[positions]
+        points = shapely.multipoints(np.column_stack([graph.x[selected], graph.y[selected]]), indices=group)
+        if kind == 'convex':
+            polygons = shapely.convex_hull(points)
+        else:
+            polygons = shapely.concave_hull(points, ratio=ratio)
+    return list(zip(keys.tolist(), polygons))
+
+def polygons_to_4326(polygons, crs="EPSG:3857"):
+    """
+    Reprojeta [(cluster, polígono)] para EPSG:4326 em uma única transformação.
+    """
+    if not polygons:
+        return []
+    import geopandas as gpd
+    geometry = gpd.GeoSeries([p for _, p in polygons], crs=crs).to_crs(epsg=4326)
+    return list(zip([c for c, _ in polygons], geometry.values))
@@ -0,0 +1,167 @@
+# instrumentation.py
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger("poh.instrumentation")
+
+_current = contextvars.ContextVar("poh_recorder", default=None)
+_NULL = contextlib.nullcontext()
+
+class _Stage:
+    __slots__ = ('name', 'path', 'depth', 'start', 'elapsed', 'mem_start', 'peak', 'counters')
+
+    def __init__(self, name, path, depth):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.mem_start = None
+        self.peak = 0
+        self.counters = {}
+
+class Recorder:
+    """
+    Registro das etapas de uma execução: tempo de parede, pico de memória (tracemalloc,
+    só com `memory=True`) e contadores de cada etapa. As etapas podem ser aninhadas;
+    `path` guarda o caminho completo ("densidades/kde").
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = []
+        self._stack = []
+        self.created = time.time()
+
+    def _enter(self, name):
+        parent = self._stack[-1] if self._stack else None
+        stage = _Stage(name, f"{parent.path}/{name}" if parent else name, len(self._stack))
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            stage.mem_start = current
+        self._stack.append(stage)
+        self.stages.append(stage)
+        return stage
+
+    def _exit(self, stage):
+        stage.elapsed = time.perf_counter() - stage.start
+        if self.memory:
+            stage.peak = max(stage.peak, tracemalloc.get_traced_memory()[1])
+            if len(self._stack) > 1:
+                parent = self._stack[-2]
+                parent.peak = max(parent.peak, stage.peak)
+        self._stack.pop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = self._enter(name)
+        try:
+            yield stage
+        finally:
+            self._exit(stage)
+
+    def count(self, name, value=1):
+        """
+        Soma `value` ao contador `name` da etapa atual (ou cria um registro avulso).
+        """
+        target = self._stack[-1] if self._stack else None
+        if target is None:
+            with self.stage('(fora de etapas)') as target:
+                pass
+        target.counters[name] = target.counters.get(name, 0) + value
+
+    def records(self):
+        """
+        Uma linha (dict) por etapa, na ordem de início.
+        """
+        rows = []
+        for s in self.stages:
+            row = {'etapa': s.path, 'nivel': s.depth,
+                   'tempo_s': round(s.elapsed, 6) if s.elapsed is not None else None,
+                   'pico_memoria_mb': round((s.peak - s.mem_start) / 1024 ** 2, 3) if s.mem_start is not None else None}
+            row.update(s.counters)
+            rows.append(row)
+        return rows
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.records())
+
+    def to_json_lines(self):
+        """
+        Log estruturado: um objeto JSON por etapa.
+        """
+        return "\n".join(json.dumps({'ts': self.created, **r}, ensure_ascii=False, default=str)
+                         for r in self.records()) + "\n"
+
+    def to_metrics_text(self, prefix="poh"):
+        """
+        Métricas no formato texto do Prometheus: tempo, memória e contadores por etapa.
+        """
+        lines = [f"# TYPE {prefix}_etapa_segundos gauge", f"# TYPE {prefix}_etapa_pico_memoria_bytes gauge",
+                 f"# TYPE {prefix}_etapa_contador gauge"]
+        for s in self.stages:
+            label = s.path.replace('\\', '\\\\').replace('"', '\\"')
+            if s.elapsed is not None:
+                lines.append(f'{prefix}_etapa_segundos{{etapa="{label}"}} {s.elapsed:.6f}')
+            if s.mem_start is not None:
+                lines.append(f'{prefix}_etapa_pico_memoria_bytes{{etapa="{label}"}} {s.peak - s.mem_start}')
+            for name, value in s.counters.items():
+                counter = str(name).replace('"', '\\"')
+                lines.append(f'{prefix}_etapa_contador{{etapa="{label}",contador="{counter}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def log(self, level=logging.INFO):
+        for record in self.records():
+            logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+@contextlib.contextmanager
+def recording(memory=False):
+    """
+    Ativa um Recorder para o código executado dentro do bloco (no contexto atual).
+    Com `memory`, liga o tracemalloc durante o bloco (que fica mais lento).
+    """
+    recorder = Recorder(memory=memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+        if started:
+            tracemalloc.stop()
+
+def current():
+    """
+    Recorder ativo, ou None quando a instrumentação está desligada.
+    """
+    return _current.get()
+
+def enabled():
+    return _current.get() is not None
+
+def stage(name):
+    """
+    Context manager que registra a etapa no Recorder ativo; sem Recorder, não faz nada.
+    """
+    recorder = _current.get()
+    if recorder is None:
+        return _NULL
+    return recorder.stage(name)
+
+def count(name, value=1):
+    """
+    Soma ao contador da etapa atual; sem Recorder ativo, não faz nada.
+    """
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.count(name, value)
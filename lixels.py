@@ -0,0 +1,278 @@
+# lixels.py
+import numpy as np
+
+from compiled_graph import compile_graph
+from network_utils import _distance_triplets, _expand_rows
+
+# Comprimento padrão dos lixels (m)
+DEFAULT_LIXEL_LENGTH = 50
+# Candidatos (fonte, lixel) materializados de uma vez no KDE
+MAX_LIXEL_PAIRS = 4_000_000
+# Fontes (lixels com crimes) por busca no grafo
+SOURCE_BLOCK = 2048
+
+def _ranges(first, counts):
+    """
+    Para cada i, os inteiros first[i], ..., first[i] + counts[i] - 1, concatenados.
+    Retorna (dono de cada valor, valor).
+    """
+    counts = np.maximum(counts, 0)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, first[owner] + within
+
+class LixelNetwork:
+    """
+    Ruas da rede divididas em lixels (segmentos lineares) de até `lixel_length` metros.
+    Cada via vira uma única sequência de lixels de mesmo comprimento: as vias de mão
+    dupla (arestas u -> v e v -> u) usam a aresta com u < v; as de mão única, a própria
+    aresta. O lixel i fica na aresta `edges[edge_of[i]]`, entre `start[i]` e `end[i]`
+    metros a partir da origem.
+    O KDE é avaliado no centro de cada lixel, com os crimes associados ao lixel mais
+    próximo, pela distância de rede (no sentido de circulação) limitada à bandwidth.
+    """
+
+    def __init__(self, G, lixel_length=DEFAULT_LIXEL_LENGTH):
+        graph = compile_graph(G)
+        self.graph = graph
+        self.lixel_length = float(lixel_length)
+        u = graph.edge_sources
+        v = graph.indices.astype(np.int64)
+        reverse = graph.find_edges(v, u)
+        two_way = reverse >= 0
+        canonical = ~two_way | (u <= v)
+        self.edges = np.flatnonzero(canonical)
+        self.u = u[self.edges]
+        self.v = v[self.edges]
+        self.two_way = two_way[self.edges] & (self.u != self.v)
+        self.length = graph.lengths[self.edges]
+        self.counts = np.maximum(1, np.ceil(self.length / self.lixel_length - 1e-9)).astype(np.int64)
+        self.seg = self.length / self.counts
+        self.edge_ptr = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=self.edge_ptr[1:])
+        self.n_lixels = int(self.edge_ptr[-1])
+        self.edge_of = np.repeat(np.arange(len(self.edges)), self.counts)
+        self.position = np.arange(self.n_lixels) - self.edge_ptr[self.edge_of]
+        self.start = self.position * self.seg[self.edge_of]
+        self.end = self.start + self.seg[self.edge_of]
+
+        # Aresta canônica de cada aresta do grafo (as de sentido v -> u ficam invertidas)
+        self._canonical = np.full(graph.n_edges, -1, dtype=np.int64)
+        self._canonical[self.edges] = np.arange(len(self.edges))
+        self._flipped = np.zeros(graph.n_edges, dtype=bool)
+        back = np.flatnonzero(self.two_way)
+        self._canonical[reverse[self.edges[back]]] = back
+        self._flipped[reverse[self.edges[back]]] = True
+
+        # Entradas de cada nó nas vias: pela origem (sentido u -> v) e, nas vias de mão
+        # dupla, pelo destino (sentido v -> u). Formato CSR por nó.
+        nodes = np.concatenate([self.u, self.v[back]])
+        order = np.argsort(nodes, kind='stable')
+        self._entry_edge = np.concatenate([np.arange(len(self.edges)), back])[order]
+        self._entry_forward = np.concatenate([np.ones(len(self.edges), dtype=bool),
+                                              np.zeros(len(back), dtype=bool)])[order]
+        self._entry_ptr = np.zeros(graph.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nodes, minlength=graph.n_nodes), out=self._entry_ptr[1:])
+        self._geometry = {}
+
+    def nbytes(self):
+        arrays = [self.edges, self.u, self.v, self.two_way, self.length, self.counts, self.seg, self.edge_ptr,
+                  self.edge_of, self.position, self.start, self.end, self._canonical, self._flipped,
+                  self._entry_edge, self._entry_forward, self._entry_ptr]
+        return sum(a.nbytes for a in arrays) + sum(g.nbytes for g in self._geometry.values())
+
+    def assign(self, snapped):
+        """
+        Lixel de cada ponto já associado à rede (SnappedPoints). No modo 'edge', o
+        lixel que contém a projeção; no modo 'node', o primeiro lixel de uma via que
+        sai do nó (-1 se o nó não tem vias).
+        """
+        if snapped.mode == 'edge':
+            edge = np.asarray(snapped.edge, dtype=np.int64)
+            c = self._canonical[edge]
+            edge_length = self.graph.lengths[edge]
+            ratio = np.divide(snapped.offset, edge_length, out=np.zeros(len(edge)), where=edge_length > 0)
+            ratio = np.where(self._flipped[edge], 1 - ratio, ratio)
+            k = np.clip(np.floor(ratio * self.counts[c]).astype(np.int64), 0, self.counts[c] - 1)
+            return self.edge_ptr[c] + k
+        node = np.asarray(snapped.node, dtype=np.int64)
+        has_entry = self._entry_ptr[node + 1] > self._entry_ptr[node]
+        first = self._entry_ptr[node][has_entry]
+        c = self._entry_edge[first]
+        lixel = np.full(len(node), -1, dtype=np.int64)
+        lixel[has_entry] = np.where(self._entry_forward[first], self.edge_ptr[c], self.edge_ptr[c + 1] - 1)
+        return lixel
+
+    def _candidates(self, sources, bandwidth):
+        """
+        Distâncias de rede <= bandwidth do centro de cada lixel de `sources` até o centro
+        dos demais lixels, em lotes: (posição da fonte, lixel, distância). Um mesmo par
+        pode aparecer mais de uma vez (caminhos pela origem e pelo destino da via).
+        """
+        c = self.edge_of[sources]
+        k = self.position[sources]
+        seg = self.seg[c]
+        center = (k + 0.5) * seg
+        src = np.arange(len(sources))
+
+        # Mesma via: para frente e, na mão dupla, para trás
+        reach = np.floor(bandwidth / seg + 1e-9).astype(np.int64)
+        forward = np.minimum(self.counts[c] - k, reach + 1)
+        owner, j = _ranges(k, forward)
+        yield src[owner], self.edge_ptr[c[owner]] + j, (j - k[owner]) * seg[owner]
+        backward = np.where(self.two_way[c], np.minimum(k, reach), 0)
+        owner, j = _ranges(k - backward, backward)
+        yield src[owner], self.edge_ptr[c[owner]] + j, (k[owner] - j) * seg[owner]
+
+        # Saídas da via: pelo destino (sempre) e pela origem (mão dupla)
+        two_way = np.flatnonzero(self.two_way[c])
+        exit_src = np.concatenate([src, two_way])
+        exit_node = np.concatenate([self.v[c], self.u[c[two_way]]])
+        exit_dist = np.concatenate([self.length[c] - center, center[two_way]])
+        inside = exit_dist <= bandwidth
+        exit_src, exit_node, exit_dist = exit_src[inside], exit_node[inside], exit_dist[inside]
+        if not len(exit_src):
+            return
+        seeds = np.unique(exit_node)
+        rows, cols, dists = _distance_triplets(self.graph, seeds, bandwidth)
+        row_ptr = np.searchsorted(rows, np.arange(len(seeds) + 1))
+        owner, pos = _expand_rows(row_ptr, np.searchsorted(seeds, exit_node))
+        node_src = exit_src[owner]
+        node = cols[pos]
+        node_dist = exit_dist[owner] + dists[pos]
+        keep = node_dist <= bandwidth
+        node_src, node, node_dist = node_src[keep], node[keep], node_dist[keep]
+        # Menor distância por (fonte, nó) antes de expandir para as vias do nó
+        order = np.lexsort((node_dist, node, node_src))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (node_src[order][1:] != node_src[order][:-1]) | (node[order][1:] != node[order][:-1])
+        order = order[first]
+        node_src, node, node_dist = node_src[order], node[order], node_dist[order]
+
+        # Cada nó alcançado entra nas vias que partem dele; lixels até onde sobra bandwidth
+        owner, pos = _expand_rows(self._entry_ptr, node)
+        entry_src, entry_dist = node_src[owner], node_dist[owner]
+        e = self._entry_edge[pos]
+        fwd = self._entry_forward[pos]
+        seg = self.seg[e]
+        n = self.counts[e]
+        rest = bandwidth - entry_dist
+        # Lixel j tem centro a (j + 0.5) * seg da origem: para frente, j <= rest / seg - 0.5;
+        # para trás, a distância até o centro é length - (j + 0.5) * seg
+        last = np.floor(rest / seg - 0.5 + 1e-9).astype(np.int64)
+        first_back = np.ceil(n - rest / seg - 0.5 - 1e-9).astype(np.int64)
+        lo = np.where(fwd, 0, np.clip(first_back, 0, n))
+        hi = np.where(fwd, np.clip(last + 1, 0, n), n)
+        sizes = hi - lo
+        # Lotes de entradas (em ordem de fonte) com até MAX_LIXEL_PAIRS candidatos
+        bounds = np.searchsorted(np.cumsum(sizes), np.arange(MAX_LIXEL_PAIRS, sizes.sum(), MAX_LIXEL_PAIRS))
+        for block in np.split(np.arange(len(sizes)), bounds):
+            owner, j = _ranges(lo[block], sizes[block])
+            rows = block[owner]
+            t = (j + 0.5) * seg[rows]
+            along = np.where(fwd[rows], t, self.length[e[rows]] - t)
+            yield entry_src[rows], self.edge_ptr[e[rows]] + j, entry_dist[rows] + along
+
+    def kde(self, sources, weights, bandwidth):
+        """
+        KDE restrito à rede por lixel: cada lixel soma weight * exp(-d / bandwidth) das
+        fontes (lixels, sem repetição) a uma distância de rede d <= bandwidth do seu centro.
+        Retorna um array com a densidade de cada lixel.
+        """
+        densities = np.zeros(self.n_lixels)
+        sources = np.asarray(sources, dtype=np.int64)
+        weights = np.asarray(weights, dtype=float)
+        for start in range(0, len(sources), SOURCE_BLOCK):
+            block = sources[start:start + SOURCE_BLOCK]
+            parts = list(self._candidates(block, bandwidth))
+            src = np.concatenate([p[0] for p in parts])
+            lixel = np.concatenate([p[1] for p in parts])
+            dist = np.concatenate([p[2] for p in parts])
+            # Menor distância de cada par (fonte, lixel)
+            order = np.lexsort((dist, lixel, src))
+            src, lixel, dist = src[order], lixel[order], dist[order]
+            first = np.ones(len(src), dtype=bool)
+            first[1:] = (src[1:] != src[:-1]) | (lixel[1:] != lixel[:-1])
+            src, lixel, dist = src[first], lixel[first], dist[first]
+            keep = dist <= bandwidth
+            densities += np.bincount(lixel[keep], weights=weights[start:start + SOURCE_BLOCK][src[keep]] *
+                                     np.exp(-dist[keep] / bandwidth), minlength=self.n_lixels)
+        return densities
+
+    def snapped_kde(self, snapped, bandwidth):
+        """
+        Densidade por lixel a partir de pontos já associados à rede (SnappedPoints).
+        """
+        lixel = self.assign(snapped)
+        sources, counts = np.unique(lixel[lixel >= 0], return_counts=True)
+        return self.kde(sources, counts, bandwidth)
+
+    def node_densities(self, densities):
+        """
+        Densidade de cada nó como a maior entre os lixels que tocam o nó, para os
+        algoritmos que trabalham com nós (PHAR, SHAR). Retorna {id do nó: densidade}.
+        """
+        graph = self.graph
+        values = np.zeros(graph.n_nodes)
+        np.maximum.at(values, self.u, densities[self.edge_ptr[:-1]])
+        np.maximum.at(values, self.v, densities[self.edge_ptr[1:] - 1])
+        return dict(zip(graph.nodes(), values.tolist()))
+
+    def adjacency(self):
+        """
+        Matriz esparsa (simétrica) de vizinhança entre lixels: consecutivos na mesma via
+        ou com uma extremidade no mesmo nó.
+        """
+        from scipy.sparse import coo_matrix
+        within = np.flatnonzero(self.position[1:] > 0) + 1
+        a, b = [within - 1], [within]
+        # Lixels das extremidades ligados ao primeiro lixel encontrado em cada nó
+        ends_node = np.concatenate([self.u, self.v])
+        ends_lixel = np.concatenate([self.edge_ptr[:-1], self.edge_ptr[1:] - 1])
+        order = np.argsort(ends_node, kind='stable')
+        ends_node, ends_lixel = ends_node[order], ends_lixel[order]
+        head = np.searchsorted(ends_node, ends_node)
+        a.append(ends_lixel[head])
+        b.append(ends_lixel)
+        a, b = np.concatenate(a), np.concatenate(b)
+        n = self.n_lixels
+        return coo_matrix((np.ones(2 * len(a)), (np.concatenate([a, b]), np.concatenate([b, a]))),
+                          shape=(n, n)).tocsr()
+
+    def edge_pairs(self, lixels):
+        """
+        Pares (u, v) de ids das vias que contêm os lixels, sem repetição.
+        """
+        c = np.unique(self.edge_of[lixels])
+        ids = self.graph.node_ids
+        return list(zip(ids[self.u[c]].tolist(), ids[self.v[c]].tolist()))
+
+    def geometry(self, epsg=None):
+        """
+        Geometria (segmento reto entre os extremos sobre a geometria da via) de cada
+        lixel, no CRS do grafo ou reprojetada para `epsg`. Calculada uma vez por CRS.
+        """
+        if epsg not in self._geometry:
+            import shapely
+            if None not in self._geometry:
+                lines = self.graph.snap_index.edge_geometry[self.edges][self.edge_of]
+                length = self.length[self.edge_of]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    a = np.nan_to_num(self.start / length)
+                    b = np.nan_to_num(self.end / length, nan=1.0)
+                start = shapely.line_interpolate_point(lines, a, normalized=True)
+                end = shapely.line_interpolate_point(lines, b, normalized=True)
+                coords = np.stack([shapely.get_coordinates(start), shapely.get_coordinates(end)], axis=1)
+                self._geometry[None] = shapely.linestrings(coords)
+            if epsg is not None:
+                import geopandas as gpd
+                crs = self.graph.crs or "EPSG:3857"
+                self._geometry[epsg] = gpd.GeoSeries(self._geometry[None], crs=crs).to_crs(epsg=epsg).values
+        return self._geometry[epsg]
+
+def lixel_densities(G, snapped, bandwidth=200, lixel_length=DEFAULT_LIXEL_LENGTH):
+    """
+    Atalho: (LixelNetwork, densidade por lixel) para os pontos `snapped`.
+    """
+    lixels = LixelNetwork(G, lixel_length)
+    return lixels, lixels.snapped_kde(snapped, bandwidth)
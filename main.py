@@ -1,15 +1,29 @@
+import os
 import streamlit as st
-import geopandas as gpd
+import pandas as pd
 import folium
-from folium.plugins import MarkerCluster
 from streamlit_folium import st_folium
 from datetime import date
-import osmnx as ox
 
+import instrumentation
 from data_utils import load_crime_data, create_geodataframe
-from network_utils import get_osmnx_graph, snap_points_to_network, compute_node_densities
-from algorithms import phar, i_phar, shar, expansive_network
+from crime_store import DEFAULT_DATASET_DIR, dataset_version, list_partitions, read_crime_dataset
+from network_utils import get_compiled_graph, snap_points_to_network, compute_node_densities
+from lixels import LixelNetwork, DEFAULT_LIXEL_LENGTH
+from graph_reduction import REDUCTION_MODES, reduce_graph
+from graph_store import GraphStore
+from result_cache import ResultCache, file_hash
+from filter_index import FilterIndex
+from density_cube import DensityCube
+from algorithms import phar, IncrementalPHAR, shar, expansive_network
+from clustering import CLUSTERING_METHODS
+from sweep import SWEEP_ALGORITHMS, parse_values, run_sweep
+from offline_network import default_cache
+from hotspot_polygons import POLYGON_TYPES, polygons_to_4326
+from map_utils import (EdgeGeometryIndex, add_cluster_edges, add_cluster_lixels, add_cluster_polygons,
+                       add_lixel_densities, add_aggregated_points, MAX_GRID_CELLS)
 from cluster_table import build_cluster_table_polygons, build_cluster_table_subgraphs, show_cluster_table_as_links
+from route_planning import RoutePlanner
 
 
 st.set_page_config('HotSpots',layout='wide')
@@ -21,6 +35,48 @@ NUNES JUNIOR, Francisco Carlos Freire. *Geração de mapas de hotspots em redes
 Disponível em: [http://repositorio.ufc.br/handle/riufc/51515](http://repositorio.ufc.br/handle/riufc/51515)
 """)
 
+@st.cache_resource
+def get_result_cache():
+    """
+    Cache de resultados por estágio, compartilhado entre as reexecuções do Streamlit.
+    """
+    return ResultCache()
+
+# Modos do painel de diagnóstico: desligado não tem custo nas etapas
+DIAGNOSTIC_MODES = {
+    'off': "Desligado",
+    'time': "Tempo e contadores",
+    'memory': "Tempo, contadores e memória (mais lento)",
+}
+
+def show_diagnostics(recorder):
+    """
+    Painel com o tempo, o pico de memória e os contadores de cada etapa da execução,
+    exportáveis como log estruturado (JSON Lines) ou métricas (texto do Prometheus).
+    """
+    recorder.log()
+    with st.expander("Diagnóstico de desempenho", expanded=True):
+        table = recorder.to_dataframe()
+        if table.empty:
+            st.caption("Nenhuma etapa registrada nesta execução.")
+            return
+        st.dataframe(table)
+        st.caption("Etapas servidas pelo cache de resultados contam em 'cache: acertos' e não repetem as subetapas.")
+        col_log, col_metrics = st.columns(2)
+        col_log.download_button("Baixar log (JSON Lines)", recorder.to_json_lines(),
+                                file_name="diagnostico.jsonl", mime="application/json")
+        col_metrics.download_button("Baixar métricas (Prometheus)", recorder.to_metrics_text(),
+                                    file_name="metricas.prom", mime="text/plain")
+
+def run():
+    mode = st.session_state.get('diagnostico', 'off')
+    if mode == 'off':
+        main()
+        return
+    with instrumentation.recording(memory=mode == 'memory') as recorder:
+        main()
+    show_diagnostics(recorder)
+
 def main():
     st.title("Patrulhamento Orientado por HotSposts - POH")
     
@@ -36,207 +92,460 @@ def main():
         "Algoritmo de Geração de Hotspots",
         ["PHAR", "i-PHAR", "SHAR", "Expansive Network"]
     )
+    snap_label = st.sidebar.selectbox(
+        "Associação dos crimes à rede",
+        ["Nó mais próximo", "Projeção na aresta"],
+        help="A projeção na aresta mantém a posição do crime ao longo da rua, útil em quarteirões longos."
+    )
+    snap_mode = "edge" if snap_label == "Projeção na aresta" else "node"
+    density_label = st.sidebar.selectbox(
+        "Modelo de densidade", ["Nós", "Lixels (trechos de rua)"],
+        help="Lixels dividem cada rua em trechos de comprimento fixo; a densidade é calculada no centro "
+             "de cada trecho, sem depender do tamanho dos quarteirões."
+    )
+    use_lixels = density_label != "Nós" and alg_option != "i-PHAR"
+    if use_lixels:
+        lixel_length = st.sidebar.slider("Comprimento do lixel (m)", 25, 100, DEFAULT_LIXEL_LENGTH, step=5)
+        show_lixel_layer = st.sidebar.checkbox("Mostrar densidade por lixel no mapa", value=False)
+    elif density_label != "Nós":
+        st.sidebar.caption("O i-PHAR atualiza as densidades por nó; o modelo por lixels não se aplica.")
+    reduction = st.sidebar.selectbox(
+        "Rede de trabalho", list(REDUCTION_MODES), index=1, format_func=REDUCTION_MODES.get,
+        help="A rede recortada mantém só as ruas a até uma bandwidth (mais a distância de cluster, no SHAR) "
+             "dos crimes filtrados; as densidades são as mesmas da rede completa. A contração junta "
+             "sequências de ruas sem cruzamento em uma única aresta."
+    )
+    cluster_method = st.sidebar.selectbox(
+        "Agrupamento (PHAR/SHAR)", list(CLUSTERING_METHODS), format_func=CLUSTERING_METHODS.get,
+        help="Average linkage exato é o método original. Em cidades grandes com limiar baixo, "
+             "a vizinhança esparsa, o single linkage e o DBSCAN usam memória quase linear."
+    )
+    polygon_type = st.sidebar.selectbox(
+        "Polígono dos hotspots (PHAR/i-PHAR)", list(POLYGON_TYPES), format_func=POLYGON_TYPES.get,
+        help="A envoltória côncava e o buffer das ruas evitam que o hotspot cubra quarteirões vazios."
+    )
+    trace_memory = st.sidebar.checkbox("Medir memória do agrupamento", value=False,
+                                       help="Usa tracemalloc; deixa o agrupamento mais lento.")
+    # Lido em run() antes de main(), pelo session_state
+    st.sidebar.selectbox("Diagnóstico por etapa", list(DIAGNOSTIC_MODES), format_func=DIAGNOSTIC_MODES.get,
+                         key='diagnostico',
+                         help="Registra tempo, contadores e (opcionalmente) pico de memória de cada etapa.")
     
-    uploaded_file = st.file_uploader("Carregue o arquivo CSV com os dados de crime", type=["csv"])
+    data_source = st.sidebar.radio(
+        "Fonte dos dados", ["Arquivo CSV", "Base particionada"],
+        help="A base particionada (gerada com 'python crime_store.py arquivo.csv') lê do disco apenas o município e o período selecionados."
+    )
+    cache = get_result_cache()
+    df_original = None
+    # Na base particionada, município e período já são filtrados na leitura
+    dataset_filters = None
     
-    if uploaded_file is not None:
-        df_original = load_crime_data(uploaded_file)
+    if data_source == "Arquivo CSV":
+        uploaded_file = st.file_uploader("Carregue o arquivo CSV com os dados de crime", type=["csv"])
+        if uploaded_file is not None:
+            source_key = file_hash(uploaded_file)
+            ingest_key = cache.key(source_key)
+            with instrumentation.stage('dados'):
+                df_original = cache.get_or_compute('ingest', ingest_key, lambda: load_crime_data(uploaded_file))
+    else:
+        dataset_dir = st.sidebar.text_input("Diretório da base particionada", DEFAULT_DATASET_DIR)
+        try:
+            version = dataset_version(dataset_dir)
+            partitions = cache.get_or_compute('ingest', ('partitions', dataset_dir, version),
+                                              lambda: list_partitions(dataset_dir))
+        except Exception as e:
+            st.error(f"Não foi possível abrir a base particionada em '{dataset_dir}': {e}")
+            partitions = None
+        if partitions is not None and not partitions.empty:
+            # A base é particionada por UF/MUNICIPIO: municípios homônimos (Santa Luzia MG/PB/MA)
+            # são escolhas distintas
+            muni_list = list(partitions[["UF", "MUNICIPIO"]].drop_duplicates()
+                             .sort_values(["MUNICIPIO", "UF"]).itertuples(index=False, name=None))
+            selected_uf, selected_municipio = st.sidebar.selectbox(
+                "Selecione um MUNICÍPIO/UF", muni_list, format_func=lambda item: f"{item[1]}/{item[0]}"
+            )
+            meses = partitions.loc[(partitions["UF"] == selected_uf) & (partitions["MUNICIPIO"] == selected_municipio),
+                                   "ANO_MES"]
+            meses = meses[meses > 0]
+            if len(meses):
+                primeiro, ultimo = int(meses.min()), int(meses.max())
+                min_date = date(primeiro // 100, primeiro % 100, 1)
+                ultimo = pd.Timestamp(year=ultimo // 100, month=ultimo % 100, day=1) + pd.offsets.MonthEnd(0)
+                date_range = st.sidebar.date_input("Intervalo de datas", [min_date, ultimo.date()])
+            else:
+                date_range = []
+            start_date, end_date = date_range if len(date_range) == 2 else (None, None)
+            source_key = cache.key(dataset_dir, version)
+            dataset_filters = (selected_uf, selected_municipio, date_range)
+            ingest_key = cache.key(source_key, selected_uf, selected_municipio, str(start_date), str(end_date))
+            with instrumentation.stage('dados'):
+                df_original = cache.get_or_compute(
+                    'ingest', ingest_key,
+                    lambda: read_crime_dataset(dataset_dir, uf=selected_uf, municipio=selected_municipio,
+                                               start=start_date, end=end_date)
+                )
+        elif partitions is not None:
+            st.warning(f"A base em '{dataset_dir}' está vazia. Importe um CSV com 'python crime_store.py arquivo.csv {dataset_dir}'.")
+    
+    if df_original is not None:
         st.write("Exemplo de dados:", df_original.head())
+        if df_original.attrs.get('relatorio_limpeza'):
+            with st.expander("Relatório de limpeza dos dados"):
+                st.dataframe(df_original.attrs['relatorio_limpeza'])
         
-        df = df_original.copy()
+        # Índice dos filtros, construído uma vez por conjunto de dados: cada controle só
+        # consulta as linhas já selecionadas, e o DataFrame filtrado é montado no fim
+        with instrumentation.stage('índice de filtros'):
+            index = cache.get_or_compute('filter_index', (ingest_key,), lambda: FilterIndex(df_original))
+        filters = {}
+        rows = None
+        # Linhas do município (todas, na base particionada): universo do cubo de densidades
+        base_rows = None
+        selected_naturezas, selected_faixa1, selected_faixa6 = [], [], []
         
-        # Filtro por MUNICÍPIO (opcional)
-        if "MUNICIPIO" in df.columns:
-            muni_list = sorted(df["MUNICIPIO"].dropna().unique())
-            selected_municipio = st.sidebar.selectbox("Selecione um MUNICÍPIO (opcional)", [""] + muni_list)
-        else:
-            selected_municipio = ""
-        if selected_municipio:
-            df = df[df["MUNICIPIO"] == selected_municipio]
-            uf_valor = df["UF"].iloc[0] if not df["UF"].empty else ""
+        if dataset_filters is not None:
+            uf_valor, selected_municipio, date_range = dataset_filters
             region_query = f"{selected_municipio}, {uf_valor}, Brazil"
         else:
-            region_query = None
+            date_range = []
+            start_date, end_date = None, None
+            # Filtro por MUNICÍPIO (opcional)
+            if "MUNICIPIO" in index:
+                muni_list = index.options("MUNICIPIO")
+                selected_municipio = st.sidebar.selectbox("Selecione um MUNICÍPIO (opcional)", [""] + muni_list)
+            else:
+                selected_municipio = ""
+            if selected_municipio:
+                filters["MUNICIPIO"] = [selected_municipio]
+                rows = base_rows = index.select(filters)
+                uf_valor = df_original["UF"].iloc[rows[0]] if len(rows) else ""
+                region_query = f"{selected_municipio}, {uf_valor}, Brazil"
+            else:
+                region_query = None
         
         # Filtro por natureza principal (opcional)
-        if "DESCR_NATUREZA_PRINCIPAL" in df.columns:
-            naturezas = sorted(df["DESCR_NATUREZA_PRINCIPAL"].dropna().unique())
+        if "DESCR_NATUREZA_PRINCIPAL" in index:
+            naturezas = index.options("DESCR_NATUREZA_PRINCIPAL", rows)
             selected_naturezas = st.sidebar.multiselect("Naturezas (opcional)", naturezas)
             if selected_naturezas:
-                df = df[df["DESCR_NATUREZA_PRINCIPAL"].isin(selected_naturezas)]
+                filters["DESCR_NATUREZA_PRINCIPAL"] = selected_naturezas
+                rows = index.select(filters)
         
         # Filtros para FAIXA_HORA_1 e FAIXA_HORA_6 (opcionais)
-        if "FAIXA_HORA_1" in df.columns:
-            faixas1 = sorted(df["FAIXA_HORA_1"].dropna().unique())
+        if "FAIXA_HORA_1" in index:
+            faixas1 = index.options("FAIXA_HORA_1", rows)
             selected_faixa1 = st.sidebar.multiselect("FAIXA_HORA_1 (opcional)", faixas1)
             if selected_faixa1:
-                df = df[df["FAIXA_HORA_1"].isin(selected_faixa1)]
-        if "FAIXA_HORA_6" in df.columns:
-            faixas6 = sorted(df["FAIXA_HORA_6"].dropna().unique())
+                filters["FAIXA_HORA_1"] = selected_faixa1
+                rows = index.select(filters)
+        if "FAIXA_HORA_6" in index:
+            faixas6 = index.options("FAIXA_HORA_6", rows)
             selected_faixa6 = st.sidebar.multiselect("FAIXA_HORA_6 (opcional)", faixas6)
             if selected_faixa6:
-                df = df[df["FAIXA_HORA_6"].isin(selected_faixa6)]
+                filters["FAIXA_HORA_6"] = selected_faixa6
+                rows = index.select(filters)
         
         # Filtro temporal
-        if "DATETIME_FATO" in df.columns and df["DATETIME_FATO"].notnull().any():
-            min_date = df["DATETIME_FATO"].min().date()
-            max_date = df["DATETIME_FATO"].max().date()
+        bounds = index.time_bounds(rows) if dataset_filters is None else None
+        if bounds is not None:
+            min_date, max_date = bounds[0].date(), bounds[1].date()
             date_range = st.sidebar.date_input("Intervalo de datas (opcional)", [min_date, max_date])
             if len(date_range) == 2:
                 start_date, end_date = date_range
-                df = df[(df["DATETIME_FATO"].dt.date >= start_date) & (df["DATETIME_FATO"].dt.date <= end_date)]
+                rows = index.select(filters, start_date, end_date)
         
-        if df.empty:
+        # Os filtros geram um novo DataFrame; o original em cache não é alterado
+        df = df_original if rows is None else df_original.iloc[rows]
+        filtered = not df.empty
+        if not filtered:
             st.warning("Nenhum dado encontrado com os filtros aplicados. Usando dados originais.")
             df = df_original.copy()
         
-        gdf_crime = create_geodataframe(df)
+        # Chave dos dados filtrados: origem (arquivo ou versão da base) + conjunto de filtros
+        data_key = cache.key(source_key, selected_municipio, selected_naturezas, selected_faixa1,
+                             selected_faixa6, [str(d) for d in date_range])
+        with instrumentation.stage('geodataframe'):
+            gdf_crime = cache.get_or_compute('geodataframe', data_key, lambda: create_geodataframe(df))
         
         if region_query:
+            graph_store = GraphStore()
+            if st.sidebar.button("Baixar novamente a rede viária"):
+                graph_store.invalidate(region_query)
+                cache.invalidate('graph')
             try:
-                G = get_osmnx_graph(region_query)
-                st.write("Rede viária obtida. Número de nós:", len(G.nodes()))
+                # Rede projetada e compilada, lida do disco quando já baixada antes
+                with instrumentation.stage('rede'):
+                    graph = cache.get_or_compute('graph', (region_query,),
+                                                 lambda: get_compiled_graph(region_query, store=graph_store))
+                st.write("Rede viária obtida. Número de nós:", graph.n_nodes)
             except Exception as e:
                 st.error(f"Erro ao obter a rede viária para '{region_query}': {e}")
                 st.warning("Verifique se o município está correto. Não foi possível gerar hotspots baseados na rede.")
-                G = None
+                offline = default_cache()
+                if offline is not None and offline.places:
+                    with st.expander("Regiões cobertas pelo cache local do Overpass (sem acesso à rede)"):
+                        st.dataframe(offline.report().drop(columns='DESCRICAO'))
+                graph = None
         else:
             st.warning("Nenhum MUNICÍPIO selecionado; não foi possível obter a rede viária. Hotspots baseados na rede não serão gerados.")
-            G = None
+            graph = None
         
-        if G is not None:
-            st.write("Calculando densidades (KDE restrito à rede, simplificado)...")
-            densities = compute_node_densities(gdf_crime, G, bandwidth=eps_kde)
+        if graph is not None:
+            # Snap de todos os crimes em uma única consulta ao índice espacial do grafo
+            network_key = (graph.fingerprint(), data_key, snap_mode)
+            with instrumentation.stage('snap'):
+                snapped = cache.get_or_compute('snap', network_key,
+                                               lambda: graph.snap_index.snap_gdf(gdf_crime, mode=snap_mode))
+            # A varredura e o i-PHAR (novos crimes podem cair fora da área) usam a rede completa
+            full_graph, full_snapped = graph, snapped
+            if reduction != 'none' and alg_option != "i-PHAR":
+                buffer = eps_kde + (dist_threshold if alg_option == "SHAR" else 0)
+                with instrumentation.stage('rede de trabalho'):
+                    reduced = cache.get_or_compute('reduced_graph', (*network_key, reduction, buffer),
+                                                   lambda: reduce_graph(graph, snapped, buffer,
+                                                                        contract=reduction == 'contract'))
+                graph, snapped = reduced.graph, reduced.snapped
+                st.caption(f"Rede de trabalho: {graph.n_nodes} de {full_graph.n_nodes} nós, "
+                           f"{graph.n_edges} de {full_graph.n_edges} arestas.")
+            st.write("Calculando densidades (KDE restrito à rede)...")
+            densities_key = cache.key(*network_key, eps_kde, graph.fingerprint())
+            lixel_network = lixel_values = None
+            if use_lixels:
+                with instrumentation.stage('lixels'):
+                    lixel_network = cache.get_or_compute('lixels', (graph.fingerprint(), lixel_length),
+                                                         lambda: LixelNetwork(graph, lixel_length))
+                densities_key = cache.key(densities_key, 'lixels', lixel_length)
+            with instrumentation.stage('densidades'):
+                if use_lixels:
+                    # Densidade por lixel; PHAR e SHAR usam, em cada nó, o maior valor dos lixels vizinhos
+                    lixel_values = cache.get_or_compute('densities', densities_key,
+                                                        lambda: lixel_network.snapped_kde(snapped, eps_kde))
+                    densities = cache.get_or_compute('densities', cache.key(densities_key, 'nós'),
+                                                     lambda: lixel_network.node_densities(lixel_values))
+                elif snap_mode == 'node' and filtered:
+                    # Cubo de densidades do município: mudar natureza, faixas ou datas só soma
+                    # células já calculadas, sem nova busca no grafo. O cubo fica na rede completa
+                    # (não depende do filtro); na rede de trabalho, os valores são os dos nós mantidos
+                    def build_cube():
+                        base_df = df_original if base_rows is None else df_original.iloc[base_rows]
+                        base_snapped = full_graph.snap_index.snap_gdf(create_geodataframe(base_df), mode='node')
+                        return DensityCube(full_graph, base_snapped, index, base_rows, bandwidth=eps_kde)
+                    cube = cache.get_or_compute('density_cube', (full_graph.fingerprint(), ingest_key, selected_municipio, eps_kde),
+                                                build_cube)
+
+                    def cube_densities():
+                        values = cube.densities(filters, start_date, end_date)
+                        if graph is not full_graph:
+                            values = values[reduced.nodes]
+                        return dict(zip(graph.nodes(), values.tolist()))
+                    densities = cache.get_or_compute('densities', densities_key, cube_densities)
+                else:
+                    densities = cache.get_or_compute('densities', densities_key,
+                                                     lambda: compute_node_densities(gdf_crime, graph, bandwidth=eps_kde, snapped=snapped))
+            
+            with st.expander("Varredura de parâmetros"):
+                st.caption("Calcula as distâncias de rede uma única vez, na maior bandwidth, e roda "
+                           "PHAR/Expansive Network para cada combinação.")
+                sweep_bandwidths = parse_values(st.text_input("Bandwidths", "100, 200, 400"), int)
+                sweep_thresholds = parse_values(st.text_input("Limiares de densidade", "1, 3, 10"))
+                sweep_dists = parse_values(st.text_input("Distâncias de cluster (PHAR)", "200, 300, 500"), int)
+                sweep_algorithms = st.multiselect("Algoritmos", list(SWEEP_ALGORITHMS), default=list(SWEEP_ALGORITHMS))
+                if st.button("Executar varredura") and sweep_bandwidths and sweep_thresholds and sweep_algorithms:
+                    sweep_key = (network_key, sweep_bandwidths, sweep_thresholds, sweep_dists or [dist_threshold],
+                                 sweep_algorithms, cluster_method)
+                    bar = st.progress(0.0)
+                    sweep_table = cache.get_or_compute(
+                        'sweep', sweep_key,
+                        lambda: run_sweep(full_graph, full_snapped, sweep_bandwidths, sweep_thresholds, sweep_dists or [dist_threshold],
+                                          algorithms=sweep_algorithms, method=cluster_method, workers=os.cpu_count() or 1,
+                                          progress=lambda done, total: bar.progress(done / total))
+                    )
+                    bar.progress(1.0)
+                    st.dataframe(sweep_table)
+                    st.caption(f"Distâncias de rede calculadas uma vez em "
+                               f"{sweep_table.attrs.get('tempo_distancias', 0):.2f} s.")
             
             st.write(f"Executando algoritmo: {alg_option} ...")
+            points_4326 = gdf_crime.geometry.to_crs(epsg=4326)
+            map_center = [points_4326.y.mean(), points_4326.x.mean()]
+            algorithm_key = (alg_option, densities_key, dens_threshold, dist_threshold, cluster_method)
+            # Matrizes de distância das rotas guardadas entre as reexecuções, por rede
+            planner = cache.get_or_compute('route_planner', (graph.fingerprint(),), lambda: RoutePlanner(graph))
+            
+            def run_with_stats(algorithm, **options):
+                # Guarda, junto do resultado, o tempo e a memória do agrupamento
+                stats = {}
+                result = algorithm(densities, graph, density_threshold=dens_threshold, dist_threshold=dist_threshold,
+                                   method=cluster_method, stats=stats, trace_memory=trace_memory, **options)
+                return result, stats
+            
+            def add_lixel_layer(folium_map):
+                if use_lixels and show_lixel_layer:
+                    shown = add_lixel_densities(folium_map, lixel_network.geometry(4326), lixel_values)
+                    st.caption(f"{shown} de {lixel_network.n_lixels} lixels com densidade positiva no mapa.")
+            
+            def show_cluster_stats(stats):
+                if stats:
+                    st.caption("Agrupamento: " + ", ".join(f"{k}: {v}" for k, v in stats.items() if v is not None))
+            
             if alg_option == "PHAR":
-                polygons = phar(densities, G, density_threshold=dens_threshold, dist_threshold=dist_threshold)
+                with instrumentation.stage('algoritmo'):
+                    polygons, cluster_stats = cache.get_or_compute('algorithm', (*algorithm_key, trace_memory, polygon_type),
+                                                                   lambda: run_with_stats(phar, polygon=polygon_type))
+                show_cluster_stats(cluster_stats)
                 if not polygons:
                     st.warning("Nenhum hotspot foi gerado com o algoritmo PHAR. Verifique os parâmetros.")
                 else:
-                    poly_list = []
-                    for cid, hull in polygons:
-                        hull_4326 = gpd.GeoDataFrame(index=[0], geometry=[hull], crs="EPSG:3857").to_crs(epsg=4326).geometry.iloc[0]
-                        poly_list.append((cid, hull_4326))
-                    m_poly = folium.Map(location=[gdf_crime.to_crs(epsg=4326).geometry.y.mean(),
-                                                  gdf_crime.to_crs(epsg=4326).geometry.x.mean()], zoom_start=12)
-                    for cid, poly_obj in poly_list:
-                        folium.GeoJson(
-                            poly_obj,
-                            style_function=lambda x, color="red": {
-                                "fillColor": color,
-                                "color": color,
-                                "weight": 2,
-                                "fillOpacity": 0.3
-                            },
-                            tooltip=f"Cluster {cid}"
-                        ).add_to(m_poly)
-                    st.subheader("Mapa PHAR (Polígonos)")
-                    st_folium(m_poly, width="100%", height=500)
+                    with instrumentation.stage('mapa'):
+                        # Todos os polígonos reprojetados de uma vez e desenhados em uma camada
+                        poly_list = polygons_to_4326(polygons, crs=graph.crs or "EPSG:3857")
+                        m_poly = folium.Map(location=map_center, zoom_start=12)
+                        add_cluster_polygons(m_poly, poly_list, color="red")
+                        add_lixel_layer(m_poly)
+                        st.subheader("Mapa PHAR (Polígonos)")
+                        st_folium(m_poly, width="100%", height=500)
                     
                     from cluster_table import build_cluster_table_polygons, show_cluster_table_as_links
-                    df_table = build_cluster_table_polygons(poly_list)
+                    with instrumentation.stage('tabela'):
+                        df_table = build_cluster_table_polygons(poly_list, densities=densities, planner=planner)
                     st.subheader("Tabela de Clusters (PHAR)")
                     show_cluster_table_as_links(df_table)
                     
             elif alg_option == "i-PHAR":
-                new_crimes = gdf_crime.geometry
-                polygons = i_phar(densities, G, old_polygons=[], new_crimes=new_crimes,
-                                  bandwidth=eps_kde, density_threshold=dens_threshold, dist_threshold=dist_threshold)
+                # Estado incremental da sessão: densidades e clusters persistem entre as
+                # reexecuções e só são refeitos quando os dados ou os parâmetros mudam
+                state_key = cache.key(algorithm_key, polygon_type)
+                state = st.session_state.get('i_phar')
+                with instrumentation.stage('algoritmo'):
+                    if state is None or state['key'] != state_key:
+                        engine = IncrementalPHAR(graph, densities, bandwidth=eps_kde, density_threshold=dens_threshold,
+                                                 dist_threshold=dist_threshold, method=cluster_method,
+                                                 polygon=polygon_type)
+                        state = {'key': state_key, 'engine': engine, 'applied': set()}
+                        st.session_state['i_phar'] = state
+                engine = state['engine']
+                new_file = st.file_uploader("Novas ocorrências (i-PHAR)", type=["csv"], key="i_phar_new",
+                                            help="Os crimes deste arquivo são somados ao estado atual; só a vizinhança deles é reagrupada.")
+                if new_file is not None:
+                    new_key = file_hash(new_file)
+                    if new_key not in state['applied']:
+                        df_new = load_crime_data(new_file)
+                        # Mesmos filtros da barra lateral (município, natureza, faixas e datas)
+                        new_filters = dict(filters)
+                        if selected_municipio:
+                            new_filters["MUNICIPIO"] = [selected_municipio]
+                        new_rows = FilterIndex(df_new).select(new_filters, start_date, end_date)
+                        if new_rows is not None:
+                            df_new = df_new.iloc[new_rows]
+                        if not df_new.empty:
+                            engine.update(snapped=graph.snap_index.snap_gdf(create_geodataframe(df_new), mode=snap_mode))
+                        state['applied'].add(new_key)
+                    if engine.last_update:
+                        st.caption("Última atualização: " + ", ".join(f"{k}: {v}" for k, v in engine.last_update.items()))
+                polygons = engine.polygons()
                 if not polygons:
                     st.warning("Nenhum hotspot foi gerado com o algoritmo i-PHAR. Verifique os parâmetros.")
                 else:
-                    poly_list = []
-                    for cid, hull in polygons:
-                        hull_4326 = gpd.GeoDataFrame(index=[0], geometry=[hull], crs="EPSG:3857").to_crs(epsg=4326).geometry.iloc[0]
-                        poly_list.append((cid, hull_4326))
-                    m_poly = folium.Map(location=[gdf_crime.to_crs(epsg=4326).geometry.y.mean(),
-                                                  gdf_crime.to_crs(epsg=4326).geometry.x.mean()], zoom_start=12)
-                    for cid, poly_obj in poly_list:
-                        folium.GeoJson(
-                            poly_obj,
-                            style_function=lambda x, color="green": {
-                                "fillColor": color,
-                                "color": color,
-                                "weight": 2,
-                                "fillOpacity": 0.3
-                            },
-                            tooltip=f"Cluster {cid}"
-                        ).add_to(m_poly)
-                    st.subheader("Mapa i-PHAR (Incremental Polígonos)")
-                    st_folium(m_poly, width="100%", height=500)
+                    with instrumentation.stage('mapa'):
+                        # Todos os polígonos reprojetados de uma vez e desenhados em uma camada
+                        poly_list = polygons_to_4326(polygons, crs=graph.crs or "EPSG:3857")
+                        m_poly = folium.Map(location=map_center, zoom_start=12)
+                        add_cluster_polygons(m_poly, poly_list, color="green")
+                        st.subheader("Mapa i-PHAR (Incremental Polígonos)")
+                        st_folium(m_poly, width="100%", height=500)
                     
                     from cluster_table import build_cluster_table_polygons, show_cluster_table_as_links
-                    df_table = build_cluster_table_polygons(poly_list)
+                    with instrumentation.stage('tabela'):
+                        df_table = build_cluster_table_polygons(poly_list, densities=engine.densities(), planner=planner)
                     st.subheader("Tabela de Clusters (i-PHAR)")
                     show_cluster_table_as_links(df_table)
                     
             elif alg_option == "SHAR":
                 from algorithms import shar
-                subgraphs = shar(densities, G, density_threshold=dens_threshold, dist_threshold=dist_threshold)
+                shar_connection = st.sidebar.selectbox(
+                    "Conexão dos subgrafos (SHAR)", ["all_pairs", "mst"],
+                    format_func={"all_pairs": "Caminhos entre todos os pares",
+                                 "mst": "Árvore geradora mínima (menos arestas)"}.get
+                )
+                shar_workers = os.cpu_count() if st.sidebar.checkbox("Processar clusters em paralelo", value=False) else 1
+                with instrumentation.stage('algoritmo'):
+                    subgraphs, cluster_stats = cache.get_or_compute(
+                        'algorithm', (*algorithm_key, trace_memory, shar_connection),
+                        lambda: run_with_stats(shar, connection=shar_connection, workers=shar_workers)
+                    )
+                show_cluster_stats(cluster_stats)
+                if cluster_stats.get('Pares sem caminho'):
+                    st.info(f"{cluster_stats['Pares sem caminho']} pares de nós sem caminho na rede (vias de mão única ou trechos desconectados).")
                 if not subgraphs:
                     st.warning("Nenhum hotspot foi gerado com o algoritmo SHAR. Verifique os parâmetros.")
                 else:
-                    m_shar = folium.Map(location=[gdf_crime.to_crs(epsg=4326).geometry.y.mean(),
-                                                  gdf_crime.to_crs(epsg=4326).geometry.x.mean()], zoom_start=12)
-                    edges_4326 = ox.graph_to_gdfs(G, nodes=False, edges=True).reset_index().to_crs(epsg=4326)
-                    color_list = ["red", "green", "blue", "purple", "orange", "yellow"]
-                    from shapely.geometry import LineString
-                    for cid, edge_pairs in subgraphs:
-                        color = color_list[cid % len(color_list)]
-                        for (u, v) in edge_pairs:
-                            mask_uv = ((edges_4326['u'] == u) & (edges_4326['v'] == v)) | ((edges_4326['u'] == v) & (edges_4326['v'] == u))
-                            row_ = edges_4326[mask_uv]
-                            if not row_.empty:
-                                line = row_.iloc[0].geometry
-                                if isinstance(line, LineString):
-                                    coords = [(pt[1], pt[0]) for pt in line.coords]
-                                    folium.PolyLine(coords, color=color, weight=3, tooltip=f"Cluster {cid}").add_to(m_shar)
-                    st.subheader("Mapa SHAR (Subgraphs)")
-                    st_folium(m_shar, width=700, height=500)
+                    with instrumentation.stage('mapa'):
+                        m_shar = folium.Map(location=map_center, zoom_start=12)
+                        edge_index = cache.get_or_compute('edge_geometry', (graph.fingerprint(),),
+                                                          lambda: EdgeGeometryIndex(graph))
+                        for cid, edge_pairs in subgraphs:
+                            add_cluster_edges(m_shar, edge_index, cid, edge_pairs)
+                        add_lixel_layer(m_shar)
+                        st.subheader("Mapa SHAR (Subgraphs)")
+                        st_folium(m_shar, width=700, height=500)
                     
                     from cluster_table import build_cluster_table_subgraphs, show_cluster_table_as_links
-                    df_table = build_cluster_table_subgraphs(subgraphs, G)
+                    with instrumentation.stage('tabela'):
+                        df_table = build_cluster_table_subgraphs(subgraphs, graph, densities=densities, planner=planner)
                     st.subheader("Tabela de Clusters (SHAR)")
                     show_cluster_table_as_links(df_table)
                     
             elif alg_option == "Expansive Network":
-                from algorithms import expansive_network
-                expansions = expansive_network(densities, G, density_threshold=dens_threshold)
+                from algorithms import expansive_network, expansion_tree
+                field = lixel_values if use_lixels else densities
+                with instrumentation.stage('algoritmo'):
+                    # Árvore de junção por campo de densidades: mudar o limiar é só uma consulta
+                    tree = cache.get_or_compute('merge_tree', (densities_key,),
+                                                lambda: expansion_tree(field, graph, lixel_network))
+                    expansions = cache.get_or_compute('algorithm', algorithm_key,
+                                                      lambda: expansive_network(field, graph, dens_threshold,
+                                                                                lixels=lixel_network, tree=tree))
                 if not expansions:
                     st.warning("Nenhum hotspot foi gerado com o algoritmo Expansive Network. Verifique os parâmetros.")
                 else:
-                    m_exp = folium.Map(location=[gdf_crime.to_crs(epsg=4326).geometry.y.mean(),
-                                                 gdf_crime.to_crs(epsg=4326).geometry.x.mean()], zoom_start=12)
-                    edges_4326 = ox.graph_to_gdfs(G, nodes=False, edges=True).reset_index().to_crs(epsg=4326)
-                    color_list = ["red", "green", "blue", "purple", "orange", "yellow"]
-                    from shapely.geometry import LineString
-                    for c_id, node_set, edge_pairs in expansions:
-                        color = color_list[c_id % len(color_list)]
-                        for (u, v) in edge_pairs:
-                            mask_uv = ((edges_4326['u'] == u) & (edges_4326['v'] == v)) | ((edges_4326['u'] == v) & (edges_4326['v'] == u))
-                            row_ = edges_4326[mask_uv]
-                            if not row_.empty:
-                                line = row_.iloc[0].geometry
-                                if isinstance(line, LineString):
-                                    coords = [(pt[1], pt[0]) for pt in line.coords]
-                                    folium.PolyLine(coords, color=color, weight=3, tooltip=f"Cluster {c_id}").add_to(m_exp)
-                    st.subheader("Mapa Expansive Network")
-                    st_folium(m_exp, width="100%", height=500)
+                    with instrumentation.stage('mapa'):
+                        m_exp = folium.Map(location=map_center, zoom_start=12)
+                        add_lixel_layer(m_exp)
+                        if use_lixels:
+                            # Só os trechos acima do limiar, não as ruas inteiras
+                            lixel_geometry = lixel_network.geometry(4326)
+                            for c_id, node_set, edge_pairs, members in expansions:
+                                add_cluster_lixels(m_exp, lixel_geometry, c_id, members)
+                        else:
+                            edge_index = cache.get_or_compute('edge_geometry', (graph.fingerprint(),),
+                                                              lambda: EdgeGeometryIndex(graph))
+                            for c_id, node_set, edge_pairs in expansions:
+                                add_cluster_edges(m_exp, edge_index, c_id, edge_pairs)
+                        st.subheader("Mapa Expansive Network")
+                        st_folium(m_exp, width="100%", height=500)
                     
                     from cluster_table import build_cluster_table_subgraphs, show_cluster_table_as_links
-                    df_table = build_cluster_table_subgraphs(expansions, G)
+                    with instrumentation.stage('tabela'):
+                        df_table = build_cluster_table_subgraphs(expansions, graph, densities=densities, planner=planner)
                     st.subheader("Tabela de Clusters (Expansive Network)")
                     show_cluster_table_as_links(df_table)
+                    with st.expander("Tamanho e pico de densidade dos clusters"):
+                        ranking = tree.summary(dens_threshold)
+                        st.dataframe(ranking.rename(columns={'Elementos': "Lixels" if use_lixels else "Nós"}))
         else:
             st.warning("Nenhum MUNICÍPIO selecionado ou rede indisponível. Não foi possível gerar hotspots baseados na rede. Exibindo apenas os pontos.")
-            center_lat = gdf_crime.to_crs(epsg=4326).geometry.y.mean()
-            center_lon = gdf_crime.to_crs(epsg=4326).geometry.x.mean()
-            m_ = folium.Map(location=[center_lat, center_lon], zoom_start=12)
-            MarkerCluster().add_to(m_)
-            for _, row in gdf_crime.to_crs(epsg=4326).iterrows():
-                folium.Marker(location=[row.geometry.y, row.geometry.x]).add_to(m_)
-            st_folium(m_, width="100%", height=500)
+            with instrumentation.stage('mapa'):
+                points_4326 = gdf_crime.geometry.to_crs(epsg=4326)
+                lon, lat = points_4326.x.to_numpy(), points_4326.y.to_numpy()
+                m_ = folium.Map(location=[lat.mean(), lon.mean()], zoom_start=12)
+                # Pontos agregados no servidor: o HTML cresce com o número de células, não de crimes
+                point_mode = st.sidebar.radio("Exibição dos pontos (sem rede)", ["Grade", "Mapa de calor"])
+                cell_size = st.sidebar.slider("Tamanho da célula (m)", 100, 5000, 500, step=100)
+                cells, used_size = add_aggregated_points(m_, lon, lat, mode="heatmap" if point_mode == "Mapa de calor" else "grid",
+                                                         cell_size=cell_size)
+                if used_size != cell_size:
+                    st.caption(f"Células ampliadas para {used_size:.0f} m para limitar o mapa a {MAX_GRID_CELLS} células.")
+                st_folium(m_, width="100%", height=500)
         
         if st.button("Exportar hotspots como shapefile"):
             try:
@@ -244,11 +553,14 @@ def main():
                 st.success("Arquivo exportado como 'hotspots_resultantes.shp'")
             except Exception as e:
                 st.error(f"Erro na exportação: {e}")
+        
+        with st.sidebar.expander("Cache de resultados"):
+            st.dataframe(cache.stats())
     else:
         st.warning("Carregue um arquivo CSV para iniciar.")
 
 if __name__ == "__main__":
-    main()
+    run()
 
 
 
@@ -0,0 +1,243 @@
+# map_utils.py
+import json
+
+import numpy as np
+import shapely
+
+from compiled_graph import compile_graph
+
+CLUSTER_COLORS = ["red", "green", "blue", "purple", "orange", "yellow"]
+
+class EdgeGeometryIndex:
+    """
+    Geometrias das arestas de um CompiledGraph já reprojetadas para EPSG:4326 (uma única
+    vez), consultadas por pares (u, v) de ids em qualquer sentido.
+    Com `epsg=None`, as geometrias ficam no CRS do grafo.
+    """
+
+    def __init__(self, G, epsg=4326):
+        self.graph = compile_graph(G)
+        geometry = self.graph.snap_index.edge_geometry
+        if epsg is not None:
+            import geopandas as gpd
+            crs = self.graph.crs or "EPSG:3857"
+            geometry = gpd.GeoSeries(geometry, crs=crs).to_crs(epsg=epsg).values
+        self.geometry = geometry
+
+    def nbytes(self):
+        return int(shapely.get_num_coordinates(self.geometry).sum()) * 16
+
+    def positions(self, pairs):
+        """
+        Posição da aresta de cada par (u, v); se só existir v -> u, usa essa. Entre as
+        duas, vale a primeira na ordem das arestas. -1 quando não há aresta.
+        """
+        graph = self.graph
+        pairs = list(pairs)
+        if not pairs:
+            return np.empty(0, dtype=np.int64)
+        index = graph.index
+        u = np.fromiter((index.get(a, -1) for a, _ in pairs), dtype=np.int64, count=len(pairs))
+        v = np.fromiter((index.get(b, -1) for _, b in pairs), dtype=np.int64, count=len(pairs))
+        known = (u >= 0) & (v >= 0)
+        pos = np.full(len(pairs), -1, dtype=np.int64)
+        forward = graph.find_edges(u[known], v[known])
+        backward = graph.find_edges(v[known], u[known])
+        big = np.iinfo(np.int64).max
+        best = np.minimum(np.where(forward >= 0, forward, big), np.where(backward >= 0, backward, big))
+        pos[known] = np.where(best == big, -1, best)
+        return pos
+
+    def lookup(self, pairs):
+        """
+        Geometrias (EPSG:4326) das arestas dos pares encontrados, sem repetições
+        (pares nos dois sentidos resolvem para a mesma aresta).
+        """
+        pos = self.positions(pairs)
+        return self.geometry[np.unique(pos[pos >= 0])]
+
+def lines_feature_collection(geometries, properties=None):
+    """
+    GeoJSON (dict) FeatureCollection com uma feature por geometria, todas com as mesmas
+    propriedades. A serialização das geometrias é vetorizada (shapely.to_geojson).
+    """
+    props = json.dumps(properties or {})
+    features = ",".join(f'{{"type":"Feature","geometry":{g},"properties":{props}}}'
+                        for g in shapely.to_geojson(geometries))
+    return json.loads(f'{{"type":"FeatureCollection","features":[{features}]}}')
+
+def add_cluster_edges(folium_map, edge_index, c_id, edge_pairs, color=None, weight=3):
+    """
+    Desenha as arestas de um cluster como uma única camada GeoJSON no mapa.
+    Retorna o número de arestas desenhadas.
+    """
+    import folium
+    geometries = edge_index.lookup(edge_pairs)
+    if not len(geometries):
+        return 0
+    color = color or CLUSTER_COLORS[c_id % len(CLUSTER_COLORS)]
+    folium.GeoJson(
+        lines_feature_collection(geometries, {"cluster": int(c_id)}),
+        name=f"Cluster {c_id}",
+        style_function=lambda x, color=color: {"color": color, "weight": weight},
+        tooltip=f"Cluster {c_id}",
+    ).add_to(folium_map)
+    return len(geometries)
+
+def add_cluster_polygons(folium_map, polygons, color="red", name="Hotspots"):
+    """
+    Desenha os polígonos [(cluster, polígono em EPSG:4326)] como uma única camada GeoJSON,
+    com o número do cluster no tooltip. Retorna o número de polígonos desenhados.
+    """
+    import folium
+    if not polygons:
+        return 0
+    features = ",".join(f'{{"type":"Feature","geometry":{g},"properties":{{"cluster":{int(c)}}}}}'
+                        for (c, _), g in zip(polygons, shapely.to_geojson(np.array([p for _, p in polygons]))))
+    folium.GeoJson(
+        json.loads(f'{{"type":"FeatureCollection","features":[{features}]}}'),
+        name=name,
+        style_function=lambda x, color=color: {"fillColor": color, "color": color, "weight": 2, "fillOpacity": 0.3},
+        tooltip=folium.GeoJsonTooltip(fields=["cluster"], aliases=["Cluster"]),
+    ).add_to(folium_map)
+    return len(polygons)
+
+def add_cluster_lixels(folium_map, geometry, c_id, lixels, color=None, weight=4):
+    """
+    Desenha os lixels de um cluster (posições em `geometry`, já em EPSG:4326) como uma
+    única camada GeoJSON. Retorna o número de lixels desenhados.
+    """
+    import folium
+    geometries = geometry[np.asarray(lixels, dtype=np.int64)]
+    if not len(geometries):
+        return 0
+    color = color or CLUSTER_COLORS[c_id % len(CLUSTER_COLORS)]
+    folium.GeoJson(
+        lines_feature_collection(geometries, {"cluster": int(c_id)}),
+        name=f"Cluster {c_id}",
+        style_function=lambda x, color=color: {"color": color, "weight": weight},
+        tooltip=f"Cluster {c_id}",
+    ).add_to(folium_map)
+    return len(geometries)
+
+# Faixas de cor da camada de densidade por lixel
+LIXEL_DENSITY_BINS = 6
+
+def add_lixel_densities(folium_map, geometry, densities, threshold=0.0, bins=LIXEL_DENSITY_BINS):
+    """
+    Desenha a densidade de cada lixel com densidade > `threshold` (geometrias em EPSG:4326).
+    Os lixels são agrupados em `bins` faixas de cor, uma camada GeoJSON por faixa, para
+    que o estilo não precise ser avaliado feature a feature. Retorna o número de lixels.
+    """
+    import folium
+    import branca.colormap as cm
+    densities = np.asarray(densities, dtype=float)
+    shown = np.flatnonzero(densities > threshold)
+    if not len(shown):
+        return 0
+    values = densities[shown]
+    low, high = float(values.min()), float(values.max())
+    colormap = cm.linear.YlOrRd_09.scale(low, max(high, low + 1e-9))
+    colormap.caption = "Densidade por lixel"
+    edges = np.linspace(low, high, bins + 1)
+    which = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, bins - 1)
+    layer = folium.FeatureGroup(name="Densidade por lixel")
+    for b in range(bins):
+        members = shown[which == b]
+        if not len(members):
+            continue
+        color = colormap((edges[b] + edges[b + 1]) / 2)
+        folium.GeoJson(
+            lines_feature_collection(geometry[members], {"faixa": f"{edges[b]:.2f} - {edges[b + 1]:.2f}"}),
+            style_function=lambda x, color=color: {"color": color, "weight": 3, "opacity": 0.8},
+            tooltip=folium.GeoJsonTooltip(fields=["faixa"], aliases=["Densidade"]),
+        ).add_to(layer)
+    layer.add_to(folium_map)
+    colormap.add_to(folium_map)
+    return len(shown)
+
+# Modo agregado (mapa sem rede): número máximo de células enviadas ao navegador
+MAX_GRID_CELLS = 5000
+_EARTH_RADIUS = 6378137.0
+
+def _to_mercator(lon, lat):
+    x = _EARTH_RADIUS * np.radians(lon)
+    y = _EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+def _from_mercator(x, y):
+    return np.degrees(x / _EARTH_RADIUS), np.degrees(np.arctan(np.sinh(y / _EARTH_RADIUS)))
+
+def aggregate_points(lon, lat, cell_size=500, max_cells=MAX_GRID_CELLS):
+    """
+    Agrega pontos (graus) em uma grade quadrada de `cell_size` metros (Web Mercator).
+    Se a grade tiver mais de `max_cells` células ocupadas, o tamanho da célula é dobrado
+    até caber. Retorna (DataFrame com ix, iy, count e a posição média lat/lon dos pontos
+    de cada célula, tamanho da célula usado).
+    """
+    import pandas as pd
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    valid = np.isfinite(lon) & np.isfinite(lat) & (np.abs(lat) < 85)
+    x, y = _to_mercator(lon[valid], lat[valid])
+    while True:
+        ix = np.floor(x / cell_size).astype(np.int64)
+        iy = np.floor(y / cell_size).astype(np.int64)
+        # Chave única por célula (evita np.unique por linhas, bem mais lento); a mesma
+        # origem (x0, y0) é usada no intervalo, na chave e na decodificação
+        x0, y0 = (int(ix.min()), int(iy.min())) if len(iy) else (0, 0)
+        span = int(iy.max()) - y0 + 1 if len(iy) else 1
+        keys, inverse, counts = np.unique((ix - x0) * span + (iy - y0),
+                                          return_inverse=True, return_counts=True)
+        if len(keys) <= max_cells:
+            break
+        cell_size *= 2
+    cells = pd.DataFrame({
+        'ix': keys // span + x0, 'iy': keys % span + y0, 'count': counts,
+        'lat': np.bincount(inverse, weights=lat[valid], minlength=len(keys)) / counts,
+        'lon': np.bincount(inverse, weights=lon[valid], minlength=len(keys)) / counts,
+    })
+    return cells, cell_size
+
+def grid_feature_collection(cells, cell_size):
+    """
+    GeoJSON (dict) com o quadrado (EPSG:4326) de cada célula e a contagem de pontos.
+    """
+    x0 = cells['ix'].to_numpy() * cell_size
+    y0 = cells['iy'].to_numpy() * cell_size
+    xs = np.stack([x0, x0 + cell_size, x0 + cell_size, x0, x0], axis=1)
+    ys = np.stack([y0, y0, y0 + cell_size, y0 + cell_size, y0], axis=1)
+    lon, lat = _from_mercator(xs, ys)
+    polygons = shapely.polygons(np.stack([lon, lat], axis=2))
+    counts = cells['count'].tolist()
+    features = ",".join(f'{{"type":"Feature","geometry":{g},"properties":{{"count":{c}}}}}'
+                        for g, c in zip(shapely.to_geojson(polygons), counts))
+    return json.loads(f'{{"type":"FeatureCollection","features":[{features}]}}')
+
+def add_aggregated_points(folium_map, lon, lat, mode='grid', cell_size=500, max_cells=MAX_GRID_CELLS):
+    """
+    Desenha os pontos agregados no servidor: 'grid' (células coloridas pela contagem)
+    ou 'heatmap' (mapa de calor ponderado pelas contagens). O tamanho do HTML depende
+    do número de células, não do número de pontos. Retorna (células, tamanho da célula).
+    """
+    import folium
+    cells, cell_size = aggregate_points(lon, lat, cell_size, max_cells)
+    if cells.empty:
+        return cells, cell_size
+    if mode == 'heatmap':
+        from folium.plugins import HeatMap
+        HeatMap(cells[['lat', 'lon', 'count']].to_numpy().tolist(), name="Ocorrências").add_to(folium_map)
+        return cells, cell_size
+    import branca.colormap as cm
+    max_count = int(cells['count'].max())
+    colormap = cm.linear.YlOrRd_09.scale(1, max(max_count, 2))
+    colormap.caption = f"Ocorrências por célula de {cell_size:.0f} m"
+    folium.GeoJson(
+        grid_feature_collection(cells, cell_size),
+        name="Ocorrências",
+        style_function=lambda f: {"fillColor": colormap(f["properties"]["count"]), "color": None,
+                                  "weight": 0, "fillOpacity": 0.6},
+        tooltip=folium.GeoJsonTooltip(fields=["count"], aliases=["Ocorrências"]),
+    ).add_to(folium_map)
+    colormap.add_to(folium_map)
+    return cells, cell_size
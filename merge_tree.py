@@ -0,0 +1,145 @@
+# merge_tree.py
+import numpy as np
+import pandas as pd
+
+from compiled_graph import compile_graph
+
+def _symmetric(graph):
+    """
+    Padrão (sem pesos) da vizinhança não direcionada do grafo, em CSR.
+    """
+    matrix = graph.matrix
+    return ((matrix + matrix.T) > 0).tocsr()
+
+class MergeTree:
+    """
+    Árvore de junção dos conjuntos de nível superior de um campo de densidades: os
+    elementos (nós ou lixels) entram em ordem decrescente de densidade e, com union-find,
+    juntam-se aos componentes vizinhos já presentes. Construída uma vez por campo de
+    densidades; os componentes de qualquer limiar saem em tempo proporcional à resposta.
+
+    Cada vértice da árvore é um componente: nasce com um elemento isolado ou na junção de
+    dois ou mais componentes (seus filhos) e morre quando é absorvido. Os elementos ficam
+    em uma ordem em que cada vértice ocupa um trecho contíguo: os trechos dos filhos
+    seguidos dos elementos que entraram diretamente nele, em ordem de entrada.
+    """
+
+    def __init__(self, adjacency, values, min_value=0.0):
+        values = np.asarray(values, dtype=float)
+        self.values = values
+        order = np.argsort(-values, kind='stable')
+        order = order[values[order] > min_value]
+        self.order = order
+        self.sorted_values = values[order]
+        step = np.full(len(values), -1, dtype=np.int64)
+        step[order] = np.arange(len(order))
+        self.step = step
+
+        indptr, indices = adjacency.indptr, adjacency.indices
+        parent = list(range(len(values)))
+
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        vertex_of = {}
+        born, died, peak, children, own = [], [], [], [], []
+        step_list = step.tolist()
+        for s, i in enumerate(order.tolist()):
+            roots = {find(j) for j in indices[indptr[i]:indptr[i + 1]].tolist() if 0 <= step_list[j] < s}
+            merged = sorted(vertex_of.pop(r) for r in roots)
+            if len(merged) == 1:
+                vertex = merged[0]
+            else:
+                vertex = len(born)
+                born.append(s)
+                died.append(len(order))
+                peak.append(s if not merged else min(peak[c] for c in merged))
+                children.append(merged)
+                own.append([])
+                for child in merged:
+                    died[child] = s
+            own[vertex].append(i)
+            for r in roots:
+                parent[r] = i
+            vertex_of[i] = vertex
+
+        # Trechos contíguos de cada vértice (percurso em pós-ordem, sem recursão)
+        n_vertices = len(born)
+        self.born = np.array(born, dtype=np.int64)
+        self.died = np.array(died, dtype=np.int64)
+        self.peak = np.array(peak, dtype=np.int64)
+        self.start = np.zeros(n_vertices, dtype=np.int64)
+        self.own_start = np.zeros(n_vertices, dtype=np.int64)
+        self.end = np.zeros(n_vertices, dtype=np.int64)
+        layout = []
+        for root in np.flatnonzero(self.died == len(order)).tolist():
+            stack = [(root, False)]
+            while stack:
+                vertex, expanded = stack.pop()
+                if not expanded:
+                    self.start[vertex] = len(layout)
+                    stack.append((vertex, True))
+                    stack.extend((c, False) for c in reversed(children[vertex]))
+                else:
+                    self.own_start[vertex] = len(layout)
+                    layout.extend(own[vertex])
+                    self.end[vertex] = len(layout)
+        self.layout = np.array(layout, dtype=np.int64)
+        self.layout_step = step[self.layout] if len(layout) else np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_graph(cls, G, densities):
+        """
+        Árvore das densidades por nó (dict id -> densidade ou array alinhado aos nós),
+        com a vizinhança não direcionada do grafo.
+        """
+        graph = compile_graph(G)
+        if isinstance(densities, dict):
+            values = np.fromiter((densities.get(n, 0.0) for n in graph.nodes()), dtype=float, count=graph.n_nodes)
+        else:
+            values = densities
+        return cls(_symmetric(graph), values)
+
+    def nbytes(self):
+        arrays = (self.values, self.order, self.sorted_values, self.step, self.born, self.died, self.peak,
+                  self.start, self.own_start, self.end, self.layout, self.layout_step)
+        return sum(a.nbytes for a in arrays)
+
+    def _alive(self, threshold):
+        """
+        Quantidade de elementos com densidade >= limiar e os vértices vivos nesse ponto,
+        do maior para o menor pico.
+        """
+        k = int(np.searchsorted(-self.sorted_values, -threshold, side='right'))
+        alive = np.flatnonzero((self.born < k) & (self.died >= k))
+        return k, alive[np.argsort(self.peak[alive], kind='stable')]
+
+    def components(self, threshold):
+        """
+        Componentes com densidade >= limiar: lista de arrays de elementos (índices), do
+        maior para o menor pico de densidade.
+        """
+        k, alive = self._alive(threshold)
+        result = []
+        for vertex in alive.tolist():
+            own_start, end = self.own_start[vertex], self.end[vertex]
+            stop = own_start + np.searchsorted(self.layout_step[own_start:end], k)
+            result.append(self.layout[self.start[vertex]:stop])
+        return result
+
+    def summary(self, threshold):
+        """
+        Tamanho e pico de densidade de cada componente do limiar, na ordem de components().
+        """
+        k, alive = self._alive(threshold)
+        own_start, end = self.own_start[alive], self.end[alive]
+        sizes = own_start - self.start[alive]
+        for i, vertex in enumerate(alive.tolist()):
+            sizes[i] += np.searchsorted(self.layout_step[own_start[i]:end[i]], k)
+        return pd.DataFrame({'Cluster': np.arange(len(alive)), 'Elementos': sizes,
+                             'Densidade máxima': self.sorted_values[self.peak[alive]]})
@@ -1,48 +1,264 @@
 # network_utils.py
 import osmnx as ox
 import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+import instrumentation
+from compiled_graph import compile_graph
+from graph_store import GraphStore
+
+# Limite de células (fontes x nós locais) da matriz de distâncias de cada lote
+MAX_DIJKSTRA_CELLS = 4_000_000
 
 def get_osmnx_graph(region_query):
     """
     Obtém a rede viária via OSMnx para a região especificada e projeta para EPSG:3857.
+    Se o cache local do Overpass (offline_network) cobre a região, a rede é montada
+    dele, sem acesso à rede.
     """
-    G = ox.graph_from_place(region_query, network_type='drive')
+    from offline_network import default_cache
+    offline = default_cache()
+    if offline is not None and offline.covers(region_query):
+        G = offline.graph_from_place(region_query)
+    else:
+        G = ox.graph_from_place(region_query, network_type='drive')
     G = ox.project_graph(G, to_crs='epsg:3857')
     return G
 
-def snap_points_to_network(gdf, G):
+def get_compiled_graph(region_query, store=None):
+    """
+    Rede viária compilada da região, lida do armazenamento em disco quando disponível.
+    Caso contrário, obtém via OSMnx, projeta, compila e salva para as próximas sessões.
+    """
+    store = store if store is not None else GraphStore()
+    graph = store.load(region_query)
+    if graph is None:
+        graph = compile_graph(get_osmnx_graph(region_query))
+        store.save(region_query, graph)
+    return graph
+
+def snap_points_to_network(gdf, G, mode='node'):
     """
-    'Snap' dos pontos de crime aos nós da rede viária, convertendo para EPSG:3857.
+    'Snap' dos pontos de crime à rede viária, convertendo para EPSG:3857.
+    mode 'node': adiciona a coluna 'nearest_node'.
+    mode 'edge': adiciona 'edge_u', 'edge_v' e 'edge_offset' (metros a partir de edge_u).
+    Usa o índice espacial persistente do grafo (CompiledGraph.snap_index).
     """
+    graph = compile_graph(G)
     gdf = gdf.to_crs(epsg=3857)
-    x_coords = gdf.geometry.x.values
-    y_coords = gdf.geometry.y.values
-    nearest_node_ids = ox.distance.nearest_nodes(G, X=x_coords, Y=y_coords)
-    gdf['nearest_node'] = nearest_node_ids
+    snapped = graph.snap_index.snap_gdf(gdf, mode=mode)
+    if mode == 'node':
+        gdf['nearest_node'] = graph.node_ids[snapped.node]
+    else:
+        gdf['edge_u'], gdf['edge_v'] = snapped.edge_ends(graph)
+        gdf['edge_offset'] = snapped.offset
     return gdf
 
-def compute_node_densities(gdf_crimes, G, bandwidth=200):
-    """
-    Implementa uma versão simplificada de KDE restrito à rede.
-    Para cada nó, soma contribuições dos crimes com decaimento exponencial.
-    """
-    densities = {node: 0.0 for node in G.nodes()}
-    gdf_crimes = gdf_crimes.to_crs(epsg=3857)
-    crime_coords = [(geom.x, geom.y) for geom in gdf_crimes.geometry]
-    for (cx, cy) in crime_coords:
-        nearest_node = ox.distance.nearest_nodes(G, X=[cx], Y=[cy])[0]
-        visited = set()
-        queue = [(nearest_node, 0)]
-        while queue:
-            current, dist = queue.pop()
-            if current in visited:
-                continue
-            visited.add(current)
-            decay = np.exp(-dist / bandwidth)
-            densities[current] += decay
-            for neighbor in G[current]:
-                edge_length = G[current][neighbor][0].get('length', 1)
-                ndist = dist + edge_length
-                if ndist <= bandwidth:
-                    queue.append((neighbor, ndist))
+def _euclidean_reach(graph, bandwidth):
+    """
+    Raio euclidiano que contém todos os nós a até `bandwidth` metros de rede.
+    Usa a maior razão entre a distância em linha reta e o comprimento das arestas,
+    o que torna o corte exato mesmo com a distorção da projeção EPSG:3857.
+    """
+    rows = np.repeat(np.arange(graph.n_nodes), np.diff(graph.indptr))
+    cols = graph.indices
+    chord = np.hypot(graph.x[rows] - graph.x[cols], graph.y[rows] - graph.y[cols])
+    positive = graph.lengths > 0
+    if not positive.any():
+        return np.inf
+    if np.any(chord[~positive] > 0):
+        return np.inf
+    scale = max(1.0, float(np.max(chord[positive] / graph.lengths[positive])))
+    return bandwidth * scale
+
+def _iter_source_distances(graph, sources, bandwidth):
+    """
+    Gera, em lotes, as distâncias de rede (limitadas a `bandwidth`) de cada fonte.
+    As fontes são agrupadas em blocos espaciais e cada bloco roda o Dijkstra apenas
+    no subgrafo dos nós alcançáveis em linha reta, sem perder exatidão.
+    Produz tuplas (posições das fontes, índices dos nós locais, matriz de distâncias).
+    """
+    x, y, matrix = graph.x, graph.y, graph.matrix
+    reach = _euclidean_reach(graph, bandwidth)
+    if not np.isfinite(reach):
+        tiles = [np.arange(len(sources))]
+    else:
+        tile_size = 2 * reach
+        gx = np.floor((x[sources] - x.min()) / tile_size).astype(np.int64)
+        gy = np.floor((y[sources] - y.min()) / tile_size).astype(np.int64)
+        keys = gx * (gy.max() + 1) + gy
+        order = np.argsort(keys, kind='stable')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        tiles = np.split(order, bounds)
+    x_order = np.argsort(x, kind='stable')
+    x_sorted = x[x_order]
+    for tile in tiles:
+        src = sources[tile]
+        if np.isfinite(reach):
+            lo = np.searchsorted(x_sorted, x[src].min() - reach, side='left')
+            hi = np.searchsorted(x_sorted, x[src].max() + reach, side='right')
+            local = x_order[lo:hi]
+            in_y = (y[local] >= y[src].min() - reach) & (y[local] <= y[src].max() + reach)
+            local = np.sort(local[in_y])
+            submatrix = matrix[local][:, local]
+            local_src = np.searchsorted(local, src)
+        else:
+            local = np.arange(graph.n_nodes)
+            submatrix = matrix
+            local_src = src
+        step = max(1, MAX_DIJKSTRA_CELLS // max(len(local), 1))
+        for start in range(0, len(tile), step):
+            dist = dijkstra(submatrix, directed=True, indices=local_src[start:start + step], limit=bandwidth)
+            if instrumentation.enabled():
+                instrumentation.count('buscas dijkstra', len(dist))
+                instrumentation.count('nós alcançados', int(np.isfinite(dist).sum()))
+            yield tile[start:start + step], local, dist
+
+def network_kde(graph, sources, weights, bandwidth):
+    """
+    KDE restrito à rede com múltiplas fontes ponderadas.
+    sources: índices (posições) dos nós de origem, sem repetição.
+    weights: peso de cada fonte (ex.: número de crimes no nó).
+    Retorna um array com a densidade de cada nó, somando weight * exp(-d / bandwidth)
+    para toda fonte a uma distância de rede d <= bandwidth.
+    """
+    densities = np.zeros(graph.n_nodes)
+    sources = np.asarray(sources, dtype=np.int64)
+    weights = np.asarray(weights, dtype=float)
+    if len(sources) == 0:
+        return densities
+    for positions, local, dist in _iter_source_distances(graph, sources, bandwidth):
+        # exp(-inf) = 0: nós fora do alcance não contribuem
+        densities[local] += weights[positions] @ np.exp(-dist / bandwidth)
+    return densities
+
+def _distance_triplets(graph, sources, bandwidth):
+    """
+    Distâncias de rede <= bandwidth de cada fonte, no formato esparso
+    (posição da fonte, índice do nó, distância), ordenado por fonte.
+    """
+    rows, cols, dists = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for positions, local, dist in _iter_source_distances(graph, sources, bandwidth):
+        r, c = np.nonzero(np.isfinite(dist))
+        rows.append(positions[r])
+        cols.append(local[c])
+        dists.append(dist[r, c])
+    rows, cols, dists = np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+    order = np.argsort(rows, kind='stable')
+    return rows[order], cols[order], dists[order]
+
+def _expand_rows(row_ptr, rows):
+    """
+    Posições (nos arrays de triplets) de todas as entradas das linhas pedidas, em sequência.
+    """
+    lengths = row_ptr[rows + 1] - row_ptr[rows]
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owner, row_ptr[rows][owner] + within
+
+def edge_seed_nodes(graph, edges):
+    """
+    Nós de onde partem as buscas do edge_kde para pontos nas arestas `edges`: o destino
+    de cada aresta e, nas vias de mão dupla, também a origem.
+    """
+    edges = np.unique(np.asarray(edges, dtype=np.int64))
+    u = graph.edge_sources[edges]
+    v = graph.indices[edges]
+    two_way = graph.find_edges(v, u) >= 0
+    return np.unique(np.concatenate([v, u[two_way]]))
+
+def edge_kde(graph, edges, offsets, bandwidth, weights=None, triplets=None):
+    """
+    KDE restrito à rede para pontos projetados nas arestas.
+    edges: posição da aresta (u -> v) de cada ponto; offsets: metros a partir de u.
+    O ponto chega a v após (comprimento - offset) e, se a via for de mão dupla, a u após
+    offset; cada nó usa a menor das duas distâncias. Os pontos são agrupados por aresta e
+    cada nó extremo roda uma única busca limitada à bandwidth; as contribuições de todos os
+    pontos de uma aresta saem de somas prefixadas, ordenadas por offset.
+    `triplets` (seed_nodes, rows, cols, dists) permite reaproveitar distâncias já calculadas
+    a partir de edge_seed_nodes com uma bandwidth maior ou igual.
+    """
+    densities = np.zeros(graph.n_nodes)
+    edges = np.asarray(edges, dtype=np.int64)
+    if len(edges) == 0:
+        return densities
+    weights = np.ones(len(edges)) if weights is None else np.asarray(weights, dtype=float)
+    offsets = np.clip(np.asarray(offsets, dtype=float), 0, graph.lengths[edges])
+    order = np.lexsort((offsets, edges))
+    edges, offsets, weights = edges[order], offsets[order], weights[order]
+    group_edges, starts, counts = np.unique(edges, return_index=True, return_counts=True)
+    ends = starts + counts
+    u = graph.edge_sources[group_edges]
+    v = graph.indices[group_edges]
+    length = graph.lengths[group_edges]
+    two_way = graph.find_edges(v, u) >= 0
+
+    if triplets is None:
+        seed_nodes = np.unique(np.concatenate([v, u[two_way]]))
+        rows, cols, dists = _distance_triplets(graph, seed_nodes, bandwidth)
+    else:
+        seed_nodes, rows, cols, dists = triplets
+    row_ptr = np.searchsorted(rows, np.arange(len(seed_nodes) + 1))
+    # Entradas (grupo, nó) alcançadas a partir de v e, nas vias de mão dupla, de u
+    g_v, pos_v = _expand_rows(row_ptr, np.searchsorted(seed_nodes, v))
+    two_way_groups = np.flatnonzero(two_way)
+    g_u, pos_u = _expand_rows(row_ptr, np.searchsorted(seed_nodes, u[two_way_groups]))
+    g_u = two_way_groups[g_u]
+    keys, inverse = np.unique(np.concatenate([g_v * graph.n_nodes + cols[pos_v],
+                                              g_u * graph.n_nodes + cols[pos_u]]), return_inverse=True)
+    dv = np.full(len(keys), np.inf)
+    du = np.full(len(keys), np.inf)
+    dv[inverse[:len(pos_v)]] = dists[pos_v]
+    du[inverse[len(pos_v):]] = dists[pos_u]
+    group, node = keys // graph.n_nodes, keys % graph.n_nodes
+
+    # Offsets abaixo de tau chegam mais rápido pelo lado de u; os demais, pelo lado de v
+    L = length[group]
+    with np.errstate(invalid='ignore'):
+        tau = (L + dv - du) / 2
+    span = float(length.max()) + 2.0
+    group_keys = np.repeat(np.arange(len(group_edges)), counts) * span + offsets
+    base = group * span
+
+    def lookup(value, side):
+        return np.searchsorted(group_keys, base + np.clip(value, -0.5, L + 0.5), side=side)
+
+    via_u = np.concatenate([[0.0], np.cumsum(weights * np.exp(-offsets / bandwidth))])
+    via_v = np.concatenate([[0.0], np.cumsum(weights * np.exp(-(graph.lengths[edges] - offsets) / bandwidth))])
+    end_u = np.minimum(lookup(tau, 'left'), lookup(bandwidth - du, 'right'))
+    start_v = np.maximum(lookup(tau, 'left'), lookup(L + dv - bandwidth, 'left'))
+    contrib = (np.exp(-du / bandwidth) * (via_u[end_u] - via_u[starts[group]]) +
+               np.exp(-dv / bandwidth) * (via_v[ends[group]] - via_v[start_v]))
+    densities += np.bincount(node, weights=contrib, minlength=graph.n_nodes)
     return densities
+
+def snapped_kde(graph, snapped, bandwidth):
+    """
+    Densidade por nó (array) a partir de pontos já associados à rede (SnappedPoints).
+    """
+    if snapped.mode == 'node':
+        sources, counts = np.unique(snapped.node, return_counts=True)
+        return network_kde(graph, sources, counts, bandwidth)
+    return edge_kde(graph, snapped.edge, snapped.offset, bandwidth)
+
+def compute_node_densities(gdf_crimes, G, bandwidth=200, snapped=None, snap_mode='node'):
+    """
+    Implementa KDE restrito à rede.
+    Todos os crimes são associados à rede em uma única consulta ao índice espacial e
+    agrupados por nó; cada nó de origem roda uma única busca de caminhos mínimos
+    limitada à bandwidth. Cada nó soma as contribuições com decaimento exponencial
+    pela distância de rede mínima.
+    G pode ser o grafo do OSMnx ou um CompiledGraph. `snapped` (SnappedPoints) permite
+    reaproveitar posições já associadas à rede; sem ele, os crimes são associados no
+    modo `snap_mode` ('node' ou 'edge').
+    """
+    graph = compile_graph(G)
+    if snapped is None:
+        if len(gdf_crimes) == 0:
+            return {node: 0.0 for node in graph.nodes()}
+        with instrumentation.stage('snap'):
+            snapped = graph.snap_index.snap_gdf(gdf_crimes, mode=snap_mode)
+    with instrumentation.stage('kde'):
+        instrumentation.count('crimes associados', len(snapped))
+        densities = snapped_kde(graph, snapped, bandwidth)
+    return dict(zip(graph.nodes(), densities.tolist()))
@@ -0,0 +1,353 @@
+# offline_network.py
+import glob
+import json
+import os
+import re
+import unicodedata
+from itertools import groupby
+
+import networkx as nx
+import numpy as np
+
+# Cache de respostas do OSMnx distribuído com o repositório
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+# Fração mínima do polígono do município coberta pelas respostas do Overpass
+MIN_COVERAGE = 0.99
+# Buffer (m) em volta do polígono, como no graph_from_polygon do OSMnx
+POLYGON_BUFFER = 500
+
+# Filtro da rede 'drive' do OSMnx: as respostas em cache já vêm filtradas, mas o
+# filtro é reaplicado para que respostas de outros tipos de rede não entrem
+_EXCLUDED = {
+    'highway': {'abandoned', 'bridleway', 'bus_guideway', 'construction', 'corridor', 'cycleway', 'elevator',
+                'escalator', 'footway', 'no', 'path', 'pedestrian', 'planned', 'platform', 'proposed', 'raceway',
+                'razed', 'rest_area', 'service', 'services', 'steps', 'track'},
+    'area': {'yes'},
+    'access': {'private'},
+    'motor_vehicle': {'no'},
+    'motorcar': {'no'},
+    'service': {'alley', 'driveway', 'emergency_access', 'parking', 'parking_aisle', 'private'},
+}
+# Valores de 'oneway' (mão única e mão invertida) usados pelo OSMnx
+_ONEWAY_VALUES = {'yes', 'true', '1', '-1', 'reverse', 'T', 'F'}
+_REVERSED_VALUES = {'-1', 'reverse', 'T'}
+
+UF_NAMES = {
+    'AC': 'Acre', 'AL': 'Alagoas', 'AP': 'Amapá', 'AM': 'Amazonas', 'BA': 'Bahia', 'CE': 'Ceará',
+    'DF': 'Distrito Federal', 'ES': 'Espírito Santo', 'GO': 'Goiás', 'MA': 'Maranhão', 'MT': 'Mato Grosso',
+    'MS': 'Mato Grosso do Sul', 'MG': 'Minas Gerais', 'PA': 'Pará', 'PB': 'Paraíba', 'PR': 'Paraná',
+    'PE': 'Pernambuco', 'PI': 'Piauí', 'RJ': 'Rio de Janeiro', 'RN': 'Rio Grande do Norte',
+    'RS': 'Rio Grande do Sul', 'RO': 'Rondônia', 'RR': 'Roraima', 'SC': 'Santa Catarina', 'SP': 'São Paulo',
+    'SE': 'Sergipe', 'TO': 'Tocantins',
+}
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+def _normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(text.upper().split())
+
+def iter_elements(path, chunk_size=1 << 20):
+    """
+    Lê os elementos ('elements') de uma resposta do Overpass um a um, sem carregar o
+    arquivo inteiro: o texto é lido em blocos de `chunk_size` caracteres e cada
+    elemento é decodificado com JSONDecoder.raw_decode. A memória fica limitada a um
+    bloco mais o maior elemento.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer = ''
+        while True:
+            more = f.read(chunk_size)
+            buffer += more
+            start = buffer.find('"elements"')
+            if start >= 0:
+                bracket = buffer.find('[', start)
+                if bracket >= 0:
+                    break
+            if not more:
+                return
+            # Mantém só o final, caso a chave esteja dividida entre dois blocos
+            buffer = buffer[-16:] if start < 0 else buffer[start:]
+        pos = bracket + 1
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if pos >= len(buffer):
+                more = f.read(chunk_size)
+                if not more:
+                    raise ValueError(f"Resposta do Overpass truncada: {path}")
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield element
+            pos = end
+
+def _is_drive(tags):
+    if 'highway' not in tags:
+        return False
+    return not any(tags.get(key) in values for key, values in _EXCLUDED.items())
+
+def _is_overpass(path):
+    with open(path, encoding='utf-8') as f:
+        head = f.read(300)
+    return head.lstrip().startswith('{') and 'Overpass' in head
+
+class OverpassCache:
+    """
+    Índice das respostas do OSMnx em `cache_dir`: lugares do Nominatim (nome, tipo e
+    polígono de cada resultado) e respostas do Overpass (extensão dos nós, número de
+    nós e vias). Permite montar a rede 'drive' de um município sem acesso à rede,
+    como o ox.graph_from_place faria, e informar quais regiões o cache cobre.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.places = []
+        self.responses = []
+        for path in sorted(glob.glob(os.path.join(cache_dir, '*.json'))):
+            if _is_overpass(path):
+                self.responses.append(self._index_response(path))
+            else:
+                self._index_places(path)
+
+    @staticmethod
+    def _index_response(path):
+        lon_min = lat_min = np.inf
+        lon_max = lat_max = -np.inf
+        n_nodes = n_ways = 0
+        for element in iter_elements(path):
+            if element.get('type') == 'node':
+                n_nodes += 1
+                lon, lat = element['lon'], element['lat']
+                lon_min, lon_max = min(lon_min, lon), max(lon_max, lon)
+                lat_min, lat_max = min(lat_min, lat), max(lat_max, lat)
+            elif element.get('type') == 'way':
+                n_ways += 1
+        bounds = (lon_min, lat_min, lon_max, lat_max) if n_nodes else None
+        return {'path': path, 'bounds': bounds, 'nodes': n_nodes, 'ways': n_ways}
+
+    def _index_places(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(results, list):
+            return
+        for result in results:
+            if not isinstance(result, dict) or (result.get('geojson') or {}).get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            display_name = result.get('display_name', '')
+            self.places.append({'path': path, 'name': display_name.split(',')[0].strip(),
+                                'display_name': display_name, 'type': result.get('addresstype'),
+                                'geojson': result['geojson']})
+
+    def find_place(self, region_query):
+        """
+        Primeiro resultado com polígono do Nominatim para a consulta "MUNICÍPIO, UF, país"
+        (o mesmo que o OSMnx usaria), ou None. Nome e UF são comparados sem acentos.
+        """
+        parts = [p.strip() for p in str(region_query).split(',') if p.strip()]
+        if not parts:
+            return None
+        name = _normalize(parts[0])
+        state = UF_NAMES.get(parts[1].upper(), parts[1]) if len(parts) > 2 else None
+        for place in self.places:
+            if _normalize(place['name']) != name:
+                continue
+            if state and _normalize(state) not in _normalize(place['display_name']):
+                continue
+            return place
+        return None
+
+    def polygon(self, region_query):
+        from shapely.geometry import shape
+        place = self.find_place(region_query)
+        return shape(place['geojson']) if place is not None else None
+
+    def _responses_for(self, polygon):
+        from shapely.geometry import box
+        return [r for r in self.responses if r['bounds'] is not None and box(*r['bounds']).intersects(polygon)]
+
+    def coverage(self, region_query):
+        """
+        Fração da área do polígono do município coberta pelas respostas do Overpass
+        (pela extensão dos nós de cada resposta); 0 se o lugar não está no cache.
+        """
+        polygon = self.polygon(region_query)
+        return self._coverage(polygon) if polygon is not None else 0.0
+
+    def _coverage(self, polygon):
+        from shapely import box, union_all
+        responses = self._responses_for(polygon)
+        if not responses or polygon.area == 0:
+            return 0.0
+        covered = union_all([box(*r['bounds']) for r in responses]).intersection(polygon)
+        return covered.area / polygon.area
+
+    def covers(self, region_query, min_coverage=MIN_COVERAGE):
+        return self.coverage(region_query) >= min_coverage
+
+    def report(self):
+        """
+        DataFrame com os lugares do cache: nome, tipo, respostas do Overpass que os
+        interceptam, nós nessas respostas e fração do polígono coberta.
+        """
+        import pandas as pd
+        from shapely.geometry import shape
+        rows = []
+        for place in self.places:
+            polygon = shape(place['geojson'])
+            responses = self._responses_for(polygon)
+            rows.append({'LUGAR': place['name'], 'TIPO': place['type'], 'DESCRICAO': place['display_name'],
+                         'RESPOSTAS_OVERPASS': len(responses), 'NOS_OSM': sum(r['nodes'] for r in responses),
+                         'COBERTURA': round(self._coverage(polygon), 4)})
+        return pd.DataFrame(rows, columns=['LUGAR', 'TIPO', 'DESCRICAO', 'RESPOSTAS_OVERPASS', 'NOS_OSM',
+                                           'COBERTURA'])
+
+    def covered_places(self, min_coverage=MIN_COVERAGE):
+        """
+        Nomes dos lugares cobertos pelo cache, sem repetição.
+        """
+        report = self.report()
+        return sorted(set(report.loc[report['COBERTURA'] >= min_coverage, 'LUGAR']))
+
+    def graph_from_place(self, region_query, min_coverage=MIN_COVERAGE):
+        """
+        Rede 'drive' do município (MultiDiGraph em EPSG:4326, simplificada), montada só
+        com o cache, nas mesmas etapas do ox.graph_from_polygon: recorte pelo polígono com
+        buffer de 500 m, maior componente, simplificação, recorte pelo polígono original.
+        Falha com LookupError se o cache cobre menos que `min_coverage` do município.
+        """
+        import osmnx as ox
+        polygon = self.polygon(region_query)
+        if polygon is None:
+            raise LookupError(f"'{region_query}' não está no cache local ({self.cache_dir}).")
+        coverage = self._coverage(polygon)
+        if coverage < min_coverage:
+            raise LookupError(f"O cache local cobre só {coverage:.0%} de '{region_query}'.")
+        projected, crs_utm = ox.projection.project_geometry(polygon)
+        buffered, _ = ox.projection.project_geometry(projected.buffer(POLYGON_BUFFER), crs=crs_utm, to_latlong=True)
+        G_buff = build_drive_graph([r['path'] for r in self._responses_for(buffered)], polygon=buffered,
+                                   retain_all=False)
+        G_buff = ox.simplify_graph(G_buff)
+        G = ox.truncate.truncate_graph_polygon(G_buff, polygon)
+        G = ox.truncate.largest_component(G, strongly=False)
+        nx.set_node_attributes(G, values=ox.stats.count_streets_per_node(G_buff, nodes=G.nodes),
+                               name='street_count')
+        return G
+
+def build_drive_graph(paths, polygon=None, retain_all=True):
+    """
+    MultiDiGraph (EPSG:4326, não simplificado, com 'length' em metros) das vias de carro
+    nas respostas do Overpass `paths`, no formato do OSMnx: atributos úteis de nós e
+    vias, mão única pelo tag oneway (e rotatórias) e arestas nos dois sentidos nas vias
+    de mão dupla. Nós e vias repetidos entre respostas entram uma vez.
+    `polygon` descarta, já na leitura, os nós fora dele (como truncate_graph_polygon, sem
+    truncate_by_edge); sem `retain_all`, fica só a maior componente fracamente conexa.
+    Os dois recortes são feitos antes de criar o grafo do networkx, que é montado uma vez.
+    """
+    import osmnx as ox
+    import shapely
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    node_tags, way_tags = ox.settings.useful_tags_node, ox.settings.useful_tags_way
+    bounds = polygon.bounds if polygon is not None else None
+    nodes, ways = {}, {}
+    for path in paths:
+        for element in iter_elements(path):
+            kind = element.get('type')
+            tags = element.get('tags', {})
+            if kind == 'node':
+                lon, lat = element['lon'], element['lat']
+                if bounds is not None and not (bounds[0] <= lon <= bounds[2] and bounds[1] <= lat <= bounds[3]):
+                    continue
+                node = {'y': lat, 'x': lon}
+                node.update((t, tags[t]) for t in node_tags if t in tags)
+                nodes[element['id']] = node
+            elif kind == 'way' and element['id'] not in ways and _is_drive(tags):
+                way = {'osmid': element['id']}
+                way.update((t, tags[t]) for t in way_tags if t in tags)
+                way['nodes'] = [n for n, _ in groupby(element.get('nodes', []))]
+                ways[element['id']] = way
+    if polygon is not None and nodes:
+        shapely.prepare(polygon)
+        xy = np.array([(n['x'], n['y']) for n in nodes.values()])
+        inside = shapely.intersects_xy(polygon, xy[:, 0], xy[:, 1])
+        nodes = {osmid: node for (osmid, node), keep in zip(nodes.items(), inside.tolist()) if keep}
+
+    # Trechos (u, v) de cada via no sentido de circulação
+    segments = []
+    for way in ways.values():
+        sequence = way.pop('nodes')
+        oneway = way.get('oneway') in _ONEWAY_VALUES or way.get('junction') == 'roundabout'
+        if oneway and way.get('oneway') in _REVERSED_VALUES:
+            sequence.reverse()
+        way['oneway'] = oneway
+        segments.append((way, [(u, v) for u, v in zip(sequence[:-1], sequence[1:]) if u in nodes and v in nodes]))
+    if not retain_all:
+        used = {n for _, edges in segments for edge in edges for n in edge}
+        ids = np.fromiter(used, dtype=np.int64, count=len(used))
+        if len(ids):
+            position = dict(zip(ids.tolist(), range(len(ids))))
+            pairs = np.array([(position[u], position[v]) for _, edges in segments for u, v in edges], dtype=np.int64)
+            adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(ids), len(ids)))
+            _, labels = connected_components(adjacency, directed=True, connection='weak')
+            keep = set(ids[labels == np.bincount(labels).argmax()].tolist())
+            segments = [(way, [(u, v) for u, v in edges if u in keep]) for way, edges in segments]
+            nodes = {osmid: node for osmid, node in nodes.items() if osmid in keep}
+
+    G = nx.MultiDiGraph(crs=ox.settings.default_crs, created_with="poh offline_network")
+    G.add_nodes_from(nodes.items())
+    for way, edges in segments:
+        G.add_edges_from(edges, **way, reversed=False)
+        if not way['oneway']:
+            G.add_edges_from([(v, u) for u, v in edges], **way, reversed=True)
+    G.remove_nodes_from([n for n, degree in G.degree() if degree == 0])
+    if G.number_of_edges():
+        G = ox.distance.add_edge_lengths(G)
+    return G
+
+_default_cache = {}
+
+def default_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    OverpassCache do diretório, indexado uma vez por processo; None se o diretório não existe.
+    """
+    if not os.path.isdir(cache_dir):
+        return None
+    if cache_dir not in _default_cache:
+        _default_cache[cache_dir] = OverpassCache(cache_dir)
+    return _default_cache[cache_dir]
+
+if __name__ == "__main__":
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(description="Redes viárias a partir do cache local do Overpass, sem acesso à rede.")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIR, help="Diretório com as respostas do OSMnx")
+    parser.add_argument('--municipio', nargs='*', default=[],
+                        help='Consultas "MUNICÍPIO, UF, Brazil" a montar e salvar no GraphStore')
+    parser.add_argument('--redes', help="Diretório do GraphStore")
+    args = parser.parse_args()
+    cache = OverpassCache(args.cache)
+    with pd.option_context('display.width', 200, 'display.max_colwidth', 60):
+        print(cache.report().drop(columns='DESCRICAO').to_string(index=False))
+    if args.municipio:
+        import osmnx as ox
+        from compiled_graph import compile_graph
+        from graph_store import DEFAULT_STORE_DIR, GraphStore
+        store = GraphStore(args.redes or DEFAULT_STORE_DIR)
+        for query in args.municipio:
+            G = ox.project_graph(cache.graph_from_place(query), to_crs='epsg:3857')
+            store.save(query, compile_graph(G))
+            print(f"{query}: {G.number_of_nodes()} nós, {G.number_of_edges()} arestas salvos em '{store.root}'.")
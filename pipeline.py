@@ -0,0 +1,262 @@
+# pipeline.py
+import json
+import os
+import sys
+import time
+
+import instrumentation
+from graph_store import DEFAULT_STORE_DIR
+
+PIPELINE_ALGORITHMS = ('PHAR', 'i-PHAR', 'SHAR', 'Expansive Network')
+
+# Parâmetros padrão (os mesmos da barra lateral do app)
+DEFAULT_CONFIG = {
+    'source': None,             # CSV de crimes ou diretório da base particionada
+    'municipio': None,
+    'uf': None,                 # opcional no CSV: inferida dos dados
+    'naturezas': [],
+    'faixa_hora_1': [],
+    'faixa_hora_6': [],
+    'start': None,              # datas inclusivas (AAAA-MM-DD)
+    'end': None,
+    'algorithm': 'PHAR',
+    'bandwidth': 200,
+    'density_threshold': 1.0,
+    'dist_threshold': 300,
+    'method': 'average',
+    'snap_mode': 'node',
+    'connection': 'all_pairs',  # SHAR
+    'polygon': 'convex',        # PHAR/i-PHAR: 'convex', 'concave' ou 'streets' (hotspot_polygons)
+    'reduction': 'prune',       # rede de trabalho: 'none', 'prune' ou 'contract' (graph_reduction)
+    'new_crimes': [],           # i-PHAR: CSVs aplicados, em ordem, como atualizações
+    'store_dir': DEFAULT_STORE_DIR,
+    'output_dir': 'saida',
+    'output_format': 'geojson',
+}
+
+def load_config(path):
+    """
+    Lê a configuração de um arquivo JSON ou TOML e completa com DEFAULT_CONFIG.
+    """
+    if path.lower().endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Parâmetros desconhecidos na configuração: {', '.join(sorted(unknown))}")
+    return {**DEFAULT_CONFIG, **config}
+
+def load_crimes(config):
+    """
+    Crimes do município com os filtros da configuração, como no app: base particionada
+    (filtros aplicados na leitura) ou CSV limpo e filtrado pelo FilterIndex.
+    """
+    source, municipio = config['source'], config['municipio']
+    if os.path.isdir(source):
+        from crime_store import read_crime_dataset
+        return read_crime_dataset(source, uf=config['uf'], municipio=municipio, start=config['start'],
+                                  end=config['end'], naturezas=config['naturezas'] or None,
+                                  faixa_hora_1=config['faixa_hora_1'] or None,
+                                  faixa_hora_6=config['faixa_hora_6'] or None)
+    from data_utils import load_crime_data
+    from filter_index import FilterIndex
+    df = load_crime_data(source)
+    filters = {'MUNICIPIO': [municipio] if municipio else [], 'UF': [config['uf']] if config['uf'] else [],
+               'DESCR_NATUREZA_PRINCIPAL': config['naturezas'], 'FAIXA_HORA_1': config['faixa_hora_1'],
+               'FAIXA_HORA_6': config['faixa_hora_6']}
+    index = FilterIndex(df, columns=list(filters))
+    start, end = config['start'], config['end']
+    if (start is None) != (end is None):
+        bounds = index.time_bounds()
+        start = start or (bounds[0].date() if bounds else None)
+        end = end or (bounds[1].date() if bounds else None)
+    rows = index.select(filters, start, end)
+    return df if rows is None else df.iloc[rows]
+
+def run_algorithm(graph, densities, config, stats=None):
+    """
+    Executa o algoritmo da configuração sobre as densidades já calculadas.
+    Retorna a saída do algoritmo: [(cluster, polígono)] para PHAR e i-PHAR,
+    [(cluster, arestas)] para o SHAR e [(cluster, nós, arestas)] para o Expansive Network.
+    No i-PHAR, o estado inicial são as densidades (que já incluem os crimes filtrados) e os
+    arquivos de `new_crimes` entram como atualizações.
+    """
+    from algorithms import phar, shar, expansive_network, IncrementalPHAR
+
+    algorithm = config['algorithm']
+    options = {'density_threshold': config['density_threshold'], 'dist_threshold': config['dist_threshold'],
+               'method': config['method']}
+    if algorithm == 'PHAR':
+        return phar(densities, graph, stats=stats, polygon=config['polygon'], **options)
+    if algorithm == 'SHAR':
+        return shar(densities, graph, stats=stats, connection=config['connection'], **options)
+    if algorithm == 'Expansive Network':
+        return expansive_network(densities, graph, density_threshold=config['density_threshold'])
+    if algorithm == 'i-PHAR':
+        from data_utils import create_geodataframe, load_crime_data
+        engine = IncrementalPHAR(graph, densities, bandwidth=config['bandwidth'], polygon=config['polygon'], **options)
+        for path in config['new_crimes']:
+            df_new = load_crime_data(path)
+            if config['municipio'] and 'MUNICIPIO' in df_new.columns:
+                df_new = df_new[df_new['MUNICIPIO'] == config['municipio']]
+            if not df_new.empty:
+                engine.update(snapped=graph.snap_index.snap_gdf(create_geodataframe(df_new), mode=config['snap_mode']))
+        return engine.polygons()
+    raise ValueError(f"Algoritmo desconhecido: {algorithm}")
+
+def hotspot_geometries(graph, result, algorithm):
+    """
+    Geometria de cada hotspot no CRS do grafo: [(cluster, geometria)]. Os subgrafos do
+    SHAR e do Expansive Network viram MultiLineStrings com as arestas do cluster.
+    """
+    if algorithm in ('PHAR', 'i-PHAR'):
+        return list(result)
+    import shapely
+    from map_utils import EdgeGeometryIndex
+    edge_index = EdgeGeometryIndex(graph, epsg=None)
+    return [(item[0], shapely.multilinestrings(edge_index.lookup(item[-1]))) for item in result]
+
+def hotspots_to_4326(graph, hotspots, **columns):
+    """
+    GeoDataFrame (EPSG:4326) dos hotspots, com uma única reprojeção; `columns` são
+    valores constantes acrescentados a todas as linhas (ex.: UF, MUNICIPIO).
+    """
+    import geopandas as gpd
+    geometry = gpd.GeoSeries([g for _, g in hotspots], crs=graph.crs or "EPSG:3857").to_crs(epsg=4326)
+    data = {**{k: [v] * len(hotspots) for k, v in columns.items()},
+            'CLUSTER': [int(cid) for cid, _ in hotspots]}
+    return gpd.GeoDataFrame(data, geometry=geometry.values, crs="EPSG:4326")
+
+def cluster_table(graph, result, algorithm, hotspots_4326, densities=None):
+    """
+    Tabela de clusters (quantidade de pontos e rota no Google Maps), como no app.
+    """
+    from cluster_table import build_cluster_table_polygons, build_cluster_table_subgraphs
+    if algorithm in ('PHAR', 'i-PHAR'):
+        return build_cluster_table_polygons(list(zip(hotspots_4326['CLUSTER'], hotspots_4326.geometry)), graph,
+                                            densities=densities)
+    return build_cluster_table_subgraphs(result, graph, densities=densities)
+
+def run_municipio(df, uf, municipio, config, with_table=True):
+    """
+    Rede, densidades, algoritmo e tabela de clusters para os crimes de um município.
+    Retorna um dict com 'hotspots' (GeoDataFrame EPSG:4326), 'tabela' e o resumo
+    (contagens, tempos por etapa e estatísticas do agrupamento).
+    """
+    from data_utils import create_geodataframe
+    from graph_store import GraphStore
+    from network_utils import get_compiled_graph, snapped_kde
+
+    timings = {}
+
+    def stage(name, compute):
+        start = time.perf_counter()
+        with instrumentation.stage(name):
+            value = compute()
+        timings[name] = round(time.perf_counter() - start, 3)
+        return value
+
+    algorithm = config['algorithm']
+    if algorithm not in PIPELINE_ALGORITHMS:
+        raise ValueError(f"Algoritmo desconhecido: {algorithm}")
+    graph = stage('rede', lambda: get_compiled_graph(f"{municipio}, {uf}, Brazil",
+                                                     store=GraphStore(config['store_dir'])))
+    snapped = stage('snap', lambda: graph.snap_index.snap_gdf(create_geodataframe(df), mode=config['snap_mode']))
+    full_nodes = int(graph.n_nodes)
+    # O i-PHAR associa novos crimes à rede: fica com a rede completa
+    if config['reduction'] != 'none' and algorithm != 'i-PHAR':
+        from graph_reduction import reduce_graph
+        buffer = config['bandwidth'] + (config['dist_threshold'] if algorithm == 'SHAR' else 0)
+        reduced = stage('rede de trabalho', lambda: reduce_graph(graph, snapped, buffer,
+                                                                 contract=config['reduction'] == 'contract'))
+        graph, snapped = reduced.graph, reduced.snapped
+    densities = stage('densidades', lambda: dict(zip(graph.nodes(),
+                                                     snapped_kde(graph, snapped, config['bandwidth']).tolist())))
+    stats = {}
+    result = stage('algoritmo', lambda: run_algorithm(graph, densities, config, stats=stats))
+    hotspots = stage('geometrias', lambda: hotspots_to_4326(graph, hotspot_geometries(graph, result, algorithm),
+                                                            UF=uf, MUNICIPIO=municipio, ALGORITMO=algorithm))
+    table = stage('tabela', lambda: cluster_table(graph, result, algorithm, hotspots, densities)) if with_table else None
+    return {'hotspots': hotspots, 'tabela': table,
+            'resumo': {'UF': uf, 'MUNICIPIO': municipio, 'Crimes': len(df), 'Nós': full_nodes,
+                       'Nós (rede de trabalho)': int(graph.n_nodes),
+                       'Hotspots': len(hotspots), 'Tempos (s)': timings, 'Agrupamento': stats}}
+
+def write_hotspots(hotspots, output):
+    """
+    Grava os hotspots no formato indicado pela extensão do arquivo.
+    """
+    ext = os.path.splitext(output)[1].lower()
+    if ext == '.parquet':
+        hotspots.to_parquet(output)
+    elif ext == '.gpkg':
+        hotspots.to_file(output, driver='GPKG', layer='hotspots')
+    elif ext in ('.geojson', '.json'):
+        hotspots.to_file(output, driver='GeoJSON')
+    else:
+        raise ValueError(f"Formato de saída não suportado: {ext} (use .parquet, .gpkg ou .geojson)")
+
+def run_pipeline(config):
+    """
+    Pipeline completo, sem interface: carrega e filtra os crimes, obtém a rede, calcula
+    as densidades, roda o algoritmo e grava em `output_dir` os hotspots
+    (hotspots.<output_format>), a tabela de clusters (tabela_clusters.csv) e um resumo
+    (resumo.json, com a configuração e os tempos de cada etapa). Retorna o resultado de
+    run_municipio.
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    if not config['source'] or not config['municipio']:
+        raise ValueError("A configuração precisa de 'source' e 'municipio'.")
+    start = time.perf_counter()
+    with instrumentation.stage('dados'):
+        df = load_crimes(config)
+    load_time = round(time.perf_counter() - start, 3)
+    if df.empty:
+        raise ValueError("Nenhum crime encontrado com os filtros da configuração.")
+    uf = config['uf'] or str(df['UF'].iloc[0])
+    result = run_municipio(df, uf, config['municipio'], config)
+    result['resumo']['Tempos (s)'] = {'dados': load_time, **result['resumo']['Tempos (s)']}
+
+    output_dir = config['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    write_hotspots(result['hotspots'], os.path.join(output_dir, f"hotspots.{config['output_format']}"))
+    result['tabela'].to_csv(os.path.join(output_dir, 'tabela_clusters.csv'), index=False)
+    with open(os.path.join(output_dir, 'resumo.json'), 'w', encoding='utf-8') as f:
+        json.dump({'config': config, **result['resumo']}, f, ensure_ascii=False, indent=1, default=str)
+    return result
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Geração de hotspots sem interface, a partir de um arquivo de configuração.")
+    parser.add_argument('config', help="Configuração em JSON ou TOML (ver DEFAULT_CONFIG)")
+    parser.add_argument('--saida', help="Sobrescreve output_dir")
+    parser.add_argument('--diagnostico', action='store_true',
+                        help="Grava tempos e contadores por etapa (diagnostico.jsonl e metricas.prom)")
+    parser.add_argument('--memoria', action='store_true', help="Com --diagnostico, mede o pico de memória (mais lento)")
+    args = parser.parse_args()
+    config = load_config(args.config)
+    if args.saida:
+        config['output_dir'] = args.saida
+    recorder = None
+    try:
+        if args.diagnostico:
+            with instrumentation.recording(memory=args.memoria) as recorder:
+                result = run_pipeline(config)
+        else:
+            result = run_pipeline(config)
+    except Exception as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        sys.exit(1)
+    if recorder is not None:
+        with open(os.path.join(config['output_dir'], 'diagnostico.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(recorder.to_json_lines())
+        with open(os.path.join(config['output_dir'], 'metricas.prom'), 'w', encoding='utf-8') as f:
+            f.write(recorder.to_metrics_text())
+    resumo = result['resumo']
+    print(f"{resumo['MUNICIPIO']}/{resumo['UF']}: {resumo['Crimes']} crimes, {resumo['Hotspots']} hotspots "
+          f"({config['algorithm']}). Tempos: " + ", ".join(f"{k} {v} s" for k, v in resumo['Tempos (s)'].items()))
+    print(f"Saída em '{config['output_dir']}'.")
@@ -0,0 +1,186 @@
+# result_cache.py
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Limites padrão por estágio: (número de entradas, bytes aproximados)
+DEFAULT_LIMITS = {
+    'ingest': (2, 2 * 1024 ** 3),
+    'filter_index': (2, 1024 ** 3),
+    'graph': (4, 2 * 1024 ** 3),
+    'edge_geometry': (4, 1024 ** 3),
+    'geodataframe': (8, 1024 ** 3),
+    'snap': (8, 256 * 1024 ** 2),
+    'reduced_graph': (8, 1024 ** 3),
+    'density_cube': (4, 1024 ** 3),
+    'lixels': (4, 1024 ** 3),
+    'densities': (32, 512 * 1024 ** 2),
+    'merge_tree': (16, 256 * 1024 ** 2),
+    'algorithm': (64, 256 * 1024 ** 2),
+    'route_planner': (4, 256 * 1024 ** 2),
+    'sweep': (8, 128 * 1024 ** 2),
+}
+FALLBACK_LIMIT = (16, 256 * 1024 ** 2)
+
+def _feed(digest, value):
+    """
+    Alimenta o hash com uma representação estável do valor.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        digest.update(repr((type(value).__name__, value)).encode('utf-8'))
+    elif isinstance(value, bytes):
+        digest.update(value)
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'{')
+        for k in sorted(value, key=repr):
+            _feed(digest, k)
+            _feed(digest, value[k])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value
+        digest.update(b'[')
+        for item in items:
+            _feed(digest, item)
+        digest.update(b']')
+    else:
+        digest.update(repr(value).encode('utf-8'))
+
+def content_hash(*parts):
+    """
+    Hash (sha1) do conteúdo das partes informadas: números, textos, bytes, datas,
+    coleções, arrays numpy e objetos pandas.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        _feed(digest, part)
+    return digest.hexdigest()
+
+def file_hash(uploaded_file):
+    """
+    Hash do conteúdo de um arquivo enviado (UploadedFile do Streamlit, objeto com read()
+    ou caminho). A posição de leitura é restaurada ao início.
+    """
+    if isinstance(uploaded_file, str):
+        digest = hashlib.sha1()
+        with open(uploaded_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    if hasattr(uploaded_file, 'getvalue'):
+        return hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+    uploaded_file.seek(0)
+    digest = hashlib.sha1(uploaded_file.read())
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+def estimate_size(value):
+    """
+    Tamanho aproximado, em bytes, de um resultado armazenado.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if callable(getattr(value, 'nbytes', None)):
+        return value.nbytes()
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + 64 * len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in list(value)[:1000])
+    return sys.getsizeof(value)
+
+class ResultCache:
+    """
+    Cache de resultados por estágio do pipeline, endereçado pelo conteúdo das entradas.
+    Cada estágio tem o próprio LRU, limitado em número de entradas e em bytes, de modo
+    que um estágio só recalcula quando as suas entradas mudam.
+    Pode ser compartilhado entre sessões (threads): consultas, inserções, remoções e
+    contadores ficam sob uma trava; o cálculo roda fora dela.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self._stages = {}
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, stage):
+        return self._stages.setdefault(stage, OrderedDict())
+
+    def key(self, *parts):
+        return content_hash(*parts)
+
+    def get_or_compute(self, stage, key_parts, compute):
+        """
+        Retorna o resultado do estágio para as entradas `key_parts`, calculando-o com
+        `compute()` apenas se ainda não estiver no cache.
+        """
+        key = key_parts if isinstance(key_parts, str) else content_hash(*key_parts)
+        with self._lock:
+            entries = self._stage(stage)
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                self.hits[stage] = self.hits.get(stage, 0) + 1
+            else:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+        if entry is not None:
+            instrumentation.count('cache: acertos')
+            return entry[0]
+        instrumentation.count('cache: cálculos')
+        # Duas sessões podem calcular a mesma chave ao mesmo tempo; fica a última gravada
+        value = compute()
+        size = estimate_size(value)
+        with self._lock:
+            self._stage(stage)[key] = (value, size)
+            self._enforce(stage)
+        return value
+
+    def _enforce(self, stage):
+        # Chamado com a trava adquirida
+        max_entries, max_bytes = self.limits.get(stage, FALLBACK_LIMIT)
+        entries = self._stage(stage)
+        total = sum(size for _, size in entries.values())
+        # A entrada mais recente é sempre mantida
+        while len(entries) > 1 and (len(entries) > max_entries or total > max_bytes):
+            _, (_, size) = entries.popitem(last=False)
+            total -= size
+
+    def invalidate(self, stage=None):
+        with self._lock:
+            if stage is None:
+                self._stages.clear()
+            else:
+                self._stages.pop(stage, None)
+
+    def stats(self):
+        """
+        DataFrame com entradas, bytes, acertos e falhas de cada estágio.
+        """
+        rows = []
+        with self._lock:
+            for stage in sorted(set(self._stages) | set(self.hits) | set(self.misses)):
+                entries = self._stages.get(stage, {})
+                rows.append({
+                    'Estágio': stage,
+                    'Entradas': len(entries),
+                    'Bytes': sum(size for _, size in entries.values()),
+                    'Acertos': self.hits.get(stage, 0),
+                    'Falhas': self.misses.get(stage, 0),
+                })
+        return pd.DataFrame(rows)
@@ -0,0 +1,162 @@
+# route_planning.py
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from compiled_graph import compile_graph
+
+# Limite de pontos de uma rota do Google Maps (origem + 23 paradas + destino)
+MAX_ROUTE_POINTS = 25
+# Busca das distâncias limitada a este múltiplo da diagonal dos pontos do cluster
+ROUTE_SEARCH_FACTOR = 3.0
+MIN_ROUTE_SEARCH = 500.0
+# Pares sem caminho dentro da busca: distância em linha reta multiplicada por este fator
+UNREACHABLE_PENALTY = 3.0
+# Matrizes de distância guardadas por RoutePlanner
+MAX_CACHED_MATRICES = 4096
+
+def representative_nodes(graph, nodes, weights=None, k=MAX_ROUTE_POINTS):
+    """
+    Até `k` nós (índices) que representam o cluster: começa pelo nó de maior peso
+    (densidade) e segue pelo nó mais distante dos já escolhidos (farthest point sampling),
+    cobrindo toda a extensão do cluster. Com até `k` nós, devolve todos, do maior peso
+    para o menor.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    weights = np.zeros(len(nodes)) if weights is None else np.asarray(weights, dtype=float)
+    order = np.argsort(-weights, kind='stable')
+    nodes = nodes[order]
+    if len(nodes) <= k:
+        return nodes
+    xy = np.column_stack([graph.x[nodes], graph.y[nodes]])
+    chosen = [0]
+    nearest = np.hypot(*(xy - xy[0]).T)
+    for _ in range(k - 1):
+        far = int(np.argmax(nearest))
+        chosen.append(far)
+        nearest = np.minimum(nearest, np.hypot(*(xy - xy[far]).T))
+    return nodes[chosen]
+
+def _two_opt(dist, tour):
+    """
+    Melhora um ciclo (lista de posições) com trocas 2-opt até não haver ganho; cada
+    passo avalia todas as inversões a partir de uma posição de uma vez.
+    """
+    tour = np.asarray(tour)
+    n = len(tour)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = tour[i - 1], tour[i]
+            c = tour[i + 1:]
+            d = tour[np.r_[i + 2:n, 0][:len(c)]]
+            gain = dist[a, b] + dist[c, d] - dist[a, c] - dist[b, d]
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-9:
+                tour[i:i + j + 2] = tour[i:i + j + 2][::-1]
+                improved = True
+    return tour
+
+def order_route(dist, start=0):
+    """
+    Ordem de visita (caminho aberto) dos pontos da matriz simétrica `dist`: vizinho mais
+    próximo a partir de `start` e refinamento 2-opt. Um ponto fictício a distância zero de
+    todos fecha o ciclo, de modo que o 2-opt também escolhe as duas pontas do caminho.
+    """
+    n = len(dist)
+    if n <= 2:
+        return np.arange(n)
+    full = np.zeros((n + 1, n + 1))
+    full[:n, :n] = dist
+    visited = np.zeros(n + 1, dtype=bool)
+    tour = [n, start]
+    visited[[n, start]] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, full[tour[-1]])
+        nxt = int(np.argmin(row))
+        tour.append(nxt)
+        visited[nxt] = True
+    tour = _two_opt(full, tour)
+    cut = int(np.flatnonzero(tour == n)[0])
+    return np.r_[tour[cut + 1:], tour[:cut]]
+
+class RoutePlanner:
+    """
+    Rotas de patrulha pelos clusters de um CompiledGraph: escolhe até MAX_ROUTE_POINTS nós
+    representativos, calcula as distâncias de rede entre eles (uma busca de dijkstra com
+    várias origens, limitada à extensão do cluster) e ordena a visita com vizinho mais
+    próximo + 2-opt. As matrizes ficam guardadas pelo conjunto de nós, de modo que redesenhar
+    a mesma tabela não refaz as buscas. O planejador fica no cache compartilhado entre
+    sessões, então o LRU das matrizes fica sob uma trava (as buscas rodam fora dela).
+    """
+
+    def __init__(self, G, max_points=MAX_ROUTE_POINTS):
+        self.graph = compile_graph(G)
+        self.max_points = max_points
+        self._matrices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def nbytes(self):
+        with self._lock:
+            return sum(m.nbytes for m in self._matrices.values())
+
+    def distance_matrix(self, nodes):
+        """
+        Matriz simétrica de distâncias de rede entre os nós (índices); nos pares sem caminho
+        dentro da busca, a distância em linha reta vezes UNREACHABLE_PENALTY.
+        """
+        key = tuple(np.asarray(nodes).tolist())
+        with self._lock:
+            matrix = self._matrices.get(key)
+            if matrix is not None:
+                self._matrices.move_to_end(key)
+                return matrix
+        graph = self.graph
+        nodes = np.asarray(nodes, dtype=np.int64)
+        xy = np.column_stack([graph.x[nodes], graph.y[nodes]])
+        straight = np.hypot(xy[:, None, 0] - xy[None, :, 0], xy[:, None, 1] - xy[None, :, 1])
+        limit = max(MIN_ROUTE_SEARCH, ROUTE_SEARCH_FACTOR * np.hypot(*np.ptp(xy, axis=0)))
+        network = dijkstra(graph.matrix, directed=True, indices=nodes, limit=limit)[:, nodes]
+        # Vias de mão única: para a ordem de visita, a média dos dois sentidos
+        network = np.where(np.isfinite(network), network, UNREACHABLE_PENALTY * straight)
+        matrix = (network + network.T) / 2
+        with self._lock:
+            self._matrices[key] = matrix
+            if len(self._matrices) > MAX_CACHED_MATRICES:
+                self._matrices.popitem(last=False)
+        return matrix
+
+    def route(self, nodes, weights=None):
+        """
+        Nós (índices) da rota do cluster, na ordem de visita, a partir da ponta do caminho
+        mais próxima do nó mais denso.
+        """
+        chosen = representative_nodes(self.graph, nodes, weights, self.max_points)
+        if len(chosen) <= 2:
+            return chosen
+        order = order_route(self.distance_matrix(chosen))
+        # O caminho é percorrido a partir da ponta mais próxima (na ordem) do nó mais denso
+        if np.flatnonzero(order == 0)[0] > len(order) // 2:
+            order = order[::-1]
+        return chosen[order]
+
+    def routes_latlon(self, clusters, weights=None):
+        """
+        Rotas de vários clusters (listas de índices de nós) como listas de (lat, lon), com
+        uma única transformação de CRS para todos os pontos. `weights` (array alinhado aos
+        nós do grafo) prioriza os nós mais densos.
+        """
+        from pyproj import Transformer
+        graph = self.graph
+        routes = [self.route(nodes, None if weights is None else weights[np.asarray(nodes, dtype=np.int64)])
+                  for nodes in clusters]
+        if not routes:
+            return []
+        flat = np.concatenate([np.asarray(r, dtype=np.int64) for r in routes])
+        transformer = Transformer.from_crs(graph.crs or "EPSG:3857", "EPSG:4326", always_xy=True)
+        lon, lat = transformer.transform(graph.x[flat], graph.y[flat])
+        bounds = np.cumsum([0] + [len(r) for r in routes])
+        return [list(zip(lat[a:b].tolist(), lon[a:b].tolist())) for a, b in zip(bounds[:-1], bounds[1:])]
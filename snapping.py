@@ -0,0 +1,136 @@
+# snapping.py
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+SNAP_MODES = ('node', 'edge')
+
+class SnappedPoints:
+    """
+    Posições de pontos já associados à rede de um CompiledGraph.
+    mode 'node': `node` guarda o índice do nó mais próximo de cada ponto.
+    mode 'edge': `edge` guarda a posição da aresta mais próxima (alinhada a graph.indices)
+    e `offset` a distância, em metros, do nó de origem da aresta até o ponto projetado.
+    `distance` é a distância (unidades do CRS) entre o ponto e a posição na rede.
+    """
+
+    def __init__(self, mode, node=None, edge=None, offset=None, distance=None):
+        if mode not in SNAP_MODES:
+            raise ValueError(f"Modo de snapping desconhecido: {mode}")
+        self.mode = mode
+        self.node = node
+        self.edge = edge
+        self.offset = offset
+        self.distance = distance
+
+    def __len__(self):
+        return len(self.node if self.mode == 'node' else self.edge)
+
+    def take(self, rows):
+        """
+        Subconjunto dos pontos (máscara booleana ou posições).
+        """
+        def pick(values):
+            return None if values is None else values[rows]
+        return SnappedPoints(self.mode, node=pick(self.node), edge=pick(self.edge),
+                             offset=pick(self.offset), distance=pick(self.distance))
+
+    def edge_ends(self, graph):
+        """
+        Para o modo 'edge', retorna os ids (u, v) da aresta de cada ponto.
+        """
+        u = graph.edge_sources[self.edge]
+        v = graph.indices[self.edge]
+        return graph.node_ids[u], graph.node_ids[v]
+
+class SnapIndex:
+    """
+    Índice espacial persistente de um CompiledGraph: KD-tree sobre os nós e STRtree
+    sobre as geometrias das arestas (construída apenas quando o modo 'edge' é usado).
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._node_tree = cKDTree(np.column_stack([graph.x, graph.y]))
+        self._edge_tree = None
+        self._edge_geometry = None
+
+    def nearest_nodes(self, X, Y, return_distance=False):
+        """
+        Índices dos nós mais próximos de cada ponto (X, Y), em uma única consulta.
+        """
+        xy = np.column_stack([np.asarray(X, dtype=float), np.asarray(Y, dtype=float)])
+        distance, idx = self._node_tree.query(xy)
+        return (idx, distance) if return_distance else idx
+
+    def nodes_within(self, X, Y, radius):
+        """
+        Índices (únicos) dos nós a até `radius` (unidades do CRS) de algum dos pontos (X, Y).
+        """
+        xy = np.column_stack([np.asarray(X, dtype=float), np.asarray(Y, dtype=float)])
+        if not len(xy):
+            return np.empty(0, dtype=np.int64)
+        hits = self._node_tree.query_ball_point(xy, r=radius)
+        return np.unique(np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]))
+
+    @property
+    def edge_geometry(self):
+        """
+        Geometrias das arestas; segmentos retos entre os nós quando o grafo não as possui.
+        """
+        if self._edge_geometry is None:
+            graph = self.graph
+            geometry = graph.edge_geometry
+            if geometry is None:
+                u = graph.edge_sources
+                v = graph.indices
+                geometry = shapely.linestrings(np.stack([np.column_stack([graph.x[u], graph.y[u]]),
+                                                         np.column_stack([graph.x[v], graph.y[v]])], axis=1))
+            self._edge_geometry = geometry
+        return self._edge_geometry
+
+    def _edges(self):
+        if self._edge_tree is None:
+            self._edge_tree = shapely.STRtree(self.edge_geometry)
+        return self._edge_tree, self.edge_geometry
+
+    def nearest_edges(self, X, Y):
+        """
+        Projeta cada ponto na aresta mais próxima.
+        Retorna (posição da aresta, offset em metros a partir da origem, distância).
+        """
+        tree, geometry = self._edges()
+        points = shapely.points(np.asarray(X, dtype=float), np.asarray(Y, dtype=float))
+        edge = np.zeros(len(points), dtype=np.int64)
+        distance = np.zeros(len(points))
+        (p_idx, e_idx), dist = tree.query_nearest(points, return_distance=True, all_matches=False)
+        edge[p_idx] = e_idx
+        distance[p_idx] = dist
+        lines = geometry[edge]
+        along = shapely.line_locate_point(lines, points)
+        line_length = shapely.length(lines)
+        # Converte a posição ao longo da geometria (unidades do CRS) em metros da aresta
+        ratio = np.divide(along, line_length, out=np.zeros(len(points)), where=line_length > 0)
+        offset = ratio * self.graph.lengths[edge]
+        return edge, offset, distance
+
+    def snap(self, X, Y, mode='node'):
+        """
+        Associa os pontos (X, Y), no CRS do grafo, à rede. Retorna SnappedPoints.
+        """
+        if mode == 'node':
+            node, distance = self.nearest_nodes(X, Y, return_distance=True)
+            return SnappedPoints('node', node=node, distance=distance)
+        if mode == 'edge':
+            edge, offset, distance = self.nearest_edges(X, Y)
+            return SnappedPoints('edge', edge=edge, offset=offset, distance=distance)
+        raise ValueError(f"Modo de snapping desconhecido: {mode}")
+
+    def snap_gdf(self, gdf, mode='node'):
+        """
+        Reprojeta o GeoDataFrame (ou GeoSeries) uma única vez para o CRS do grafo e
+        associa todos os pontos à rede.
+        """
+        crs = self.graph.crs or "EPSG:3857"
+        geometry = gdf.geometry.to_crs(crs)
+        return self.snap(geometry.x.values, geometry.y.values, mode=mode)
@@ -0,0 +1,171 @@
+# sweep.py
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from algorithms import phar, expansive_network, expansion_tree
+from compiled_graph import compile_graph
+from network_utils import _distance_triplets, edge_kde, edge_seed_nodes
+
+SWEEP_ALGORITHMS = ('PHAR', 'Expansive Network')
+
+class KDESweep:
+    """
+    Densidades do KDE restrito à rede para várias bandwidths a partir de uma única busca
+    de caminhos mínimos, feita na maior bandwidth: para as menores, as mesmas distâncias
+    são filtradas (d <= bandwidth) e reponderadas com exp(-d / bandwidth).
+    """
+
+    def __init__(self, G, snapped, max_bandwidth):
+        self.graph = compile_graph(G)
+        self.snapped = snapped
+        self.max_bandwidth = max_bandwidth
+        if snapped.mode == 'node':
+            self.sources, self.counts = np.unique(snapped.node, return_counts=True)
+            self.triplets = _distance_triplets(self.graph, self.sources, max_bandwidth)
+        else:
+            seeds = edge_seed_nodes(self.graph, snapped.edge)
+            self.triplets = (seeds, *_distance_triplets(self.graph, seeds, max_bandwidth))
+
+    def densities(self, bandwidth):
+        """
+        Array com a densidade de cada nó para `bandwidth` (<= max_bandwidth).
+        """
+        if bandwidth > self.max_bandwidth:
+            raise ValueError(f"Bandwidth {bandwidth} maior que a da varredura ({self.max_bandwidth}).")
+        graph = self.graph
+        if self.snapped.mode == 'edge':
+            return edge_kde(graph, self.snapped.edge, self.snapped.offset, bandwidth, triplets=self.triplets)
+        rows, cols, dists = self.triplets
+        within = dists <= bandwidth
+        weights = self.counts[rows[within]] * np.exp(-dists[within] / bandwidth)
+        return np.bincount(cols[within], weights=weights, minlength=graph.n_nodes)
+
+    def densities_dict(self, bandwidth):
+        return dict(zip(self.graph.nodes(), self.densities(bandwidth).tolist()))
+
+def _crime_nodes(graph, snapped):
+    """
+    Nó de rede de cada crime: o próprio nó no modo 'node'; no modo 'edge', a
+    extremidade da aresta mais próxima do ponto projetado.
+    """
+    if snapped.mode == 'node':
+        return snapped.node
+    u = graph.edge_sources[snapped.edge]
+    v = graph.indices[snapped.edge]
+    return np.where(snapped.offset <= graph.lengths[snapped.edge] / 2, u, v)
+
+def _area_factor(graph):
+    """
+    Fator que converte áreas em EPSG:3857 para m² aproximados na latitude média da rede.
+    """
+    if graph.crs is not None and '3857' not in str(graph.crs):
+        return 1.0
+    lat = np.arctan(np.sinh(np.mean(graph.y) / 6378137.0))
+    return float(np.cos(lat) ** 2)
+
+def _summarize_phar(graph, polygons, crime_nodes, area_factor):
+    hulls = np.array([hull for _, hull in polygons], dtype=object)
+    covered = 0
+    if len(hulls):
+        points = shapely.points(graph.x[crime_nodes], graph.y[crime_nodes])
+        hit, _ = shapely.STRtree(hulls).query(points, predicate='intersects')
+        covered = len(np.unique(hit))
+    return {'Hotspots': len(polygons),
+            'Área total (km²)': float(shapely.area(hulls).sum()) * area_factor / 1e6 if len(hulls) else 0.0,
+            'Crimes cobertos': covered}
+
+def _summarize_expansive(graph, expansions, crime_nodes):
+    nodes = set()
+    pairs = set()
+    for _, cluster_nodes, cluster_edges in expansions:
+        nodes |= cluster_nodes
+        pairs |= {(min(a, b), max(a, b)) for a, b in cluster_edges}
+    length = 0.0
+    if pairs:
+        index = graph.index
+        u = np.fromiter((index[a] for a, _ in pairs), dtype=np.int64, count=len(pairs))
+        v = np.fromiter((index[b] for _, b in pairs), dtype=np.int64, count=len(pairs))
+        pos = graph.find_edges(u, v)
+        pos = np.where(pos >= 0, pos, graph.find_edges(v, u))
+        length = float(graph.lengths[pos[pos >= 0]].sum())
+    in_cluster = np.zeros(graph.n_nodes, dtype=bool)
+    if nodes:
+        in_cluster[graph.indices_of(nodes)] = True
+    return {'Hotspots': len(expansions),
+            'Extensão total (km)': length / 1000,
+            'Crimes cobertos': int(in_cluster[crime_nodes].sum())}
+
+def parse_values(text, cast=float):
+    """
+    Converte uma lista digitada ("100, 200; 300") em valores; ignora entradas inválidas.
+    """
+    values = []
+    for part in text.replace(';', ',').split(','):
+        try:
+            values.append(cast(part.strip()))
+        except ValueError:
+            continue
+    return sorted(set(values))
+
+def run_sweep(G, snapped, bandwidths, density_thresholds, dist_thresholds, algorithms=SWEEP_ALGORITHMS,
+              method='average', workers=1, progress=None):
+    """
+    Executa PHAR e/ou Expansive Network para todas as combinações de bandwidth, limiar de
+    densidade e distância de cluster (esta só afeta o PHAR). As distâncias de rede são
+    calculadas uma única vez, na maior bandwidth. `workers` > 1 roda as combinações em
+    paralelo (threads). Retorna um DataFrame com hotspots, área ou extensão e a parcela
+    dos crimes cobertos em cada combinação.
+    """
+    graph = compile_graph(G)
+    start = time.perf_counter()
+    sweep = KDESweep(graph, snapped, max(bandwidths))
+    distance_time = time.perf_counter() - start
+    crime_nodes = _crime_nodes(graph, snapped)
+    area_factor = _area_factor(graph)
+    densities = {bw: sweep.densities_dict(bw) for bw in sorted(set(bandwidths))}
+    # Uma árvore de junção por bandwidth atende todos os limiares do Expansive Network
+    trees = {bw: expansion_tree(densities[bw], graph) for bw in densities} if 'Expansive Network' in algorithms else {}
+
+    tasks = []
+    for algorithm in algorithms:
+        dists = sorted(set(dist_thresholds)) if algorithm == 'PHAR' else [None]
+        tasks += list(itertools.product([algorithm], sorted(densities), sorted(set(density_thresholds)), dists))
+
+    def run(task):
+        algorithm, bw, threshold, dist = task
+        t0 = time.perf_counter()
+        if algorithm == 'PHAR':
+            summary = _summarize_phar(graph, phar(densities[bw], graph, threshold, dist, method=method),
+                                      crime_nodes, area_factor)
+        else:
+            summary = _summarize_expansive(graph, expansive_network(densities[bw], graph, threshold, tree=trees[bw]),
+                                           crime_nodes)
+        row = {'Algoritmo': algorithm, 'Bandwidth': bw, 'Limiar de densidade': threshold,
+               'Distância de cluster': dist, **summary}
+        row['% dos crimes'] = 100.0 * row.pop('Crimes cobertos') / max(len(crime_nodes), 1)
+        row['Tempo (s)'] = round(time.perf_counter() - t0, 3)
+        return row
+
+    rows = []
+    if workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, row in enumerate(executor.map(run, tasks)):
+                rows.append(row)
+                if progress:
+                    progress(i + 1, len(tasks))
+    else:
+        for i, task in enumerate(tasks):
+            rows.append(run(task))
+            if progress:
+                progress(i + 1, len(tasks))
+    table = pd.DataFrame(rows)
+    columns = ['Algoritmo', 'Bandwidth', 'Limiar de densidade', 'Distância de cluster', 'Hotspots',
+               'Área total (km²)', 'Extensão total (km)', '% dos crimes', 'Tempo (s)']
+    table = table.reindex(columns=[c for c in columns if c in table.columns])
+    table.attrs['tempo_distancias'] = distance_time
+    return table